@@ -27,11 +27,8 @@ def create_app(config_class=None):
     db.init_app(app)
     login_manager.init_app(app)
     migrate.init_app(app, db)
-    # Кэш (простая память по умолчанию; можно заменить на Redis через конфиг)
-    cache.init_app(app, config={
-        'CACHE_TYPE': 'SimpleCache',
-        'CACHE_DEFAULT_TIMEOUT': 60
-    })
+    # Кэш, общий для процессов gunicorn (бэкенд — CACHE_TYPE в конфиге)
+    cache.init_app(app)
     
     login_manager.login_view = 'user.login'
     # Убираем сообщение о необходимости входа в систему
@@ -63,10 +60,38 @@ def create_app(config_class=None):
     app.register_blueprint(supply, url_prefix='/supply')
     app.register_blueprint(objects_bp, url_prefix='/objects')
     
+    # Фоновая пакетная запись журнала действий
+    from .utils.activity_writer import activity_log_writer
+    activity_log_writer.init_app(app)
+    
+    # Команды обслуживания хранилища вложений (flask blobs migrate / gc)
+    from .utils.blob_store import blobs_cli
+    app.cli.add_command(blobs_cli)
+    
+    # Счётчики и сброс общего кэша (flask cache stats / clear)
+    from .utils.shared_cache import cache_cli
+    app.cli.add_command(cache_cli)
+    
+    # Секции и архив журнала действий (flask activity-log backfill / archive)
+    from .utils.activity_archive import activity_log_cli
+    app.cli.add_command(activity_log_cli)
+    
+    # Сводка активности календаря (flask calendar rebuild)
+    from .utils.calendar_index import calendar_cli
+    app.cli.add_command(calendar_cli)
+    
+    # Сводка по копке траншей (flask trenches refresh-progress)
+    from .utils.trench_progress import trenches_cli
+    app.cli.add_command(trenches_cli)
+    
     # Инициализация планировщика задач (только в production)
     if not app.debug:
         from .utils.scheduler import scheduler
         scheduler.init_app(app)
+    else:
+        # Без планировщика статусы работ и траншей пересчитываются перед запросами
+        from .utils.scheduler import sweep_statuses_on_request
+        sweep_statuses_on_request(app)
     
     # Регистрируем фильтры и контекстные процессоры
     _register_template_filters(app)
@@ -39,6 +39,47 @@ class Config(object):
     # Upload folder for avatars
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads', 'avatars')
     
+    # Хранилище содержимого вложений (файлы по SHA-256 вне БД)
+    BLOB_STORE_BACKEND = os.environ.get('BLOB_STORE_BACKEND', 'local')
+    BLOB_STORE_PATH = os.environ.get(
+        'BLOB_STORE_PATH',
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'blobs'),
+    )
+    # Уменьшенные копии фото вложений (строятся при первом запросе)
+    THUMBNAIL_PATH = os.environ.get(
+        'THUMBNAIL_PATH',
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'thumbs'),
+    )
+    
+    # Журнал действий: очередь процесса и пакетная запись фоновым потоком
+    ACTIVITY_LOG_ASYNC = os.environ.get('ACTIVITY_LOG_ASYNC', 'true').lower() == 'true'
+    ACTIVITY_LOG_QUEUE_SIZE = 10000
+    ACTIVITY_LOG_BATCH_SIZE = 200
+    ACTIVITY_LOG_FLUSH_INTERVAL_MS = 500
+    ACTIVITY_LOG_ENQUEUE_TIMEOUT_MS = 50
+    # Правила полной записи и свёртки просмотров (None — activity_policy.DEFAULT_RULES)
+    ACTIVITY_LOG_RULES = None
+    # Срок хранения журнала в таблице; старые месяцы уходят в сжатый архив
+    ACTIVITY_LOG_RETENTION_MONTHS = int(os.environ.get('ACTIVITY_LOG_RETENTION_MONTHS', 6))
+    ACTIVITY_LOG_ARCHIVE_PATH = os.environ.get(
+        'ACTIVITY_LOG_ARCHIVE_PATH',
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'activity_archive'),
+    )
+    
+    # Кэш приложения: файл SQLite, общий для всех процессов gunicorn
+    # (app/utils/shared_cache.py); для нескольких серверов — RedisCache
+    CACHE_TYPE = os.environ.get('CACHE_TYPE', 'app.utils.shared_cache.SQLiteCache')
+    CACHE_DIR = os.environ.get(
+        'CACHE_DIR',
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'cache'),
+    )
+    CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT', 60))
+    CACHE_THRESHOLD = 5000
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+    # Срок хранения страниц в кэше: устаревшие страницы сбрасываются по тегам
+    # при изменении данных (app/utils/cache_tags.py), срок лишь ограничивает размер
+    PAGE_CACHE_TIMEOUT = int(os.environ.get('PAGE_CACHE_TIMEOUT', 6 * 3600))
+    
     # Максимальный размер загружаемого файла (15 МБ)
     MAX_CONTENT_LENGTH = 15 * 1024 * 1024
     
@@ -1,6 +1,6 @@
 from .settings import SystemSetting  # noqa: F401
 from .users import Users
-from .activity_log import ActivityLog
+from .activity_log import ActivityAction, ActivityLog, ActivityLogRollup
 from .supply import Material, Equipment, SupplyOrder, SupplyOrderItem, WarehouseMovement, WarehouseAttachment, UserMaterialAllocation, SupplyRequest, SupplyRequestItem
-from .objects import Object, Support, Trench, TrenchExcavation, TrenchFile, Report, Checklist, ChecklistItem
+from .objects import Object, Support, Trench, TrenchExcavation, TrenchFile, Report, Checklist, ChecklistItem, ActivityDate
 from .remembered_device import RememberedDevice
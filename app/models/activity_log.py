@@ -4,9 +4,27 @@ import pytz
 from app.extensions import db
 from app.utils.timezone_utils import get_moscow_now, to_moscow_time
 
+def month_key(moment):
+    """Секция журнала для момента времени: ГГГГММ"""
+    return moment.year * 100 + moment.month
+
+
+def _partition_month_default(context):
+    created_at = context.get_current_parameters().get('created_at') or get_moscow_now()
+    return month_key(created_at)
+
+
 class ActivityLog(db.Model):
     """Модель журнала действий пользователей"""
     __tablename__ = 'activity_logs'
+    __table_args__ = (
+        # Секции-месяцы: фильтры по дате и архивация старых месяцев (app/utils/activity_archive.py)
+        db.Index('ix_activity_logs_partition_month_created_at', 'partition_month', 'created_at'),
+        # Keyset-пагинация журнала по (created_at, id) и её фильтры
+        db.Index('ix_activity_logs_created_at_id', 'created_at', 'id'),
+        db.Index('ix_activity_logs_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_activity_logs_action_created_at', 'action', 'created_at'),
+    )
     
     id = db.Column(db.UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = db.Column(db.UUID(as_uuid=True), db.ForeignKey('users.userid'), nullable=True)
@@ -19,6 +37,8 @@ class ActivityLog(db.Model):
     method = db.Column(db.String(10), nullable=True)  # HTTP метод
     status_code = db.Column(db.Integer, nullable=True)  # HTTP статус код
     created_at = db.Column(db.DateTime, default=get_moscow_now, nullable=False)
+    # Секция ГГГГММ по created_at; NULL — запись до разметки (flask activity-log backfill)
+    partition_month = db.Column(db.Integer, nullable=True, default=_partition_month_default)
     
     # Связь с пользователем
     user = db.relationship('Users', backref='activity_logs')
@@ -46,27 +66,48 @@ class ActivityLog(db.Model):
     
     @classmethod
     def log_action(cls, user_id=None, user_login=None, action="", description="", ip_address=None, page_url=None, method=None, **kwargs):
-        """Создает запись в журнале действий"""
+        """Создает запись в журнале действий
+
+        Запись ставится в очередь и пишется фоновым потоком пакетами
+        (app/utils/activity_writer.py): запрос не ждёт INSERT, а текущая
+        сессия не коммитится. Просмотры страниц по правилам
+        app/utils/activity_policy.py сворачиваются в почасовые счётчики
+        ActivityLogRollup. Возвращает True, если запись принята.
+        """
+        from app.utils.activity_policy import MODE_DROP, MODE_ROLLUP, apply_policy
+        from app.utils.activity_writer import activity_log_writer
+
+        row = {
+            'user_id': user_id,
+            'user_login': user_login or "Неавторизованный пользователь",
+            'action': action,
+            'description': description,
+            'ip_address': ip_address,
+            'user_agent': None,
+            'page_url': page_url,
+            'method': method,
+            'status_code': None,
+            'created_at': get_moscow_now(),
+        }
+        unknown = set(kwargs) - set(row)
+        if unknown:
+            print(f"Ошибка при записи в журнал действий: неизвестные поля {sorted(unknown)}")
+            return False
+        row.update(kwargs)
         try:
-            log_entry = cls(
-                user_id=user_id,
-                user_login=user_login or "Неавторизованный пользователь",
-                action=action,
-                description=description,
-                ip_address=ip_address,
-                page_url=page_url,
-                method=method,
-                **kwargs
-            )
-            
-            db.session.add(log_entry)
-            db.session.commit()
-            
-            return log_entry
+            # Политика журнала: полная запись, счётчик просмотров за час или пропуск
+            mode, keep_detail = apply_policy(action, method)
+            if mode == MODE_DROP:
+                return True
+            accepted = True
+            if mode == MODE_ROLLUP:
+                accepted = activity_log_writer.enqueue(row, rollup=True)
+            if keep_detail:
+                accepted = activity_log_writer.enqueue(row) and accepted
+            return accepted
         except Exception as e:
-            db.session.rollback()
             print(f"Ошибка при записи в журнал действий: {e}")
-            return None
+            return False
     
     @classmethod
     def get_recent_activities(cls, limit=50):
@@ -90,3 +131,50 @@ class ActivityLog(db.Model):
             cls.created_at >= start_date,
             cls.created_at <= end_date
         ).order_by(cls.created_at.desc()).limit(limit).all()
+
+
+class ActivityAction(db.Model):
+    """Справочник названий действий журнала
+
+    Пополняется при записи журнала (app/utils/activity_writer.py); фильтр
+    журнала по действию выбирает названия из справочника и ищет по индексу
+    (action, created_at) вместо поиска подстроки по всей таблице.
+    """
+    __tablename__ = 'activity_actions'
+
+    name = db.Column(db.String(100), primary_key=True)
+    first_seen = db.Column(db.DateTime, default=get_moscow_now, nullable=False)
+
+
+class ActivityLogRollup(db.Model):
+    """Почасовой счётчик повторяющихся действий (просмотров страниц)
+
+    Одна строка — сколько раз пользователь выполнил действие на странице за час.
+    """
+    __tablename__ = 'activity_log_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('hour', 'user_login', 'action', 'page', name='uq_activity_log_rollups_key'),
+        db.Index('ix_activity_log_rollups_user_id_hour', 'user_id', 'hour'),
+    )
+
+    id = db.Column(db.UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    hour = db.Column(db.DateTime, nullable=False)  # Начало часа (московское время)
+    user_id = db.Column(db.UUID(as_uuid=True), db.ForeignKey('users.userid'), nullable=True)
+    user_login = db.Column(db.String(50), nullable=False)
+    action = db.Column(db.String(100), nullable=False)
+    page = db.Column(db.String(500), nullable=False, default='')  # Путь страницы без параметров
+    count = db.Column(db.Integer, nullable=False, default=0)
+    first_seen = db.Column(db.DateTime, nullable=False)
+    last_seen = db.Column(db.DateTime, nullable=False)
+
+    def to_dict(self):
+        return {
+            'hour': to_moscow_time(self.hour).isoformat() if self.hour else None,
+            'user_id': self.user_id,
+            'user_login': self.user_login,
+            'action': self.action,
+            'page': self.page,
+            'count': self.count,
+            'first_seen': to_moscow_time(self.first_seen).isoformat() if self.first_seen else None,
+            'last_seen': to_moscow_time(self.last_seen).isoformat() if self.last_seen else None,
+        }
@@ -2,6 +2,7 @@ from app.extensions import db
 from datetime import datetime
 import uuid
 from app.utils.timezone_utils import get_moscow_now
+from app.utils.blob_store import BlobContentMixin
 
 class Object(db.Model):
     """Модель объекта"""
@@ -78,13 +79,33 @@ class Trench(db.Model):
     updated_at = db.Column(db.DateTime, default=get_moscow_now, onupdate=get_moscow_now)
     created_by = db.Column(db.UUID(as_uuid=True), db.ForeignKey('users.userid'))
     
+    # Сводка по копке (пересчитывается refresh_progress() при добавлении записи о копке)
+    total_excavated = db.Column(db.Float, nullable=False, default=0.0, server_default='0')  # выкопано метров
+    files_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # прикреплено файлов
+    required_files = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # требуется файлов
+    
     # Связи
     excavations = db.relationship('TrenchExcavation', backref='trench', lazy=True, cascade='all, delete-orphan')
     files = db.relationship('TrenchFile', backref='trench', lazy=True, cascade='all, delete-orphan')
     
+    @staticmethod
+    def required_files_for(length):
+        """Минимальное число файлов для выкопанной длины: по файлу на каждые начатые 20 м"""
+        return max(1, int(length / 20) + (1 if length % 20 > 0 else 0))
+    
+    def refresh_progress(self):
+        """Пересчитывает сводку по копке по записям о копке и файлам траншеи"""
+        self.total_excavated = db.session.query(
+            db.func.coalesce(db.func.sum(TrenchExcavation.length), 0.0)
+        ).filter(TrenchExcavation.trench_id == self.id).scalar()
+        self.files_count = db.session.query(db.func.count(TrenchFile.id)).filter(
+            TrenchFile.trench_id == self.id
+        ).scalar()
+        self.required_files = self.required_files_for(self.total_excavated)
+    
     def get_total_excavated_length(self):
         """Возвращает общую длину выкопанной траншеи"""
-        return sum(exc.length for exc in self.excavations)
+        return self.total_excavated or 0.0
     
     def check_completion_status(self):
         """Проверяет и обновляет статус завершения траншеи"""
@@ -99,12 +120,11 @@ class Trench(db.Model):
     
     def get_required_files_count(self):
         """Возвращает минимальное количество файлов, которое должно быть прикреплено"""
-        total_excavated = self.get_total_excavated_length()
-        return max(1, int(total_excavated / 20) + (1 if total_excavated % 20 > 0 else 0))
+        return self.required_files or self.required_files_for(self.get_total_excavated_length())
     
     def get_files_count(self):
         """Возвращает количество прикрепленных файлов"""
-        return len(self.files)
+        return self.files_count or 0
     
     @staticmethod
     def update_overdue_trenches():
@@ -274,6 +294,10 @@ class Checklist(db.Model):
 class ChecklistItem(db.Model):
     """Модель элемента чек-листа"""
     __tablename__ = 'checklist_items'
+    __table_args__ = (
+        db.Index('ix_checklist_items_checklist_id', 'checklist_id'),
+        db.Index('ix_checklist_items_completed_at', 'completed_at'),
+    )
     
     id = db.Column(db.UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     checklist_id = db.Column(db.UUID(as_uuid=True), db.ForeignKey('checklists.id'), nullable=False)
@@ -575,7 +599,7 @@ class Luminaire(db.Model):
     # Связь с опорой
     support = db.relationship('Support', backref='luminaire_elements', lazy=True)
 
-class ElementAttachment(db.Model):
+class ElementAttachment(BlobContentMixin, db.Model):
     """Модель для файлов-вложений элементов (ZDF, Bracket, Luminaire)"""
     __tablename__ = 'element_attachments'
     
@@ -585,7 +609,9 @@ class ElementAttachment(db.Model):
     filename = db.Column(db.String(255), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
     content_type = db.Column(db.String(127), nullable=True)
-    data = db.Column(db.LargeBinary, nullable=False)
+    # Содержимое — в blob_store (см. app/utils/blob_store.py); data остаётся у старых записей до переноса
+    data = db.deferred(db.Column(db.LargeBinary, nullable=True))
+    sha256 = db.Column(db.String(64), nullable=True)
     size_bytes = db.Column(db.Integer, nullable=False)
     uploaded_by = db.Column(db.UUID(as_uuid=True), db.ForeignKey('users.userid'), nullable=False)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
@@ -606,7 +632,7 @@ class ElementAttachment(db.Model):
             'uploaded_at': self.uploaded_at.isoformat() if self.uploaded_at else None,
         }
         if include_data:
-            payload['data'] = self.data
+            payload['data'] = self.read_content()
         return payload
 
 class DailyReport(db.Model):
@@ -655,4 +681,21 @@ class DailyReport(db.Model):
     rejector = db.relationship('Users', foreign_keys=[rejected_by], backref='rejected_daily_reports')
     
     # Уникальность: один отчёт на объект в день
-    __table_args__ = (db.UniqueConstraint('object_id', 'report_date', name='unique_daily_report_per_object'),)
\ No newline at end of file
+    __table_args__ = (db.UniqueConstraint('object_id', 'report_date', name='unique_daily_report_per_object'),)
+
+class ActivityDate(db.Model):
+    """Сводка активности по дням и объектам для календаря.
+
+    Счётчики поддерживаются app/utils/calendar_index.py при записи отчётов,
+    работ, опор, траншей и пунктов чек-листа.
+    """
+    __tablename__ = 'activity_dates'
+
+    day = db.Column(db.Date, primary_key=True)
+    object_id = db.Column(db.UUID(as_uuid=True), db.ForeignKey('objects.id', ondelete='CASCADE'), primary_key=True)
+    reports_count = db.Column(db.Integer, nullable=False, default=0)
+    daily_reports_count = db.Column(db.Integer, nullable=False, default=0)
+    planned_works_count = db.Column(db.Integer, nullable=False, default=0)
+    supports_count = db.Column(db.Integer, nullable=False, default=0)
+    trenches_count = db.Column(db.Integer, nullable=False, default=0)
+    checklist_items_count = db.Column(db.Integer, nullable=False, default=0)
@@ -3,10 +3,15 @@ from datetime import datetime, timezone, timedelta
 import pytz
 from app.extensions import db
 from app.utils.timezone_utils import get_moscow_now
+from app.utils.blob_store import BlobContentMixin
 
 class Material(db.Model):
     """Модель для материалов"""
     __tablename__ = 'materials'
+    __table_args__ = (
+        # Keyset-пагинация истории движений (синтетические записи «creation»)
+        db.Index('ix_materials_created_at_id', 'created_at', 'id'),
+    )
     
     id = db.Column(db.UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     name = db.Column(db.String(200), nullable=False)
@@ -20,6 +25,10 @@ class Material(db.Model):
     created_by = db.Column(db.UUID(as_uuid=True), db.ForeignKey('users.userid'), nullable=True)
     created_at = db.Column(db.DateTime, default=get_moscow_now, nullable=False)
     updated_at = db.Column(db.DateTime, default=get_moscow_now, onupdate=get_moscow_now)
+    # Версия строки для оптимистической блокировки (см. app/utils/stock_ledger.py)
+    version_id = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version_id}
     
     def to_dict(self):
         return {
@@ -40,6 +49,15 @@ class Material(db.Model):
 class WarehouseMovement(db.Model):
     """Движение по складу: поступления, выдачи, перемещения, возвраты, списания"""
     __tablename__ = 'warehouse_movements'
+    __table_args__ = (
+        # Keyset-пагинация истории движений по (created_at, id) и её фильтры
+        db.Index('ix_warehouse_movements_created_at_id', 'created_at', 'id'),
+        db.Index('ix_warehouse_movements_material_created_at', 'material_id', 'created_at'),
+        db.Index('ix_warehouse_movements_type_created_at', 'movement_type', 'created_at'),
+        db.Index('ix_warehouse_movements_from_user_created_at', 'from_user_id', 'created_at'),
+        db.Index('ix_warehouse_movements_to_user_created_at', 'to_user_id', 'created_at'),
+        db.Index('ix_warehouse_movements_created_by_created_at', 'created_by', 'created_at'),
+    )
 
     id = db.Column(db.UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     material_id = db.Column(db.UUID(as_uuid=True), db.ForeignKey('materials.id'), nullable=False)
@@ -70,15 +88,20 @@ class WarehouseMovement(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None,
         }
 
-class WarehouseAttachment(db.Model):
-    """Файл-вложение, прикрепленный к движению по складу. Хранится в БД."""
+class WarehouseAttachment(BlobContentMixin, db.Model):
+    """Файл-вложение, прикрепленный к движению по складу. Содержимое — в blob_store."""
     __tablename__ = 'warehouse_attachments'
+    __table_args__ = (
+        db.Index('ix_warehouse_attachments_movement_id', 'movement_id'),
+    )
 
     id = db.Column(db.UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     movement_id = db.Column(db.UUID(as_uuid=True), db.ForeignKey('warehouse_movements.id'), nullable=False)
     filename = db.Column(db.String(255), nullable=False)
     content_type = db.Column(db.String(127), nullable=True)
-    data = db.Column(db.LargeBinary, nullable=False)
+    # Содержимое хранится в blob_store по sha256; data — только у ещё не перенесённых записей
+    data = db.deferred(db.Column(db.LargeBinary, nullable=True))
+    sha256 = db.Column(db.String(64), nullable=True)
     size_bytes = db.Column(db.Integer, nullable=False)
     uploaded_by = db.Column(db.UUID(as_uuid=True), db.ForeignKey('users.userid'), nullable=False)
     uploaded_at = db.Column(db.DateTime, default=get_moscow_now, nullable=False)
@@ -96,13 +119,13 @@ class WarehouseAttachment(db.Model):
             'uploaded_at': self.uploaded_at.isoformat() if self.uploaded_at else None,
         }
         if include_data:
-            payload['data'] = self.data
+            payload['data'] = self.read_content()
         return payload
 
 
-class MaterialAttachment(db.Model):
+class MaterialAttachment(BlobContentMixin, db.Model):
     """Файл-превью, прикрепленный к материалу для отображения внешнего вида.
-    Хранится в БД аналогично WarehouseAttachment.
+    Хранится аналогично WarehouseAttachment.
     """
     __tablename__ = 'material_attachments'
 
@@ -114,7 +137,9 @@ class MaterialAttachment(db.Model):
     )
     filename = db.Column(db.String(255), nullable=False)
     content_type = db.Column(db.String(127), nullable=True)
-    data = db.Column(db.LargeBinary, nullable=False)
+    # Как у WarehouseAttachment: sha256 в blob_store, data — до переноса
+    data = db.deferred(db.Column(db.LargeBinary, nullable=True))
+    sha256 = db.Column(db.String(64), nullable=True)
     size_bytes = db.Column(db.Integer, nullable=False)
     uploaded_by = db.Column(db.UUID(as_uuid=True), db.ForeignKey('users.userid'), nullable=False)
     uploaded_at = db.Column(db.DateTime, default=get_moscow_now, nullable=False)
@@ -132,7 +157,7 @@ class MaterialAttachment(db.Model):
             'uploaded_at': self.uploaded_at.isoformat() if self.uploaded_at else None,
         }
         if include_data:
-            payload['data'] = self.data
+            payload['data'] = self.read_content()
         return payload
 
 class UserMaterialAllocation(db.Model):
@@ -144,6 +169,8 @@ class UserMaterialAllocation(db.Model):
     material_id = db.Column(db.UUID(as_uuid=True), db.ForeignKey('materials.id'), nullable=False)
     quantity = db.Column(db.Float, default=0.0, nullable=False)
     updated_at = db.Column(db.DateTime, default=get_moscow_now, onupdate=get_moscow_now)
+    # Версия строки для оптимистической блокировки (см. app/utils/stock_ledger.py)
+    version_id = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     user = db.relationship('Users')
     material = db.relationship('Material')
@@ -151,6 +178,7 @@ class UserMaterialAllocation(db.Model):
     __table_args__ = (
         db.UniqueConstraint('user_id', 'material_id', name='uq_user_material'),
     )
+    __mapper_args__ = {'version_id_col': version_id}
 
     def to_dict(self):
         return {
@@ -358,4 +386,56 @@ class MaterialGroupItem(db.Model):
             'group_id': self.group_id,
             'material_id': self.material_id,
             'added_at': self.added_at.isoformat() if self.added_at else None,
-        }
\ No newline at end of file
+        }
+
+class StockSnapshot(db.Model):
+    """Контрольная точка складского учёта: остатки и распределения на момент времени.
+
+    last_movement_created_at/last_movement_id — последнее движение, учтённое в
+    снимке; пересчёт (app/utils/stock_replay.py) продолжается со следующего.
+    """
+    __tablename__ = 'stock_snapshots'
+    __table_args__ = (
+        db.Index('ix_stock_snapshots_taken_at', 'taken_at'),
+    )
+
+    id = db.Column(db.UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    taken_at = db.Column(db.DateTime, default=get_moscow_now, nullable=False)
+    source = db.Column(db.String(16), nullable=False)  # ledger, counters
+    last_movement_created_at = db.Column(db.DateTime, nullable=True)
+    last_movement_id = db.Column(db.UUID(as_uuid=True), nullable=True)
+    created_by = db.Column(db.UUID(as_uuid=True), db.ForeignKey('users.userid'), nullable=True)
+
+    lines = db.relationship('StockSnapshotLine', backref='snapshot', lazy=True, cascade='all, delete-orphan')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'taken_at': self.taken_at.isoformat() if self.taken_at else None,
+            'source': self.source,
+            'last_movement_created_at': self.last_movement_created_at.isoformat() if self.last_movement_created_at else None,
+            'last_movement_id': self.last_movement_id,
+            'created_by': self.created_by,
+        }
+
+
+class StockSnapshotLine(db.Model):
+    """Строка снимка: количество материала на складе (user_id IS NULL) или у пользователя."""
+    __tablename__ = 'stock_snapshot_lines'
+    __table_args__ = (
+        db.Index('ix_stock_snapshot_lines_snapshot_material', 'snapshot_id', 'material_id'),
+    )
+
+    id = db.Column(db.UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    snapshot_id = db.Column(
+        db.UUID(as_uuid=True),
+        db.ForeignKey('stock_snapshots.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+    material_id = db.Column(
+        db.UUID(as_uuid=True),
+        db.ForeignKey('materials.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+    user_id = db.Column(db.UUID(as_uuid=True), db.ForeignKey('users.userid'), nullable=True)
+    quantity = db.Column(db.Float, nullable=False)
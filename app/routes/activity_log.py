@@ -1,10 +1,18 @@
-from flask import Blueprint, render_template, request, jsonify, session
+from flask import Blueprint, Response, render_template, request, jsonify, session, stream_with_context
 from flask_login import login_required, current_user
-from app.models.activity_log import ActivityLog
+from app.models.activity_log import ActivityAction, ActivityLog, ActivityLogRollup
 from app.models.users import Users
-from app.extensions import db
+from app.models.settings import SystemSetting
+from app.utils.activity_archive import ACTIONS_FILLED_SETTING, fill_actions, partition_filter
+from app.extensions import cache, db
 from app.utils.mobile_detection import is_mobile_device
+from app.utils.timezone_utils import get_moscow_now
 from datetime import datetime, timedelta, timezone
+import base64
+import csv
+import io
+import uuid
+import zlib
 
 activity_log = Blueprint('activity_log', __name__)
 
@@ -89,6 +97,169 @@ def is_admin():
     """Проверяет, является ли пользователь администратором"""
     return current_user.is_authenticated and current_user.role == 'Инженер ПТО'
 
+# Записей на странице журнала и верхняя граница ?limit= в API
+LOG_PAGE_SIZE = 50
+LOG_API_MAX_LIMIT = 500
+# Сколько секунд кэшируются счётчики записей и справочник действий
+LOG_STATS_CACHE_TTL = 60
+# Не больше стольких названий действий подставляется в фильтр по подстроке
+ACTION_FILTER_MAX_NAMES = 200
+
+
+class ActivityLogPage:
+    """Страница журнала при навигации курсорами"""
+    
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.has_next = next_cursor is not None
+        self.has_prev = prev_cursor is not None
+
+
+def _encode_log_cursor(created_at, row_id):
+    """Курсор страницы журнала: непрозрачная строка из пары (created_at, id)"""
+    raw = f"{created_at.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def _decode_log_cursor(cursor):
+    """Разбирает курсор журнала; при ошибке формата бросает ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        created_at, row_id = raw.split('|', 1)
+        return datetime.fromisoformat(created_at), uuid.UUID(row_id)
+    except Exception:
+        raise ValueError('Неверный курсор')
+
+
+def known_actions():
+    """Названия действий из справочника activity_actions (кэшируются)
+    
+    При первом обращении после развёртывания справочник заполняется по журналу.
+    """
+    names = cache.get('activity_log:actions')
+    if names is None:
+        if SystemSetting.get(ACTIONS_FILLED_SETTING) is None:
+            fill_actions()
+        names = list(db.session.execute(
+            db.select(ActivityAction.name).order_by(ActivityAction.name)
+        ).scalars())
+        cache.set('activity_log:actions', names, timeout=LOG_STATS_CACHE_TTL)
+    return names
+
+
+def _log_filter_criteria(user_filter='', user_id_filter='', action_filter='', date_filter=''):
+    """Условия фильтров журнала или None, если под фильтры заведомо ничего не подходит.
+    
+    Подстрока логина ищется в user_login самой записи. Подстрока действия
+    сначала ищется в небольшом справочнике действий, а журнал фильтруется по
+    точным значениям — по индексу (action, created_at).
+    Ошибки формата (user_id, дата) — ValueError.
+    """
+    criteria = []
+    if user_id_filter:
+        criteria.append(ActivityLog.user_id == uuid.UUID(user_id_filter))
+    elif user_filter:
+        # По логину в самой записи: так находятся и записи удалённых или
+        # переименованных пользователей, и системные записи без user_id
+        criteria.append(ActivityLog.user_login.contains(user_filter))
+    
+    if action_filter:
+        names = known_actions()
+        if not names:
+            # Справочник пуст — ищем подстроку в самом журнале
+            criteria.append(ActivityLog.action.contains(action_filter))
+        elif action_filter in names:
+            criteria.append(ActivityLog.action == action_filter)
+        else:
+            needle = action_filter.lower()
+            matched = [name for name in names if needle in name.lower()][:ACTION_FILTER_MAX_NAMES]
+            if not matched:
+                return None
+            criteria.append(ActivityLog.action.in_(matched))
+    
+    if date_filter:
+        filter_date = datetime.strptime(date_filter, '%Y-%m-%d')
+        # Запрос ограничивается секцией месяца этой даты
+        criteria.extend(partition_filter(filter_date, filter_date + timedelta(days=1)))
+    return criteria
+
+
+def _log_page(criteria, per_page, before=None, after=None):
+    """Страница журнала в порядке (created_at DESC, id DESC) без OFFSET и COUNT.
+    
+    before — курсор следующей (более старой) страницы, after — предыдущей.
+    """
+    if criteria is None:
+        return ActivityLogPage([], per_page)
+    query = ActivityLog.query.filter(*criteria)
+    if after is not None:
+        created_at, row_id = after
+        rows = query.filter(db.or_(
+            ActivityLog.created_at > created_at,
+            db.and_(ActivityLog.created_at == created_at, ActivityLog.id > row_id),
+        )).order_by(ActivityLog.created_at.asc(), ActivityLog.id.asc()).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        has_next = bool(items)
+    else:
+        if before is not None:
+            created_at, row_id = before
+            query = query.filter(db.or_(
+                ActivityLog.created_at < created_at,
+                db.and_(ActivityLog.created_at == created_at, ActivityLog.id < row_id),
+            ))
+        rows = query.order_by(ActivityLog.created_at.desc(), ActivityLog.id.desc()).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        has_prev = before is not None and bool(items)
+    return ActivityLogPage(
+        items,
+        per_page,
+        next_cursor=_encode_log_cursor(items[-1].created_at, items[-1].id) if has_next else None,
+        prev_cursor=_encode_log_cursor(items[0].created_at, items[0].id) if has_prev else None,
+    )
+
+
+def _approximate_total():
+    """Приблизительное число записей журнала (кэшируется).
+    
+    В PostgreSQL берётся оценка планировщика из pg_class вместо COUNT(*)
+    по всей таблице.
+    """
+    total = cache.get('activity_log:total')
+    if total is None:
+        total = -1
+        if db.engine.dialect.name == 'postgresql':
+            total = db.session.execute(db.text(
+                "SELECT reltuples::bigint FROM pg_class WHERE relname = 'activity_logs'"
+            )).scalar()
+        if total is None or total < 0:
+            # Таблица ещё не анализировалась или СУБД без статистики
+            total = ActivityLog.query.count()
+        cache.set('activity_log:total', total, timeout=LOG_STATS_CACHE_TTL)
+    return total
+
+
+def _today_total():
+    # Записи журнала хранят московское время без часового пояса
+    today = get_moscow_now().replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    key = f'activity_log:today:{today.date().isoformat()}'
+    total = cache.get(key)
+    if total is None:
+        total = ActivityLog.query.filter(*partition_filter(today)).count()
+        cache.set(key, total, timeout=LOG_STATS_CACHE_TTL)
+    return total
+
+
+def _read_cursors(args):
+    before = _decode_log_cursor(args['before']) if args.get('before') else None
+    after = _decode_log_cursor(args['after']) if args.get('after') and not before else None
+    return before, after
+
+
 @activity_log.route('/activity-log')
 @login_required
 def view_activity_log():
@@ -109,81 +280,57 @@ def view_activity_log():
     )
     
     # Получаем параметры фильтрации
-    page = request.args.get('page', 1, type=int)
-    per_page = 50
     user_filter = request.args.get('user', '')
     user_id_filter = request.args.get('user_id', '')
     action_filter = request.args.get('action', '')
     date_filter = request.args.get('date', '')
     
-    # Базовый запрос
-    query = ActivityLog.query
-    
-    # Применяем фильтры
+    # Некорректный user_id или дата отбрасываются, остальные фильтры сохраняются
     if user_id_filter:
-        # Фильтрация по ID пользователя (точное совпадение)
-        query = query.filter(ActivityLog.user_id == user_id_filter)
-    elif user_filter:
-        # Фильтрация по логину пользователя (частичное совпадение)
-        query = query.filter(ActivityLog.user_login.contains(user_filter))
-    
-    if action_filter:
-        query = query.filter(ActivityLog.action.contains(action_filter))
-    
+        try:
+            uuid.UUID(user_id_filter)
+        except ValueError:
+            user_id_filter = ''
     if date_filter:
         try:
-            filter_date = datetime.strptime(date_filter, '%Y-%m-%d')
-            next_date = filter_date + timedelta(days=1)
-            query = query.filter(
-                ActivityLog.created_at >= filter_date,
-                ActivityLog.created_at < next_date
-            )
+            datetime.strptime(date_filter, '%Y-%m-%d')
         except ValueError:
-            pass
+            date_filter = ''
+    criteria = _log_filter_criteria(user_filter, user_id_filter, action_filter, date_filter)
+    try:
+        before, after = _read_cursors(request.args)
+    except ValueError:
+        before = after = None
     
-    # Получаем данные с пагинацией
-    activities = query.order_by(ActivityLog.created_at.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
-    )
+    # Получаем данные страницы по курсору
+    activities = _log_page(criteria, LOG_PAGE_SIZE, before=before, after=after)
     
-    # Добавляем информацию о роли пользователя для каждой записи
+    # Роли пользователей страницы — одним запросом
+    user_ids = {activity.user_id for activity in activities.items if activity.user_id}
+    roles = dict(
+        Users.query.with_entities(Users.userid, Users.role).filter(Users.userid.in_(user_ids)).all()
+    ) if user_ids else {}
     for activity in activities.items:
         if activity.user_id:
-            user = Users.query.get(activity.user_id)
-            if user:
-                activity.user_role = user.role
-            else:
-                activity.user_role = "Неизвестно"
+            activity.user_role = roles.get(activity.user_id, "Неизвестно")
         else:
             activity.user_role = "Неавторизованный"
     
-    # Статистика
-    total_activities = ActivityLog.query.count()
-    today_activities = ActivityLog.query.filter(
-        ActivityLog.created_at >= datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    ).count()
+    # Статистика (приблизительная, из кэша)
+    total_activities = _approximate_total()
+    today_activities = _today_total()
     
     # Получаем информацию о пользователе для фильтра
     filtered_user = None
     if user_id_filter:
-        filtered_user = Users.query.get(user_id_filter)
+        filtered_user = Users.query.get(uuid.UUID(user_id_filter))
     
-    # Проверяем мобильное устройство
-    if is_mobile_device():
-        return render_template('main/mobile_activity_log.html',
-                             activities=activities,
-                             total_activities=total_activities,
-                             today_activities=today_activities,
-                             user_filter=user_filter,
-                             user_id_filter=user_id_filter,
-                             filtered_user=filtered_user,
-                             action_filter=action_filter,
-                             date_filter=date_filter)
-    
-    return render_template('main/activity_log.html',
+    template = 'main/mobile_activity_log.html' if is_mobile_device() else 'main/activity_log.html'
+    return render_template(template,
                          activities=activities,
                          total_activities=total_activities,
                          today_activities=today_activities,
+                         action_names=known_actions(),
                          user_filter=user_filter,
                          user_id_filter=user_id_filter,
                          filtered_user=filtered_user,
@@ -193,27 +340,68 @@ def view_activity_log():
 @activity_log.route('/api/activity-log')
 @login_required
 def api_activity_log():
-    """API для получения журнала действий"""
+    """API для получения журнала действий
+    
+    Фильтры: user, user_id, action, date; навигация — курсоры before/after
+    из next_cursor/prev_cursor ответа.
+    """
+    if not is_admin():
+        return jsonify({'error': gettext("У вас нет прав для просмотра журнала действий")}), 403
+    
+    limit = max(1, min(request.args.get('limit', LOG_PAGE_SIZE, type=int), LOG_API_MAX_LIMIT))
+    try:
+        criteria = _log_filter_criteria(
+            request.args.get('user', ''),
+            request.args.get('user_id', ''),
+            request.args.get('action', ''),
+            request.args.get('date', ''),
+        )
+        before, after = _read_cursors(request.args)
+    except ValueError as e:
+        return jsonify({'error': f'Неверные параметры запроса: {e}'}), 400
+    
+    activities = _log_page(criteria, limit, before=before, after=after)
+    
+    return jsonify({
+        'activities': [activity.to_dict() for activity in activities.items],
+        'total': len(activities.items),
+        'next_cursor': activities.next_cursor,
+        'prev_cursor': activities.prev_cursor,
+    })
+
+@activity_log.route('/api/activity-log/page-views')
+@login_required
+def api_activity_log_page_views():
+    """Почасовые счётчики просмотров страниц (свёрнутые записи журнала)"""
     if not is_admin():
         return jsonify({'error': gettext("У вас нет прав для просмотра журнала действий")}), 403
     
-    limit = request.args.get('limit', 50, type=int)
+    limit = min(request.args.get('limit', 200, type=int), 1000)
     user_filter = request.args.get('user', '')
     action_filter = request.args.get('action', '')
+    date_filter = request.args.get('date', '')
     
-    query = ActivityLog.query
-    
+    query = ActivityLogRollup.query
     if user_filter:
-        query = query.filter(ActivityLog.user_login.contains(user_filter))
-    
+        query = query.filter(ActivityLogRollup.user_login.contains(user_filter))
     if action_filter:
-        query = query.filter(ActivityLog.action.contains(action_filter))
+        query = query.filter(ActivityLogRollup.action.contains(action_filter))
+    if date_filter:
+        try:
+            filter_date = datetime.strptime(date_filter, '%Y-%m-%d')
+        except ValueError:
+            return jsonify({'error': 'Неверный формат даты (ожидается YYYY-MM-DD)'}), 400
+        query = query.filter(
+            ActivityLogRollup.hour >= filter_date,
+            ActivityLogRollup.hour < filter_date + timedelta(days=1)
+        )
     
-    activities = query.order_by(ActivityLog.created_at.desc()).limit(limit).all()
+    total_views = query.with_entities(db.func.coalesce(db.func.sum(ActivityLogRollup.count), 0)).scalar()
+    rollups = query.order_by(ActivityLogRollup.hour.desc(), ActivityLogRollup.count.desc()).limit(limit).all()
     
     return jsonify({
-        'activities': [activity.to_dict() for activity in activities],
-        'total': len(activities)
+        'page_views': [rollup.to_dict() for rollup in rollups],
+        'total_views': int(total_views),
     })
 
 @activity_log.route('/api/activity-log/clear', methods=['POST'])
@@ -233,6 +421,7 @@ def clear_activity_log():
         
         # Удаляем все записи
         deleted_count = ActivityLog.query.delete()
+        ActivityLogRollup.query.delete()
         db.session.commit()
         
         # Логируем действие очистки в новой транзакции
@@ -256,62 +445,105 @@ def clear_activity_log():
         print(f"Ошибка при очистке журнала: {e}")
         return jsonify({'error': f'Ошибка при очистке журнала: {str(e)}'}), 500
 
+# Размер пачки строк при потоковой выгрузке журнала
+EXPORT_BATCH_SIZE = 1000
+EXPORT_COLUMNS = ['ID', 'Пользователь', 'Действие', 'Описание', 'IP адрес', 'Страница', 'Дата']
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+
+def _export_criteria(args):
+    """Условия выгрузки из параметров запроса: date или date_from/date_to, user, user_id, action"""
+    if args.get('date'):
+        start = _parse_date(args['date'])
+        end = start + timedelta(days=1)
+    else:
+        start = _parse_date(args.get('date_from'))
+        end = _parse_date(args.get('date_to'))
+        if end is not None:
+            end += timedelta(days=1)  # date_to включительно
+    criteria = _log_filter_criteria(args.get('user', ''), args.get('user_id', ''), args.get('action', ''))
+    if criteria is None:
+        # Под фильтры ничего не подходит — выгружается только заголовок
+        return [db.false()]
+    return criteria + partition_filter(start, end)
+
+
+def _iter_export_csv(criteria):
+    """CSV по частям: строки читаются курсором пачками, память не зависит от размера журнала"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    
+    statement = db.select(
+        ActivityLog.id, ActivityLog.user_login, ActivityLog.action, ActivityLog.description,
+        ActivityLog.ip_address, ActivityLog.page_url, ActivityLog.created_at
+    ).where(*criteria).order_by(ActivityLog.created_at.desc(), ActivityLog.id.desc())
+    result = db.session.execute(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for rows in result.partitions():
+        for row in rows:
+            # Форматируем время в московском формате для CSV
+            moscow_time = format_moscow_time(row.created_at)
+            if moscow_time == "Нет данных" or moscow_time == "Ошибка времени":
+                moscow_time = ''
+            writer.writerow([
+                row.id, row.user_login, row.action, row.description,
+                row.ip_address, row.page_url, moscow_time
+            ])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+    db.session.rollback()
+
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)  # формат gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 @activity_log.route('/api/activity-log/export')
 @login_required
 def export_activity_log():
-    """Экспорт журнала действий в CSV"""
+    """Экспорт журнала действий в CSV
+
+    Файл отдаётся потоком по мере чтения из БД. Фильтры: date или
+    date_from/date_to (YYYY-MM-DD), user, user_id, action; gzip=1 — сжатый файл.
+    """
     if not is_admin():
         return jsonify({'error': gettext("У вас нет прав для экспорта журнала действий")}), 403
     
     try:
-        activities = ActivityLog.query.order_by(ActivityLog.created_at.desc()).all()
-        
-        # Создаем CSV
-        import csv
-        import io
-        
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # Заголовки
-        writer.writerow(['ID', 'Пользователь', 'Действие', 'Описание', 'IP адрес', 'Страница', 'Дата'])
-        
-        # Данные
-        for activity in activities:
-            # Форматируем время в московском формате для CSV
-            moscow_time = format_moscow_time(activity.created_at)
-            if moscow_time == "Нет данных" or moscow_time == "Ошибка времени":
-                moscow_time = ''
-            
-            writer.writerow([
-                activity.id,
-                activity.user_login,
-                activity.action,
-                activity.description,
-                activity.ip_address,
-                activity.page_url,
-                moscow_time
-            ])
-        
-        output.seek(0)
-        
-        # Логируем экспорт
-        ActivityLog.log_action(
-            user_id=current_user.userid,
-            user_login=current_user.login,
-            action="Экспорт журнала",
-            description=f"Администратор {current_user.login} экспортировал журнал действий",
-            ip_address=request.remote_addr,
-            page_url=request.url,
-            method=request.method
-        )
-        
-        from flask import Response
-        return Response(
-            output.getvalue(),
-            mimetype='text/csv',
-            headers={'Content-Disposition': f'attachment; filename=activity_log_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'}
-        )
-        
-    except Exception as e:
-        return jsonify({'error': f'Ошибка при экспорте: {str(e)}'}), 500
+        criteria = _export_criteria(request.args)
+    except ValueError:
+        return jsonify({'error': 'Неверный формат даты (ожидается YYYY-MM-DD) или user_id'}), 400
+    use_gzip = request.args.get('gzip') in ('1', 'true')
+    
+    # Логируем экспорт
+    ActivityLog.log_action(
+        user_id=current_user.userid,
+        user_login=current_user.login,
+        action="Экспорт журнала",
+        description=f"Администратор {current_user.login} экспортировал журнал действий",
+        ip_address=request.remote_addr,
+        page_url=request.url,
+        method=request.method
+    )
+    
+    filename = f'activity_log_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
+    chunks = _iter_export_csv(criteria)
+    if use_gzip:
+        body, mimetype, filename = _gzip_chunks(chunks), 'application/gzip', filename + '.gz'
+    else:
+        body, mimetype = chunks, 'text/csv; charset=utf-8'
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
@@ -1,7 +1,7 @@
 import os
 from uuid import uuid4
 
-from flask import Blueprint, render_template, session, redirect, url_for, request, current_app, flash
+from flask import Blueprint, render_template, session, redirect, url_for, request, current_app, flash, jsonify
 from ..extensions import db
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
@@ -170,6 +170,7 @@ def dashboard():
 from ..models.users import Users
 from ..models.activity_log import ActivityLog
 from ..models.objects import Object, Report
+from ..utils.timezone_utils import get_moscow_now
 
 import re
 
@@ -258,68 +259,12 @@ def format_phone_for_display(phone_number):
 @main.route('/calendar')
 @login_required
 def calendar():
-    from datetime import datetime, date
-    from ..models.objects import Object, Report, PlannedWork, Support, Trench, ChecklistItem, DailyReport
-    
-    # Обновляем статус работ на 'в работе', когда наступает дата
-    PlannedWork.update_works_status_to_in_progress()
-    # Обновляем статус просроченных работ
-    PlannedWork.update_overdue_works()
-    
-    # Обновляем статус просроченных траншей
-    Trench.update_overdue_trenches()
-    
-    # Получаем все даты с активностью
-    active_dates = set()
-    
-    # Даты с отчётами
-    reports_dates = db.session.query(db.func.date(Report.report_date)).distinct().all()
-    for (report_date,) in reports_dates:
-        if report_date:
-            active_dates.add(report_date.strftime('%Y-%m-%d'))
-    # Даты с ежедневными отчётами
-    try:
-        daily_dates = db.session.query(db.func.date(DailyReport.report_date)).distinct().all()
-        for (d,) in daily_dates:
-            if d:
-                active_dates.add(d.strftime('%Y-%m-%d'))
-    except Exception:
-        pass
-    
-    # Даты с запланированными работами
-    planned_works_dates = db.session.query(db.func.date(PlannedWork.planned_date)).distinct().all()
-    for (work_date,) in planned_works_dates:
-        if work_date:
-            active_dates.add(work_date.strftime('%Y-%m-%d'))
-    
-    # Даты создания опор
-    supports_dates = db.session.query(db.func.date(Support.created_at)).distinct().all()
-    for (support_date,) in supports_dates:
-        if support_date:
-            active_dates.add(support_date.strftime('%Y-%m-%d'))
-    
-    # Даты создания траншей
-    trenches_dates = db.session.query(db.func.date(Trench.created_at)).distinct().all()
-    for (trench_date,) in trenches_dates:
-        if trench_date:
-            active_dates.add(trench_date.strftime('%Y-%m-%d'))
-    
-    # Даты выполнения элементов чек-листа
-    checklist_dates = db.session.query(db.func.date(ChecklistItem.completed_at)).filter(
-        ChecklistItem.is_completed == True
-    ).distinct().all()
-    for (checklist_date,) in checklist_dates:
-        if checklist_date:
-            active_dates.add(checklist_date.strftime('%Y-%m-%d'))
-    # Даты ежедневных отчётов (старой таблицы Reports)
-    try:
-        from ..models.reports import Reports as LegacyReports
-        legacy_dates = db.session.query(db.func.date(LegacyReports.created_at)).distinct().all()
-        for (ld,) in legacy_dates:
-            if ld:
-                active_dates.add(ld.strftime('%Y-%m-%d'))
-    except Exception:
-        pass
+    from ..utils.calendar_index import active_days, month_bounds
+    
+    # Активные дни только текущего месяца; остальные месяцы страница
+    # запрашивает через calendar_active_dates при перелистывании
+    today = get_moscow_now().date()
+    active_dates = active_days(*month_bounds(today.year, today.month))
     
     # Логируем просмотр страницы календаря
     ActivityLog.log_action(
@@ -331,7 +276,20 @@ def calendar():
         page_url=request.url,
         method=request.method
     )
-    return render_template('main/calendar.html', active_dates=list(active_dates))
+    return render_template('main/calendar.html', active_dates=active_dates,
+                           active_month=f'{today.year}-{today.month:02d}')
+
+@main.route('/calendar/active-dates')
+@login_required
+def calendar_active_dates():
+    """Дни с активностью за месяц (?year=&month=) для календаря"""
+    from ..utils.calendar_index import active_days, month_bounds
+    
+    year = request.args.get('year', type=int)
+    month = request.args.get('month', type=int)
+    if year is None or month is None or not 1 <= month <= 12 or not 1 <= year <= 9999:
+        return jsonify({'error': 'Некорректный месяц'}), 400
+    return jsonify(active_days(*month_bounds(year, month)))
 
 @main.route('/calendar/date/<date>')
 @login_required
@@ -339,138 +297,14 @@ def calendar_date_detail(date):
     """Детальная информация по выбранной дате"""
     try:
         from datetime import datetime
-        from ..models.objects import Object, Report, PlannedWork, Support, Trench, Checklist, ChecklistItem, DailyReport
-        # Попробуем подключить старую модель отчётов, если она используется
-        try:
-            from ..models.reports import Reports as LegacyReports
-        except Exception:
-            LegacyReports = None
-        from ..models.users import Users
-        
-        # Обновляем статус работ на 'в работе', когда наступает дата
-        PlannedWork.update_works_status_to_in_progress()
-        # Обновляем статус просроченных работ
-        PlannedWork.update_overdue_works()
-        
-        # Обновляем статус просроченных траншей
-        Trench.update_overdue_trenches()
-        
+        from ..utils.calendar_drilldown import date_activity
+
         # Парсим дату
         report_date = datetime.strptime(date, '%Y-%m-%d').date()
-        
-        # Получаем все объекты
-        all_objects = Object.query.all()
-        
-        # Собираем данные по каждому объекту за выбранную дату
-        objects_data = []
-        
-        for obj in all_objects:
-            # Отчёты за эту дату (поддержка обеих моделей)
-            reports = []
-            try:
-                reports = Report.query.filter(
-                    Report.object_id == obj.id,
-                    Report.report_date == report_date
-                ).all()
-            except Exception:
-                reports = []
-            if (not reports) and LegacyReports is not None:
-                legacy = LegacyReports.query.filter(
-                    LegacyReports.objectid == obj.id,
-                    db.func.date(LegacyReports.created_at) == report_date
-                ).all()
-                # Нормализуем поля под шаблон
-                for r in legacy:
-                    r.title = getattr(r, 'comment', 'Ежедневный отчёт')
-                    r.report_number = ''
-                    r.status = getattr(r, 'status', '')
-                reports = legacy or reports
 
-            # Подтягиваем ежедневный отчёт как отдельный элемент в блок "Отчёты"
-            try:
-                daily = DailyReport.query.filter_by(object_id=obj.id, report_date=report_date).all()
-            except Exception:
-                daily = []
-            for d in daily:
-                reports.append(type('DailyStub', (), {
-                    'title': 'Ежедневный отчёт',
-                    'report_number': '',
-                    'status': getattr(d, 'approval_status', getattr(d, 'status', '')),
-                    'created_by': None
-                }))
-            
-            # Запланированные работы на эту дату
-            planned_works = PlannedWork.query.filter(
-                PlannedWork.object_id == obj.id,
-                PlannedWork.planned_date == report_date
-            ).all()
-            
-            # Опоры, созданные в эту дату
-            supports_created = Support.query.filter(
-                Support.object_id == obj.id,
-                db.func.date(Support.created_at) == report_date
-            ).all()
-            
-            # Траншеи, созданные в эту дату
-            trenches_created = Trench.query.filter(
-                Trench.object_id == obj.id,
-                db.func.date(Trench.created_at) == report_date
-            ).all()
-            
-            # Элементы чек-листа, выполненные в эту дату
-            checklist_items_completed = []
-            if obj.checklist:
-                checklist_items_completed = ChecklistItem.query.filter(
-                    ChecklistItem.checklist_id == obj.checklist.id,
-                    ChecklistItem.is_completed == True,
-                    db.func.date(ChecklistItem.completed_at) == report_date
-                ).all()
-            
-            # Подсчитываем статистику
-            total_reports = len(reports)
-            total_planned_works = len(planned_works)
-            total_supports_created = len(supports_created)
-            total_trenches_created = len(trenches_created)
-            total_checklist_completed = len(checklist_items_completed)
-            
-            # Если есть какая-то активность, добавляем объект
-            if (total_reports > 0 or total_planned_works > 0 or 
-                total_supports_created > 0 or total_trenches_created > 0 or 
-                total_checklist_completed > 0):
-                
-                # Загружаем информацию о создателях
-                for report in reports:
-                    if report.created_by:
-                        report.creator = Users.query.get(report.created_by)
-                    else:
-                        report.creator = None
-                
-                for work in planned_works:
-                    if work.created_by:
-                        work.creator = Users.query.get(work.created_by)
-                    else:
-                        work.creator = None
-                
-                for item in checklist_items_completed:
-                    if item.completed_by:
-                        item.completed_by_user = Users.query.get(item.completed_by)
-                    else:
-                        item.completed_by_user = None
-                
-                objects_data.append({
-                    'object': obj,
-                    'reports': reports,
-                    'planned_works': planned_works,
-                    'supports_created': supports_created,
-                    'trenches_created': trenches_created,
-                    'checklist_items_completed': checklist_items_completed,
-                    'total_reports': total_reports,
-                    'total_planned_works': total_planned_works,
-                    'total_supports_created': total_supports_created,
-                    'total_trenches_created': total_trenches_created,
-                    'total_checklist_completed': total_checklist_completed
-                })
-        
+        # Активность за дату по объектам (только объекты, где что-то было)
+        objects_data = date_activity(report_date)
+
         # Логируем просмотр данных по дате
         ActivityLog.log_action(
             user_id=current_user.userid,
@@ -1138,8 +972,9 @@ def object_reports(object_id):
 @main.route('/reports/calendar')
 @login_required
 def reports_calendar():
-    from datetime import datetime, date, timedelta
-    from ..models.objects import DailyReport
+    from datetime import datetime
+    from ..utils.cache_tags import model_tag
+    from ..utils.view_cache import cached_page
     
     # Проверяем, что пользователь не является снабженцем
     if current_user.role == 'Снабженец':
@@ -1157,62 +992,6 @@ def reports_calendar():
     if not (2020 <= year <= 2030):
         year = current_date.year
     
-    # Получаем все отчёты (ручные и ежедневные) за указанный месяц
-    start_date = date(year, month, 1)
-    if month == 12:
-        end_date = date(year + 1, 1, 1)
-    else:
-        end_date = date(year, month + 1, 1)
-    
-    # Ручные отчёты
-    reports = Report.query.filter(
-        Report.report_date >= start_date,
-        Report.report_date < end_date
-    ).order_by(Report.report_date).all()
-    
-    # Ежедневные отчёты
-    daily_reports = DailyReport.query.filter(
-        DailyReport.report_date >= start_date,
-        DailyReport.report_date < end_date
-    ).order_by(DailyReport.report_date).all()
-    
-    # Загружаем информацию о создателях отчётов
-    from ..models.users import Users
-    for report in reports:
-        if report.created_by:
-            report.creator = Users.query.get(report.created_by)
-        else:
-            report.creator = None
-    
-    # Группируем объекты по датам отчётов
-    objects_by_date = {}
-    
-    # Обрабатываем ручные отчёты
-    for report in reports:
-        date_key = report.report_date.strftime('%Y-%m-%d')
-        if date_key not in objects_by_date:
-            objects_by_date[date_key] = {'objects': [], 'reports_count': 0, 'daily_reports_count': 0}
-        
-        # Добавляем объект, если его еще нет в списке для этой даты
-        object_obj = report.object
-        if not any(obj.id == object_obj.id for obj in objects_by_date[date_key]['objects']):
-            objects_by_date[date_key]['objects'].append(object_obj)
-        
-        objects_by_date[date_key]['reports_count'] += 1
-    
-    # Обрабатываем ежедневные отчёты
-    for daily_report in daily_reports:
-        date_key = daily_report.report_date.strftime('%Y-%m-%d')
-        if date_key not in objects_by_date:
-            objects_by_date[date_key] = {'objects': [], 'reports_count': 0, 'daily_reports_count': 0}
-        
-        # Добавляем объект, если его еще нет в списке для этой даты
-        object_obj = daily_report.object
-        if not any(obj.id == object_obj.id for obj in objects_by_date[date_key]['objects']):
-            objects_by_date[date_key]['objects'].append(object_obj)
-        
-        objects_by_date[date_key]['daily_reports_count'] += 1
-    
     # Логируем просмотр календаря отчётов
     ActivityLog.log_action(
         user_id=current_user.userid,
@@ -1224,8 +1003,23 @@ def reports_calendar():
         method=request.method
     )
     
-    # Определяем, нужно ли использовать мобильный шаблон
+    # Сетка месяца кэшируется и сбрасывается при изменении любых отчётов и
+    # объектов (данные сетки собираются по объектам с отчётами)
+    return cached_page(
+        lambda: _render_reports_calendar(year, month),
+        tags=[model_tag('reports'), model_tag('daily_reports'), model_tag('objects')],
+    )
+
+
+def _render_reports_calendar(year, month):
+    from datetime import date, timedelta
     from ..utils.mobile_detection import is_mobile_device
+    from ..utils.report_calendar import month_reports_by_date
+    
+    # Объекты и число ручных/ежедневных отчётов по датам месяца
+    objects_by_date = month_reports_by_date(year, month)
+    
+    # Определяем, нужно ли использовать мобильный шаблон
     if is_mobile_device():
         return render_template('main/mobile_reports_calendar.html', 
                              objects_by_date=objects_by_date, 
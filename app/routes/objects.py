@@ -1,9 +1,15 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, abort, send_file, current_app
 from io import BytesIO
 from flask_login import login_required, current_user
-from app.extensions import db, cache
+from app.extensions import db
 from app.models.objects import Object, Support, Trench, TrenchExcavation, TrenchFile, Report, Checklist, ChecklistItem, PlannedWork, WorkExecution, WorkComparison, ZDF, Bracket, Luminaire, DailyReport, ElementAttachment
 from app.models.activity_log import ActivityLog
+from app.utils.attachment_download import send_attachment, send_attachment_for_view
+from app.utils.thumbnails import attachment_source, delete_thumbnails, requested_size, send_thumbnail
+from app.utils.cache_tags import model_tag, object_tag
+from app.utils.planned_work_stats import attach_work_counts
+from app.utils.trench_progress import ensure_trench_progress
+from app.utils.view_cache import cached_page
 from datetime import datetime
 import uuid
 import os
@@ -12,6 +18,11 @@ from werkzeug.utils import secure_filename
 
 objects_bp = Blueprint('objects', __name__)
 
+@objects_bp.before_request
+def _ensure_trench_progress():
+    """Сводка по копке траншей пересчитывается один раз после развёртывания"""
+    ensure_trench_progress()
+
 def is_pto_engineer(user):
     """Проверяет, является ли пользователь инженером ПТО"""
     return user and user.role and 'ПТО' in user.role.upper()
@@ -125,9 +136,22 @@ def inject_gettext():
 
 @objects_bp.route('/')
 @login_required
-@cache.cached(timeout=30, query_string=True)
 def object_list():
     """Список всех объектов"""
+    # Логируем просмотр списка объектов (на каждый запрос, в том числе из кэша)
+    ActivityLog.log_action(
+        user_id=current_user.userid,
+        user_login=current_user.login,
+        action="Просмотр списка объектов",
+        description=f"Пользователь {current_user.login} просмотрел список объектов",
+        ip_address=request.remote_addr,
+        page_url=request.url,
+        method=request.method
+    )
+    return cached_page(_render_object_list, tags=[model_tag('objects')])
+
+
+def _render_object_list():
     # Пагинация и выбор только нужных полей для ускорения ответа
     from sqlalchemy.orm import load_only
     page = request.args.get('page', 1, type=int)
@@ -143,17 +167,6 @@ def object_list():
     pagination = query.paginate(page=page, per_page=per_page, error_out=False)
     objects = pagination.items
     
-    # Логируем просмотр списка объектов
-    ActivityLog.log_action(
-        user_id=current_user.userid,
-        user_login=current_user.login,
-        action="Просмотр списка объектов",
-        description=f"Пользователь {current_user.login} просмотрел список объектов",
-        ip_address=request.remote_addr,
-        page_url=request.url,
-        method=request.method
-    )
-    
     # Определяем, нужно ли использовать мобильный шаблон
     from ..utils.mobile_detection import is_mobile_device
     if is_mobile_device():
@@ -161,37 +174,11 @@ def object_list():
     else:
         return render_template('objects/object_list.html', objects=objects, active_page='objects', pagination=pagination)
 
+
 @objects_bp.route('/planned-works-overview')
 @login_required
-@cache.cached(timeout=60, query_string=True)
 def planned_works_overview():
     """Обзор всех запланированных работ по объектам"""
-    # Обновляем статус работ на 'в работе', когда наступает дата
-    PlannedWork.update_works_status_to_in_progress()
-    # Обновляем статус просроченных работ
-    PlannedWork.update_overdue_works()
-    
-    # Обновляем статус просроченных траншей
-    Trench.update_overdue_trenches()
-    
-    # Получаем все объекты с их запланированными работами
-    objects = Object.query.all()
-    
-    # Отладочная информация
-    print(f"DEBUG: Найдено объектов: {len(objects)}")
-    
-    # Подсчитываем статистику по каждому объекту
-    for obj in objects:
-        obj.planned_works_count = len(obj.planned_works)
-        obj.completed_works_count = len([w for w in obj.planned_works if w.status == 'completed'])
-        obj.pending_works_count = len([w for w in obj.planned_works if w.status == 'planned'])
-        obj.in_progress_works_count = len([w for w in obj.planned_works if w.status == 'in_progress'])
-        obj.overdue_works_count = len([w for w in obj.planned_works if w.status == 'overdue'])
-        
-        print(f"DEBUG: Объект '{obj.name}' - запланированных работ: {obj.planned_works_count}")
-        for work in obj.planned_works:
-            print(f"DEBUG:   - Работа: {work.work_title}, тип: {work.work_type}, статус: {work.status}")
-    
     # Логируем просмотр обзора запланированных работ
     ActivityLog.log_action(
         user_id=current_user.userid,
@@ -202,6 +189,12 @@ def planned_works_overview():
         page_url=request.url,
         method=request.method
     )
+    return cached_page(_render_planned_works_overview, tags=[model_tag('objects'), model_tag('planned_works')])
+
+
+def _render_planned_works_overview():
+    # Объекты и счётчики их работ по статусам — два запроса при любом числе объектов
+    objects = attach_work_counts(Object.query.all())
     
     # Определяем, нужно ли использовать мобильный шаблон
     from ..utils.mobile_detection import is_mobile_device
@@ -214,30 +207,15 @@ def planned_works_overview():
 @login_required
 def all_planned_works():
     """Список всех запланированных работ в виде таблицы"""
-    # Обновляем статус работ на 'в работе', когда наступает дата
-    PlannedWork.update_works_status_to_in_progress()
-    # Обновляем статус просроченных работ
-    PlannedWork.update_overdue_works()
-    
-    # Обновляем статус просроченных траншей
-    Trench.update_overdue_trenches()
-    
     # Получаем параметр фильтра по объекту
     object_filter = request.args.get('object_id', '')
     
-    # Получаем все объекты для фильтра
-    all_objects = Object.query.order_by(Object.name.asc()).all()
-    
-    # Вычисляем статистику для каждого объекта
-    for obj in all_objects:
-        obj.planned_works_count = len(obj.planned_works)
-        obj.completed_works_count = len([w for w in obj.planned_works if w.status == 'completed'])
-        obj.pending_works_count = len([w for w in obj.planned_works if w.status == 'planned'])
-        obj.in_progress_works_count = len([w for w in obj.planned_works if w.status == 'in_progress'])
-        obj.overdue_works_count = len([w for w in obj.planned_works if w.status == 'overdue'])
+    # Получаем все объекты для фильтра со счётчиками работ по статусам
+    all_objects = attach_work_counts(Object.query.order_by(Object.name.asc()).all())
     
-    # Базовый запрос
-    query = PlannedWork.query.join(Object)
+    # Базовый запрос; объект работы загружается тем же JOIN, а не отдельно на строку
+    from sqlalchemy.orm import contains_eager
+    query = PlannedWork.query.join(Object).options(contains_eager(PlannedWork.object))
     
     # Применяем фильтр по объекту, если указан
     if object_filter:
@@ -434,11 +412,15 @@ def object_detail(object_id):
         method=request.method
     )
     
+    # Счётчики для карточки — из сводки, а не из ленивых связей объекта
+    from ..utils.object_summary import object_summary
+    summary = object_summary(obj.id)
+    
     from ..utils.mobile_detection import is_mobile_device
     if is_mobile_device():
-        return render_template('objects/mobile_object_detail.html', object=obj)
+        return render_template('objects/mobile_object_detail.html', object=obj, summary=summary)
     else:
-        return render_template('objects/object_detail.html', object=obj)
+        return render_template('objects/object_detail.html', object=obj, summary=summary)
 
 @objects_bp.route('/<uuid:object_id>/elements')
 @login_required
@@ -798,8 +780,7 @@ def add_element(object_id):
                         element_id=None,  # Будет установлен после создания элемента
                         original_filename=file.filename,
                         content_type=content_type,
-                        data=file_data,
-                        size_bytes=len(file_data),
+                        content=file_data,
                         uploaded_by=current_user.userid
                     )
                     
@@ -882,12 +863,6 @@ def add_element(object_id):
         # Отладочная информация после сохранения
         print(f"DEBUG add_element: Element saved with ID = {new_element.id}")
         print(f"DEBUG add_element: Element support_id after save = {new_element.support_id}")
-
-        # Сбрасываем кеш списка элементов, чтобы сразу увидеть кнопку просмотра файла
-        try:
-            cache.delete_memoized(elements_list, object_id)
-        except Exception as _:
-            pass
         
         ActivityLog.log_action(
             user_id=current_user.userid,
@@ -1573,14 +1548,11 @@ def trenches_list(object_id):
     # Получаем траншеи объекта (сортируем по убыванию даты создания - последние добавленные сверху)
     trenches = Trench.query.filter_by(object_id=object_id).order_by(Trench.created_at.desc()).all()
     
-    # Для каждой траншеи получаем общую длину и количество файлов
+    # Выкопанная длина и число файлов хранятся в самой траншее (Trench.refresh_progress)
     total_excavated_all = 0  # Общая выкопанная длина по всем траншеям
     total_length_all = 0  # Общий метраж всех траншей (если указан)
     for trench in trenches:
-        trench.total_excavated = trench.get_total_excavated_length()
-        trench.files_count = trench.get_files_count()
-        trench.required_files = trench.get_required_files_count()
-        total_excavated_all += trench.total_excavated
+        total_excavated_all += trench.get_total_excavated_length()
         if trench.total_length:
             total_length_all += trench.total_length
     
@@ -1691,7 +1663,7 @@ def add_trench_excavation(object_id, trench_id):
         
         # Проверяем количество файлов только для не-админов (не Инженер ПТО)
         if not is_pto_engineer(current_user):
-            required_files = max(1, int(length / 20) + (1 if length % 20 > 0 else 0))
+            required_files = Trench.required_files_for(length)
             if len(files) < required_files:
                 flash(f'Необходимо прикрепить минимум {required_files} файл(ов) для {length} метров', 'error')
                 return render_template('objects/mobile_add_trench_excavation.html' if is_mobile else 'objects/add_trench_excavation.html', object=obj, trench=trench)
@@ -1753,7 +1725,8 @@ def add_trench_excavation(object_id, trench_id):
                     current_app.logger.error(f'Ошибка при сохранении файла {file.filename}: {str(e)}')
                     continue
         
-        # Обновляем статус траншеи
+        # Обновляем сводку по копке и статус траншеи
+        trench.refresh_progress()
         trench.check_completion_status()
         
         db.session.commit()
@@ -1783,28 +1756,21 @@ def trench_detail(object_id, trench_id):
     obj = Object.query.get_or_404(object_id)
     trench = Trench.query.filter_by(id=trench_id, object_id=object_id).first_or_404()
     
-    # Получаем все записи о копке с файлами
-    excavations = TrenchExcavation.query.filter_by(trench_id=trench_id).order_by(TrenchExcavation.excavation_date.desc(), TrenchExcavation.created_at.desc()).all()
-    
-    # Для каждой записи получаем файлы и информацию о создателе
+    # Все записи о копке одним запросом, их файлы и создатели — ещё по одному
+    from sqlalchemy.orm import selectinload
     from app.models.users import Users
-    for excavation in excavations:
-        excavation.files_list = TrenchFile.query.filter_by(excavation_id=excavation.id).all()
-        if excavation.created_by:
-            excavation.creator = Users.query.get(excavation.created_by)
-        else:
-            excavation.creator = None
+    excavations = TrenchExcavation.query.options(
+        selectinload(TrenchExcavation.files),
+        selectinload(TrenchExcavation.created_by_user),
+    ).filter_by(trench_id=trench_id).order_by(TrenchExcavation.excavation_date.desc(), TrenchExcavation.created_at.desc()).all()
     
-    # Получаем общую информацию
-    trench.total_excavated = trench.get_total_excavated_length()
-    trench.files_count = trench.get_files_count()
-    trench.required_files = trench.get_required_files_count()
+    for excavation in excavations:
+        excavation.files_list = excavation.files
+        excavation.creator = excavation.created_by_user
     
+    # Выкопанная длина и число файлов хранятся в самой траншее (Trench.refresh_progress)
     # Получаем создателя траншеи
-    if trench.created_by:
-        trench.creator = Users.query.get(trench.created_by)
-    else:
-        trench.creator = None
+    trench.creator = db.session.get(Users, trench.created_by) if trench.created_by else None
     
     ActivityLog.log_action(
         user_id=current_user.userid,
@@ -1822,16 +1788,8 @@ def trench_detail(object_id, trench_id):
     return render_template('objects/mobile_trench_detail.html' if is_mobile else 'objects/trench_detail.html', 
                          object=obj, trench=trench, excavations=excavations)
 
-@objects_bp.route('/<uuid:object_id>/trenches/<uuid:trench_id>/files/<uuid:file_id>/download')
-@login_required
-def download_trench_file(object_id, trench_id, file_id):
-    """Скачивание или просмотр файла траншеи"""
-    obj = Object.query.get_or_404(object_id)
-    trench = Trench.query.filter_by(id=trench_id, object_id=object_id).first_or_404()
-    trench_file = TrenchFile.query.filter_by(id=file_id, trench_id=trench_id).first_or_404()
-    
-    import os
-    
+def _trench_file_path(trench_file):
+    """Путь к файлу траншеи на диске (пути в БД сохранены в разных форматах)"""
     # Нормализуем путь к файлу
     # В БД может быть сохранен путь вида 'app/static/uploads/trenches/...'
     # Рабочая директория в контейнере - /app, поэтому нужно убрать 'app/' из начала пути
@@ -1849,15 +1807,26 @@ def download_trench_file(object_id, trench_id, file_id):
     # Альтернативный вариант: если файл не найден, пробуем найти по имени файла
     if not os.path.exists(file_path):
         # Пробуем найти файл по имени в папке траншеи
-        upload_folder = os.path.join('/', 'app', 'app', 'static', 'uploads', 'trenches', str(trench_id))
+        upload_folder = os.path.join('/', 'app', 'app', 'static', 'uploads', 'trenches', str(trench_file.trench_id))
         alt_path = os.path.join(upload_folder, trench_file.filename)
         if os.path.exists(alt_path):
             file_path = alt_path
         else:
             # Пробуем еще один вариант
-            alt_path2 = os.path.join('/', 'app', 'static', 'uploads', 'trenches', str(trench_id), trench_file.filename)
+            alt_path2 = os.path.join('/', 'app', 'static', 'uploads', 'trenches', str(trench_file.trench_id), trench_file.filename)
             if os.path.exists(alt_path2):
                 file_path = alt_path2
+    return file_path
+
+@objects_bp.route('/<uuid:object_id>/trenches/<uuid:trench_id>/files/<uuid:file_id>/download')
+@login_required
+def download_trench_file(object_id, trench_id, file_id):
+    """Скачивание или просмотр файла траншеи"""
+    obj = Object.query.get_or_404(object_id)
+    trench = Trench.query.filter_by(id=trench_id, object_id=object_id).first_or_404()
+    trench_file = TrenchFile.query.filter_by(id=file_id, trench_id=trench_id).first_or_404()
+    
+    file_path = _trench_file_path(trench_file)
     
     if os.path.exists(file_path):
         # Для изображений отдаем без скачивания (для просмотра)
@@ -1871,13 +1840,44 @@ def download_trench_file(object_id, trench_id, file_id):
         flash('Файл не найден', 'error')
         return redirect(url_for('objects.trenches_list', object_id=object_id))
 
+@objects_bp.route('/<uuid:object_id>/trenches/<uuid:trench_id>/files/<uuid:file_id>/thumb')
+@login_required
+def trench_file_thumb(object_id, trench_id, file_id):
+    """Уменьшенная копия фото траншеи (?size=sm|md)"""
+    Trench.query.filter_by(id=trench_id, object_id=object_id).first_or_404()
+    trench_file = TrenchFile.query.filter_by(id=file_id, trench_id=trench_id).first_or_404()
+
+    def open_source():
+        file_path = _trench_file_path(trench_file)
+        return file_path if os.path.exists(file_path) else None
+
+    response = None
+    if trench_file.mime_type and trench_file.mime_type.startswith('image/'):
+        response = send_thumbnail('trench', trench_file.id, requested_size(request.args.get('size')), open_source)
+    if response is None:
+        return redirect(url_for('objects.download_trench_file', object_id=object_id, trench_id=trench_id, file_id=file_id))
+    return response
+
 # Маршруты для отчётов
 @objects_bp.route('/<uuid:object_id>/reports')
 @login_required
-@cache.cached(timeout=60, query_string=True)
 def reports_list(object_id):
     """Список отчётов объекта"""
     obj = Object.query.get_or_404(object_id)
+    ActivityLog.log_action(
+        user_id=current_user.userid,
+        user_login=current_user.login,
+        action="Просмотр отчётов",
+        description=f"Пользователь {current_user.login} просмотрел отчёты объекта '{obj.name}'",
+        ip_address=request.remote_addr,
+        page_url=request.url,
+        method=request.method
+    )
+    return cached_page(lambda: _render_reports_list(obj), tags=[object_tag(obj.id)])
+
+
+def _render_reports_list(obj):
+    object_id = obj.id
     from sqlalchemy.orm import load_only
     # Пагинация основных отчётов
     page = request.args.get('page', 1, type=int)
@@ -1920,16 +1920,6 @@ def reports_list(object_id):
         trench_count = trench_counts_by_date.get(daily_report.report_date, 0)
         daily_report.trench_excavations_count = trench_count
     
-    ActivityLog.log_action(
-        user_id=current_user.userid,
-        user_login=current_user.login,
-        action="Просмотр отчётов",
-        description=f"Пользователь {current_user.login} просмотрел отчёты объекта '{obj.name}'",
-        ip_address=request.remote_addr,
-        page_url=request.url,
-        method=request.method
-    )
-    
     from ..utils.mobile_detection import is_mobile_device
     if is_mobile_device():
         return render_template('objects/mobile_reports_list.html', object=obj, reports=reports, daily_reports=daily_reports, today=date.today(), pagination=reports_pagination)
@@ -2327,19 +2317,24 @@ def delete_checklist_item(object_id, item_id):
 # Маршруты для запланированных работ
 @objects_bp.route('/<uuid:object_id>/planned-works')
 @login_required
-@cache.cached(timeout=60, query_string=True)
 def planned_works_list(object_id):
     """Список запланированных работ объекта"""
-    # Обновляем статус работ на 'в работе', когда наступает дата
-    PlannedWork.update_works_status_to_in_progress()
-    # Обновляем статус просроченных работ
-    PlannedWork.update_overdue_works()
-    
-    # Обновляем статус просроченных траншей
-    Trench.update_overdue_trenches()
-    
     obj = Object.query.get_or_404(object_id)
     
+    ActivityLog.log_action(
+        user_id=current_user.userid,
+        user_login=current_user.login,
+        action="Просмотр запланированных работ",
+        description=f"Пользователь {current_user.login} просмотрел запланированные работы объекта '{obj.name}'",
+        ip_address=request.remote_addr,
+        page_url=request.url,
+        method=request.method
+    )
+    return cached_page(lambda: _render_planned_works_list(obj), tags=[object_tag(obj.id)])
+
+
+def _render_planned_works_list(obj):
+    object_id = obj.id
     # Пагинация и узкая выборка полей для ускорения
     from sqlalchemy.orm import load_only
     page = request.args.get('page', 1, type=int)
@@ -2355,16 +2350,6 @@ def planned_works_list(object_id):
     pagination = query.paginate(page=page, per_page=per_page, error_out=False)
     planned_works = pagination.items
     
-    ActivityLog.log_action(
-        user_id=current_user.userid,
-        user_login=current_user.login,
-        action="Просмотр запланированных работ",
-        description=f"Пользователь {current_user.login} просмотрел запланированные работы объекта '{obj.name}'",
-        ip_address=request.remote_addr,
-        page_url=request.url,
-        method=request.method
-    )
-    
     # Проверяем, является ли пользователь инженером ПТО
     is_pto = is_pto_engineer(current_user)
     
@@ -2928,15 +2913,17 @@ def add_checklist_item_quantity(object_id, item_id):
 def manual_update_overdue_works():
     """Ручное обновление статуса просроченных работ"""
     try:
-        # Обновляем статус работ на 'в работе', когда наступает дата
-        in_progress_count = PlannedWork.update_works_status_to_in_progress()
-        # Обновляем статус просроченных работ
-        updated_count = PlannedWork.update_overdue_works()
+        # Тот же пересчёт, что выполняет планировщик, но без ожидания следующего часа
+        from app.utils.scheduler import sweep_statuses
+        counts = sweep_statuses(force=True)
+        in_progress_count = counts['in_progress']
+        updated_count = counts['overdue_works']
         
         ActivityLog.log_action(
             user_id=current_user.userid,
+            user_login=current_user.login,
             action='manual_update_overdue_works',
-            details=f'Обновлено работ в работу: {in_progress_count}, просроченных работ: {updated_count}',
+            description=f'Обновлено работ в работу: {in_progress_count}, просроченных работ: {updated_count}',
             method=request.method
         )
         
@@ -3258,12 +3245,21 @@ def delete_object(object_id):
             method=request.method
         )
         
+        # Файлы траншей удаляются каскадом вместе с объектом, их миниатюры — после commit
+        trench_file_ids = [
+            file_id for (file_id,) in
+            db.session.query(TrenchFile.id).join(Trench, TrenchFile.trench_id == Trench.id)
+            .filter(Trench.object_id == object_id)
+        ]
+        
         # Сначала удаляем все связанные DailyReport записи
         DailyReport.query.filter_by(object_id=object_id).delete()
         
         # Затем удаляем сам объект
         db.session.delete(obj)
         db.session.commit()
+        for file_id in trench_file_ids:
+            delete_thumbnails('trench', file_id)
         
         return jsonify({'success': True, 'message': f'Объект "{obj.name}" успешно удалён'})
         
@@ -3317,8 +3313,7 @@ def upload_element_attachment(object_id, element_type, element_id):
             filename=secure_filename(file.filename),
             original_filename=file.filename,
             content_type=content_type,
-            data=file_data,
-            size_bytes=len(file_data),
+            content=file_data,
             uploaded_by=current_user.userid
         )
         
@@ -3349,29 +3344,10 @@ def view_element_attachment(object_id, element_type, element_id, attachment_id):
     if not attachment:
         return jsonify({'error': 'Файл не найден'}), 404
     
-    # Определяем, можно ли отобразить файл в браузере
-    viewable_types = [
-        'image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp',
-        'application/pdf',
-        'text/plain', 'text/html', 'text/css', 'text/javascript',
-        'application/json', 'application/xml', 'text/xml'
-    ]
-    
-    if attachment.content_type in viewable_types:
-        # Отправляем файл для просмотра в браузере
-        return send_file(
-            BytesIO(attachment.data), 
-            mimetype=attachment.content_type or 'application/octet-stream', 
-            as_attachment=False
-        )
-    else:
-        # Принудительно скачиваем файл
-        return send_file(
-            BytesIO(attachment.data), 
-            mimetype=attachment.content_type or 'application/octet-stream', 
-            as_attachment=True, 
-            download_name=attachment.original_filename or getattr(attachment, 'filename', None) or 'file'
-        )
+    return send_attachment_for_view(
+        attachment,
+        download_name=attachment.original_filename or getattr(attachment, 'filename', None) or 'file',
+    )
 
 @objects_bp.route('/<uuid:object_id>/elements/<element_type>/<uuid:element_id>/attachments/latest/view', methods=['GET'])
 @login_required
@@ -3383,24 +3359,50 @@ def view_element_attachment_latest(object_id, element_type, element_id):
     ).order_by(ElementAttachment.uploaded_at.desc()).first()
     if not attachment:
         return jsonify({'error': 'Файл не найден'}), 404
-    viewable_types = [
-        'image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp',
-        'application/pdf',
-        'text/plain', 'text/html', 'text/css', 'text/javascript',
-        'application/json', 'application/xml', 'text/xml'
-    ]
-    if attachment.content_type in viewable_types:
-        return send_file(
-            BytesIO(attachment.data),
-            mimetype=attachment.content_type or 'application/octet-stream',
-            as_attachment=False
-        )
-    return send_file(
-        BytesIO(attachment.data),
-        mimetype=attachment.content_type or 'application/octet-stream',
-        as_attachment=True,
-        download_name=attachment.original_filename or getattr(attachment, 'filename', None) or 'file'
+    # Адрес «последний файл» может начать отдавать другое вложение — без immutable
+    return send_attachment_for_view(
+        attachment,
+        download_name=attachment.original_filename or getattr(attachment, 'filename', None) or 'file',
+        immutable=False,
+    )
+
+@objects_bp.route('/<uuid:object_id>/elements/<element_type>/<uuid:element_id>/attachments/<uuid:attachment_id>/thumb', methods=['GET'])
+@login_required
+def element_attachment_thumb(object_id, element_type, element_id, attachment_id):
+    """Уменьшенная копия фото элемента (?size=sm|md); не изображения отдаются как есть"""
+    attachment = ElementAttachment.query.filter_by(
+        id=attachment_id,
+        element_type=element_type,
+        element_id=element_id
+    ).first()
+    if not attachment:
+        return jsonify({'error': 'Файл не найден'}), 404
+    response = send_thumbnail(
+        'element', attachment.id, requested_size(request.args.get('size')), attachment_source(attachment),
     )
+    if response is None:
+        return send_attachment_for_view(attachment, download_name=attachment.original_filename or 'file')
+    return response
+
+@objects_bp.route('/<uuid:object_id>/elements/<element_type>/<uuid:element_id>/attachments/latest/thumb', methods=['GET'])
+@login_required
+def element_attachment_latest_thumb(object_id, element_type, element_id):
+    """Уменьшенная копия последнего (по дате) фото элемента"""
+    attachment = ElementAttachment.query.filter_by(
+        element_type=element_type,
+        element_id=element_id
+    ).order_by(ElementAttachment.uploaded_at.desc()).first()
+    if not attachment:
+        return jsonify({'error': 'Файл не найден'}), 404
+    response = send_thumbnail(
+        'element', attachment.id, requested_size(request.args.get('size')), attachment_source(attachment),
+        immutable=False,
+    )
+    if response is None:
+        return send_attachment_for_view(
+            attachment, download_name=attachment.original_filename or 'file', immutable=False,
+        )
+    return response
 
 @objects_bp.route('/<uuid:object_id>/elements/<element_type>/<uuid:element_id>/attachments/<uuid:attachment_id>/download', methods=['GET'])
 @login_required
@@ -3415,12 +3417,7 @@ def download_element_attachment(object_id, element_type, element_id, attachment_
     if not attachment:
         return jsonify({'error': 'Файл не найден'}), 404
     
-    return send_file(
-        BytesIO(attachment.data), 
-        mimetype=attachment.content_type or 'application/octet-stream', 
-        as_attachment=True, 
-        download_name=attachment.original_filename
-    )
+    return send_attachment(attachment, as_attachment=True, download_name=attachment.original_filename)
 
 @objects_bp.route('/<uuid:object_id>/elements/<element_type>/<uuid:element_id>/attachments/<uuid:attachment_id>', methods=['DELETE'])
 @login_required
@@ -3441,6 +3438,7 @@ def delete_element_attachment(object_id, element_type, element_id, attachment_id
     try:
         db.session.delete(attachment)
         db.session.commit()
+        delete_thumbnails('element', attachment_id)
         
         return jsonify({'success': True, 'message': 'Файл удалён'})
         
@@ -13,15 +13,28 @@ from app.models.supply import (
     SupplyRequestItem,
     MaterialGroup,
     MaterialGroupItem,
+    StockSnapshotLine,
 )
 from app.models.users import Users
 from app.models.activity_log import ActivityLog
-from app.extensions import db
+from app.extensions import cache, db
 from app.utils.mobile_detection import is_mobile_device
 from app.utils.timezone_utils import get_moscow_now
+from app.utils.stock_ledger import (
+    StockBatchError, StockLedgerError, commit_with_retry, post_movement, post_movements, set_quantity,
+)
+from app.utils.cache_tags import ALL_TAG, tag_versions
+from app.utils.material_index import get_material_index
+from app.utils.attachment_download import send_attachment, send_attachment_for_view
+from app.utils.thumbnails import attachment_source, delete_thumbnails, requested_size, send_thumbnail
+from app.utils.user_search import USER_INDEX_TAG, get_user_index, normalize as normalize_search_query
+from app.utils.stock_replay import check_drift, latest_snapshot, rebuild, replay, stock_as_of, take_snapshot
 from datetime import datetime, timedelta, timezone
 from io import BytesIO
+import base64
+import heapq
 import os
+import uuid
 from werkzeug.utils import secure_filename
 
 supply = Blueprint('supply', __name__)
@@ -691,11 +704,23 @@ def api_materials_check():
     if not name:
         return jsonify({'error': 'Требуется название материала'}), 400
     
-    # Получаем все активные материалы
-    all_materials = Material.query.filter_by(is_active=True).all()
+    index = get_material_index()
     
     # 1. Точное совпадение (с учетом регистра)
-    exact_match = next((m for m in all_materials if m.name == name), None)
+    exact_id = index.exact.get(name)
+    # 2. Совпадение без учета регистра
+    case_insensitive_id = None if exact_id else index.lower.get(name.lower())
+    matched_id = exact_id or case_insensitive_id
+    # 3. Поиск похожих названий (триграммы + ограниченное расстояние Левенштейна)
+    similar = [] if matched_id else index.similar(name)
+    
+    # Количества и описания берём из БД одним запросом: индекс хранит только названия
+    wanted_ids = [matched_id] if matched_id else [m_id for m_id, _ in similar]
+    materials = {
+        m.id: m for m in Material.query.filter(Material.id.in_(wanted_ids), Material.is_active.is_(True)).all()
+    } if wanted_ids else {}
+    
+    exact_match = materials.get(exact_id)
     if exact_match:
         return jsonify({
             'exists': True,
@@ -709,8 +734,7 @@ def api_materials_check():
             }
         })
     
-    # 2. Совпадение без учета регистра
-    case_insensitive_match = next((m for m in all_materials if m.name.lower() == name.lower()), None)
+    case_insensitive_match = materials.get(case_insensitive_id)
     if case_insensitive_match:
         return jsonify({
             'exists': True,
@@ -726,49 +750,25 @@ def api_materials_check():
             }
         })
     
-    # 3. Поиск похожих названий (простой алгоритм Левенштейна)
-    def levenshtein_distance(s1, s2):
-        if len(s1) < len(s2):
-            return levenshtein_distance(s2, s1)
-        if len(s2) == 0:
-            return len(s1)
-        
-        previous_row = list(range(len(s2) + 1))
-        for i, c1 in enumerate(s1):
-            current_row = [i + 1]
-            for j, c2 in enumerate(s2):
-                insertions = previous_row[j + 1] + 1
-                deletions = current_row[j] + 1
-                substitutions = previous_row[j] + (c1 != c2)
-                current_row.append(min(insertions, deletions, substitutions))
-            previous_row = current_row
-        
-        return previous_row[-1]
-    
-    # Ищем похожие названия
-    similar_materials = []
-    for material in all_materials:
-        distance = levenshtein_distance(name.lower(), material.name.lower())
-        # Если расстояние меньше 30% от длины более короткой строки
-        max_distance = min(len(name), len(material.name)) * 0.3
-        if distance <= max_distance and distance > 0:
-            similar_materials.append({
-                'name': material.name,
-                'distance': distance,
-                'unit': material.unit,
-                'min_quantity': material.min_quantity,
-                'current_quantity': material.current_quantity,
-                'description': material.description or ''
-            })
-    
-    # Сортируем по расстоянию (более похожие сначала)
-    similar_materials.sort(key=lambda x: x['distance'])
+    # Похожие названия уже отсортированы по расстоянию (более похожие сначала)
+    similar_materials = [
+        {
+            'name': materials[m_id].name,
+            'distance': distance,
+            'unit': materials[m_id].unit,
+            'min_quantity': materials[m_id].min_quantity,
+            'current_quantity': materials[m_id].current_quantity,
+            'description': materials[m_id].description or ''
+        }
+        for m_id, distance in similar
+        if m_id in materials
+    ]
     
     if similar_materials:
         return jsonify({
             'exists': False,
             'similar_found': True,
-            'similar_materials': similar_materials[:3]  # Возвращаем до 3 похожих
+            'similar_materials': similar_materials  # До 3 похожих
         })
     
     return jsonify({'exists': False, 'similar_found': False})
@@ -807,36 +807,83 @@ def api_materials_create():
     if not name or not unit:
         return jsonify({'error': 'Требуются name и unit'}), 400
 
-    # Сначала проверяем, есть ли активный материал с таким же именем
-    active_material = Material.query.filter_by(name=name, is_active=True).first()
-    
-    if active_material:
-        # Пополняем существующий активный материал
-        new_quantity = float(data.get('current_quantity') or 0.0)
-        addition_reason = data.get('addition_reason', '').strip()
+    new_quantity = float(data.get('current_quantity') or 0.0)
+    addition_reason = (data.get('addition_reason') or '').strip()
+    upload_data = upload.read() if upload and getattr(upload, 'filename', None) else None
+
+    def work():
+        # Сначала проверяем, есть ли активный материал с таким же именем
+        active_material = Material.query.filter_by(name=name, is_active=True).first()
         
-        # Создаем запись о пополнении в истории движений
-        movement = WarehouseMovement(
-            material_id=active_material.id,
-            quantity=new_quantity,
-            movement_type='replenishment',
-            note=f"Пополнение материала. Причина: {addition_reason}" if addition_reason else "Пополнение материала",
-            created_by=current_user.userid,
-        )
-        db.session.add(movement)
+        if active_material:
+            # Создаем запись о пополнении в истории движений
+            movement = WarehouseMovement(
+                material_id=active_material.id,
+                quantity=new_quantity,
+                movement_type='replenishment',
+                note=f"Пополнение материала. Причина: {addition_reason}" if addition_reason else "Пополнение материала",
+                created_by=current_user.userid,
+            )
+            db.session.add(movement)
+            
+            # Обновляем количество материала
+            active_material.current_quantity = (active_material.current_quantity or 0.0) + new_quantity
+            active_material.updated_at = get_moscow_now()
+            return 'replenished', active_material
         
-        # Обновляем количество материала
-        active_material.current_quantity = (active_material.current_quantity or 0.0) + new_quantity
-        active_material.updated_at = get_moscow_now()
+        # Проверяем, есть ли неактивный материал с таким же именем
+        existing_material = Material.query.filter_by(name=name, is_active=False).first()
         
-        db.session.commit()
+        if existing_material:
+            # Восстанавливаем существующий материал; изменение остатка — движением
+            existing_material.is_active = True
+            set_quantity(existing_material, new_quantity, current_user.userid, note='Восстановление материала')
+            existing_material.min_quantity = float(data.get('min_quantity') or 0.0)
+            existing_material.description = data.get('description')
+            existing_material.supplier = data.get('supplier')
+            existing_material.price_per_unit = float(data.get('price_per_unit') or 0.0) if data.get('price_per_unit') is not None else None
+            existing_material.updated_at = get_moscow_now()
+            return 'restored', existing_material
         
+        # Создаем новый материал
+        material = Material(
+            name=name,
+            unit=unit,
+            description=data.get('description'),
+            current_quantity=0.0,
+            min_quantity=float(data.get('min_quantity') or 0.0),
+            supplier=data.get('supplier'),
+            price_per_unit=float(data.get('price_per_unit') or 0.0) if data.get('price_per_unit') is not None else None,
+            created_by=current_user.userid,
+        )
+        db.session.add(material)
+        db.session.flush()
+        # Начальное количество — движением, чтобы журнал сходился со счётчиком
+        set_quantity(material, new_quantity, current_user.userid, note='Начальный остаток при создании материала')
+
+        # Если в форме был передан файл превью, сохраняем его как вложение к материалу
+        if upload_data is not None:
+            db.session.add(MaterialAttachment(
+                material_id=material.id,
+                filename=secure_filename(upload.filename),
+                content_type=upload.mimetype,
+                content=upload_data,
+                uploaded_by=current_user.userid,
+            ))
+        return 'created', material
+
+    try:
+        outcome, material = commit_with_retry(work)
+    except StockLedgerError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+    if outcome == 'replenished':
         # Логируем действие
         ActivityLog.log_action(
             user_id=current_user.userid,
             user_login=current_user.login,
             action="Пополнение материала",
-            description=f'Пополнен материал "{name}" на {new_quantity} {active_material.unit}. Причина: {addition_reason}' if addition_reason else f'Пополнен материал "{name}" на {new_quantity} {active_material.unit}',
+            description=f'Пополнен материал "{name}" на {new_quantity} {material.unit}. Причина: {addition_reason}' if addition_reason else f'Пополнен материал "{name}" на {new_quantity} {material.unit}',
             ip_address=request.remote_addr,
             page_url=request.url,
             method=request.method
@@ -845,65 +892,19 @@ def api_materials_create():
         # Возвращаем информацию о пополнении
         return jsonify({
             'success': True,
-            'material': active_material.to_dict(),
-            'message': f'Материал "{name}" пополнен на {new_quantity} {active_material.unit}. Текущее количество: {active_material.current_quantity} {active_material.unit}'
+            'material': material.to_dict(),
+            'message': f'Материал "{name}" пополнен на {new_quantity} {material.unit}. Текущее количество: {material.current_quantity} {material.unit}'
         }), 201
-    
-    # Проверяем, есть ли неактивный материал с таким же именем
-    existing_material = Material.query.filter_by(name=name, is_active=False).first()
-    
-    if existing_material:
-        # Восстанавливаем существующий материал
-        existing_material.is_active = True
-        existing_material.current_quantity = float(data.get('current_quantity') or 0.0)
-        existing_material.min_quantity = float(data.get('min_quantity') or 0.0)
-        existing_material.description = data.get('description')
-        existing_material.supplier = data.get('supplier')
-        existing_material.price_per_unit = float(data.get('price_per_unit') or 0.0) if data.get('price_per_unit') is not None else None
-        existing_material.updated_at = get_moscow_now()
-        
-        db.session.commit()
-        
+
+    if outcome == 'restored':
         # Возвращаем предупреждение о восстановлении
         return jsonify({
             'success': True,
-            'material': existing_material.to_dict(),
+            'material': material.to_dict(),
             'warning': f'Материал "{name}" уже существовал ранее и был восстановлен. Все предыдущие перемещения и история будут сохранены и объединены с новыми операциями.'
         }), 201
-    else:
-        # Создаем новый материал
-        material = Material(
-            name=name,
-            unit=unit,
-            description=data.get('description'),
-            current_quantity=float(data.get('current_quantity') or 0.0),
-            min_quantity=float(data.get('min_quantity') or 0.0),
-            supplier=data.get('supplier'),
-            price_per_unit=float(data.get('price_per_unit') or 0.0) if data.get('price_per_unit') is not None else None,
-            created_by=current_user.userid,
-        )
-        db.session.add(material)
-        db.session.flush()
 
-        # Если в форме был передан файл превью, сохраняем его как вложение к материалу
-        if upload and getattr(upload, 'filename', None):
-            try:
-                data_bytes = upload.read()
-                attach = MaterialAttachment(
-                    material_id=material.id,
-                    filename=secure_filename(upload.filename),
-                    content_type=upload.mimetype,
-                    data=data_bytes,
-                    size_bytes=len(data_bytes),
-                    uploaded_by=current_user.userid,
-                )
-                db.session.add(attach)
-            except Exception as e:
-                db.session.rollback()
-                return jsonify({'error': f'Ошибка сохранения файла превью: {str(e)}'}), 500
-
-        db.session.commit()
-        return jsonify(material.to_dict()), 201
+    return jsonify(material.to_dict()), 201
 
 @supply.route('/api/supply/materials/<uuid:material_id>', methods=['PUT'])
 @login_required
@@ -916,16 +917,29 @@ def api_materials_update(material_id):
         return jsonify({'error': 'Материал не найден'}), 404
 
     data = request.get_json(force=True, silent=True) or {}
+    updates = {}
     for field in ['name', 'description', 'unit', 'supplier']:
         if field in data and data[field] is not None:
-            setattr(material, field, data[field])
+            updates[field] = data[field]
     for fnum in ['current_quantity', 'min_quantity', 'price_per_unit']:
         if fnum in data and data[fnum] is not None:
             try:
-                setattr(material, fnum, float(data[fnum]))
+                updates[fnum] = float(data[fnum])
             except Exception:
                 return jsonify({'error': f'Неверное значение {fnum}'}), 400
-    db.session.commit()
+
+    def work():
+        for field, value in updates.items():
+            if field == 'current_quantity':
+                # Ручная правка остатка — движением на разницу
+                set_quantity(material, value, current_user.userid, note='Корректировка остатка')
+            else:
+                setattr(material, field, value)
+
+    try:
+        commit_with_retry(work)
+    except StockLedgerError as e:
+        return jsonify({'error': e.message}), e.status_code
     return jsonify(material.to_dict())
 
 @supply.route('/api/supply/materials/<uuid:material_id>', methods=['DELETE'])
@@ -957,9 +971,14 @@ def api_materials_delete(material_id):
     )
     
     # Мягкое удаление - помечаем как неактивный
-    material.is_active = False
-    material.updated_at = get_moscow_now()
-    db.session.commit()
+    def work():
+        material.is_active = False
+        material.updated_at = get_moscow_now()
+
+    try:
+        commit_with_retry(work)
+    except StockLedgerError as e:
+        return jsonify({'error': e.message}), e.status_code
     
     return jsonify({'success': True, 'message': f'Материал "{material_name}" успешно удален'})
 
@@ -995,9 +1014,14 @@ def api_materials_restore(material_id):
     )
     
     # Восстанавливаем материал
-    material.is_active = True
-    material.updated_at = get_moscow_now()
-    db.session.commit()
+    def work():
+        material.is_active = True
+        material.updated_at = get_moscow_now()
+
+    try:
+        commit_with_retry(work)
+    except StockLedgerError as e:
+        return jsonify({'error': e.message}), e.status_code
     
     return jsonify({'success': True, 'message': f'Материал "{material_name}" успешно восстановлен'})
 
@@ -1009,13 +1033,23 @@ def api_material_preview(material_id):
     attachment = MaterialAttachment.query.filter_by(material_id=material_id).order_by(MaterialAttachment.uploaded_at.desc()).first()
     if not attachment:
         return jsonify({'error': 'Файл не найден'}), 404
-    return send_file(
-        BytesIO(attachment.data),
-        mimetype=attachment.content_type or 'application/octet-stream',
-        as_attachment=False,
-        download_name=attachment.filename,
-        conditional=True,
+    # Адрес отдаёт последнее превью материала, поэтому ответ перепроверяется по ETag
+    return send_attachment(attachment, immutable=False)
+
+@supply.route('/api/supply/materials/<uuid:material_id>/attachment/thumb', methods=['GET'])
+@login_required
+def api_material_preview_thumb(material_id):
+    """Уменьшенная копия превью материала (?size=sm|md)."""
+    attachment = MaterialAttachment.query.filter_by(material_id=material_id).order_by(MaterialAttachment.uploaded_at.desc()).first()
+    if not attachment:
+        return jsonify({'error': 'Файл не найден'}), 404
+    response = send_thumbnail(
+        'material', attachment.id, requested_size(request.args.get('size')), attachment_source(attachment),
+        immutable=False,
     )
+    if response is None:
+        return send_attachment(attachment, immutable=False)
+    return response
 
 @supply.route('/api/supply/materials/<uuid:material_id>/hard-delete', methods=['DELETE'])
 @login_required
@@ -1033,6 +1067,11 @@ def api_materials_hard_delete(material_id):
         return jsonify({'error': 'Материал не найден'}), 404
     
     material_name = material.name
+    # Вложения удаляются каскадом в БД, их миниатюры — после commit
+    attachment_ids = [
+        attachment_id for (attachment_id,) in
+        db.session.query(MaterialAttachment.id).filter_by(material_id=material_id)
+    ]
     
     try:
         # Логируем действие перед удалением
@@ -1046,35 +1085,44 @@ def api_materials_hard_delete(material_id):
             method=request.method
         )
         
-        # Получаем все связанные записи для логирования
-        movements_count = WarehouseMovement.query.filter_by(material_id=material_id).count()
-        allocations_count = UserMaterialAllocation.query.filter_by(material_id=material_id).count()
-        request_items_count = SupplyRequestItem.query.filter_by(material_id=material_id).count()
-        
-        # Удаляем все вложения к движениям этого материала
-        movements = WarehouseMovement.query.filter_by(material_id=material_id).all()
-        for movement in movements:
-            WarehouseAttachment.query.filter_by(movement_id=movement.id).delete()
-        
-        # Удаляем все движения по материалу
-        WarehouseMovement.query.filter_by(material_id=material_id).delete()
-        
-        # Удаляем все распределения материала по пользователям
-        UserMaterialAllocation.query.filter_by(material_id=material_id).delete()
-        
-        # Удаляем все элементы заявок, связанные с материалом
-        SupplyRequestItem.query.filter_by(material_id=material_id).delete()
-        
-        # Удаляем сам материал
-        db.session.delete(material)
+        def work():
+            # Получаем все связанные записи для логирования
+            movements_count = WarehouseMovement.query.filter_by(material_id=material_id).count()
+            allocations_count = UserMaterialAllocation.query.filter_by(material_id=material_id).count()
+            request_items_count = SupplyRequestItem.query.filter_by(material_id=material_id).count()
+            
+            # Удаляем все вложения к движениям этого материала
+            movements = WarehouseMovement.query.filter_by(material_id=material_id).all()
+            for movement in movements:
+                WarehouseAttachment.query.filter_by(movement_id=movement.id).delete()
+            
+            # Удаляем все движения по материалу
+            WarehouseMovement.query.filter_by(material_id=material_id).delete()
+            
+            # Удаляем все распределения материала по пользователям
+            UserMaterialAllocation.query.filter_by(material_id=material_id).delete()
+            
+            # Удаляем строки снимков складского учёта по материалу
+            StockSnapshotLine.query.filter_by(material_id=material_id).delete()
+            
+            # Удаляем все элементы заявок, связанные с материалом
+            SupplyRequestItem.query.filter_by(material_id=material_id).delete()
+            
+            # Удаляем сам материал
+            db.session.delete(material)
+            return movements_count, allocations_count, request_items_count
         
-        db.session.commit()
+        movements_count, allocations_count, request_items_count = commit_with_retry(work)
+        for attachment_id in attachment_ids:
+            delete_thumbnails('material', attachment_id)
         
         return jsonify({
             'success': True, 
             'message': f'Материал "{material_name}" полностью удален. Удалено: {movements_count} движений, {allocations_count} распределений, {request_items_count} элементов заявок.'
         })
         
+    except StockLedgerError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         db.session.rollback()
         print(f"Ошибка полного удаления материала: {e}")
@@ -1108,135 +1156,44 @@ def api_create_movement():
     if not material_id or not quantity or not movement_type:
         return jsonify({'error': 'material_id, quantity и movement_type обязательны'}), 400
 
-    material = Material.query.get(material_id)
-    if not material:
-        return jsonify({'error': 'Материал не найден'}), 404
-
     try:
         quantity = float(quantity)
     except Exception:
         return jsonify({'error': 'quantity должен быть числом'}), 400
 
-    # Проверяем достаточность количества
-    if movement_type == 'move':
-        # Для выдачи проверяем наличие на складе
-        if material.current_quantity < quantity:
-            return jsonify({
-                'error': f'Недостаточно материала на складе. Доступно: {material.current_quantity} {material.unit}, требуется: {quantity} {material.unit}'
-            }), 400
-    elif movement_type == 'return':
-        # Для возврата проверяем наличие у пользователя
-        if from_user_id:
-            user_alloc = UserMaterialAllocation.query.filter_by(user_id=from_user_id, material_id=material.id).first()
-            user_quantity = user_alloc.quantity if user_alloc else 0.0
-            if user_quantity < quantity:
-                return jsonify({
-                    'error': f'У пользователя недостаточно материала. Доступно: {user_quantity} {material.unit}, требуется: {quantity} {material.unit}'
-                }), 400
-    elif movement_type == 'writeoff':
-        # Для списания проверяем наличие на складе
-        if material.current_quantity < quantity:
-            return jsonify({
-                'error': f'Недостаточно материала на складе. Доступно: {material.current_quantity} {material.unit}, требуется: {quantity} {material.unit}'
-            }), 400
-
-    movement = WarehouseMovement(
-        material_id=material.id,
-        from_user_id=from_user_id,
-        to_user_id=to_user_id,
-        quantity=quantity,
-        movement_type=movement_type,
-        note=note,
-        created_by=current_user.userid,
-    )
-    db.session.add(movement)
-
-    # Отслеживаем, был ли материал восстановлен
-    material_restored = False
-    
-    # Обновление остатков материала
-    if movement_type == 'add':
-        # Поступление на склад - увеличиваем количество
-        material.current_quantity = (material.current_quantity or 0.0) + quantity
-        # Если материал был неактивен, восстанавливаем его
-        if not material.is_active:
-            material.is_active = True
-            material.updated_at = get_moscow_now()
-            material_restored = True
-            print(f"DEBUG: Материал '{material.name}' автоматически восстановлен при поступлении")
-    elif movement_type == 'move':
-        # Выдача со склада пользователю - уменьшаем склад, увеличиваем у пользователя
-        material.current_quantity = (material.current_quantity or 0.0) - quantity
-    elif movement_type == 'return':
-        # Возврат от пользователя на склад - увеличиваем склад, уменьшаем у пользователя
-        material.current_quantity = (material.current_quantity or 0.0) + quantity
-        # Если материал был неактивен, восстанавливаем его
-        if not material.is_active:
-            material.is_active = True
-            material.updated_at = get_moscow_now()
-            material_restored = True
-            print(f"DEBUG: Материал '{material.name}' автоматически восстановлен при возврате")
-    elif movement_type == 'writeoff':
-        # Списание - только уменьшаем склад
-        material.current_quantity = (material.current_quantity or 0.0) - quantity
-
-    # Обновляем распределение по пользователям
-    if movement_type == 'move' and to_user_id:
-        # Выдача: увеличиваем количество у получателя
-        alloc = UserMaterialAllocation.query.filter_by(user_id=to_user_id, material_id=material.id).first()
-        if not alloc:
-            alloc = UserMaterialAllocation(user_id=to_user_id, material_id=material.id, quantity=0.0)
-            db.session.add(alloc)
-        alloc.quantity = (alloc.quantity or 0.0) + quantity
-        alloc.updated_at = get_moscow_now()  # Обновляем время изменения
-        
-    elif movement_type == 'return' and from_user_id:
-        # Возврат: уменьшаем количество у возвращающего
-        alloc_from = UserMaterialAllocation.query.filter_by(user_id=from_user_id, material_id=material.id).first()
-        if alloc_from:
-            new_quantity = max(0.0, (alloc_from.quantity or 0.0) - quantity)
-            alloc_from.quantity = new_quantity
-            alloc_from.updated_at = get_moscow_now()  # Обновляем время изменения
-            
-            # Если количество стало 0, удаляем запись
-            if new_quantity == 0:
-                db.session.delete(alloc_from)
-        else:
-            # Если у пользователя нет этого материала, но он пытается его вернуть
-            # Это может быть ошибка, но мы не блокируем операцию
-            pass
-
-    # Обработка вложения
     upload = files.get('file') if hasattr(files, 'get') else None
-    if upload and upload.filename:
-        data = upload.read()
-        attachment = WarehouseAttachment(
-            movement=movement,
-            filename=upload.filename,
-            content_type=upload.mimetype,
-            data=data,
-            size_bytes=len(data),
-            uploaded_by=current_user.userid,
-        )
-        db.session.add(attachment)
+    upload_data = upload.read() if upload and upload.filename else None
 
-    db.session.commit()
+    def work():
+        # Блокировки, проверка остатков, движение, распределение и автоскрытие — одна транзакция
+        movement, material, material_restored = post_movement(
+            material_id, movement_type, quantity, current_user.userid,
+            from_user_id=from_user_id, to_user_id=to_user_id, note=note,
+        )
+        # Обработка вложения
+        if upload_data is not None:
+            db.session.add(WarehouseAttachment(
+                movement=movement,
+                filename=upload.filename,
+                content_type=upload.mimetype,
+                content=upload_data,
+                uploaded_by=current_user.userid,
+            ))
+        return movement, material, material_restored
 
-    # Проверяем, нужно ли скрыть материал (если количество стало 0 или меньше)
-    if material.current_quantity <= 0 and material.is_active:
-        material.is_active = False
-        material.updated_at = get_moscow_now()
-        db.session.commit()
-        print(f"DEBUG: Материал '{material.name}' автоматически скрыт (количество: {material.current_quantity})")
+    try:
+        movement, material, material_restored = commit_with_retry(work)
+    except StockLedgerError as e:
+        return jsonify({'error': e.message}), e.status_code
 
     # Логируем действие с деталями
     action_description = f"Создано движение: {movement_type}, материал: {material.name}, количество: {quantity}"
-    if movement_type == 'move' and to_user_id:
-        user = Users.query.get(to_user_id)
+    if movement_type == 'move' and movement.to_user_id:
+        user = Users.query.get(movement.to_user_id)
         if user:
             action_description += f", выдано пользователю: {user.login}"
-    elif movement_type == 'return' and from_user_id:
-        user = Users.query.get(from_user_id)
+    elif movement_type == 'return' and movement.from_user_id:
+        user = Users.query.get(movement.from_user_id)
         if user:
             action_description += f", возвращено от пользователя: {user.login}"
 
@@ -1261,99 +1218,349 @@ def api_create_movement():
     
     return jsonify(response_data), 201
 
+# Максимальное количество строк в одном пакетном движении
+MOVEMENTS_BATCH_MAX_LINES = 500
+
+
+@supply.route('/api/supply/movements/batch', methods=['POST'])
+@login_required
+def api_create_movements_batch():
+    """Пакетное движение по складу (например, выдача комплекта из группы материалов).
+
+    Тело JSON: {"lines": [{"material_id", "quantity", "movement_type"?,
+    "from_user_id"?, "to_user_id"?, "note"?}, ...], "movement_type"?,
+    "from_user_id"?, "to_user_id"?, "note"?}. Поля верхнего уровня служат
+    значениями по умолчанию для строк. Все строки проверяются по одному
+    снимку остатков и проводятся одной транзакцией: либо все, либо ни одной.
+    """
+    if not is_supplier_or_admin():
+        return jsonify({'error': 'Недостаточно прав'}), 403
+
+    payload = request.get_json(force=True, silent=True) or {}
+    raw_lines = payload.get('lines')
+    if not isinstance(raw_lines, list) or not raw_lines:
+        return jsonify({'error': 'Нужен непустой массив lines'}), 400
+    if len(raw_lines) > MOVEMENTS_BATCH_MAX_LINES:
+        return jsonify({'error': f'Не более {MOVEMENTS_BATCH_MAX_LINES} строк в одном пакете'}), 400
+
+    defaults = {key: payload.get(key) for key in ('movement_type', 'from_user_id', 'to_user_id', 'note')}
+    lines = []
+    errors = []
+    for index, raw in enumerate(raw_lines):
+        if not isinstance(raw, dict):
+            errors.append({'line': index, 'error': 'Строка должна быть объектом'})
+            continue
+        line = {key: raw.get(key) or defaults[key] for key in defaults}
+        line['movement_type'] = (line['movement_type'] or '').strip()
+        line['material_id'] = raw.get('material_id')
+        if not line['material_id'] or not raw.get('quantity') or not line['movement_type']:
+            errors.append({'line': index, 'error': 'material_id, quantity и movement_type обязательны'})
+            continue
+        try:
+            line['quantity'] = float(raw.get('quantity'))
+        except (TypeError, ValueError):
+            errors.append({'line': index, 'error': 'quantity должен быть числом'})
+            continue
+        lines.append(line)
+    if errors:
+        return jsonify({'error': 'Пакет движений не проведён: есть ошибки в строках', 'errors': errors}), 400
+
+    def work():
+        results = post_movements(lines, current_user.userid)
+        # Сериализуем до commit, пока объекты не истекли: иначе каждая строка
+        # ответа перечитывалась бы из БД отдельным запросом
+        db.session.flush()
+        materials = {material.id: material for _, material, _ in results}
+        return {
+            'movements': [movement.to_dict() for movement, _, _ in results],
+            'materials': [material.to_dict() for material in materials.values()],
+            'restored': sorted({material.name for _, material, restored in results if restored}),
+        }
+
+    try:
+        response_data = commit_with_retry(work)
+    except StockBatchError as e:
+        return jsonify({'error': e.message, 'errors': e.errors}), e.status_code
+    except StockLedgerError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+    # Одна сводная запись в журнале на весь пакет
+    movements = response_data['movements']
+    types = sorted({m['movement_type'] for m in movements})
+    action_description = f"Пакетное движение: {', '.join(types)}, позиций: {len(movements)}"
+    recipient_ids = {m['to_user_id'] for m in movements if m['movement_type'] == 'move' and m['to_user_id']}
+    if len(recipient_ids) == 1:
+        user = Users.query.get(next(iter(recipient_ids)))
+        if user:
+            action_description += f", выдано пользователю: {user.login}"
+    ActivityLog.log_action(
+        user_id=current_user.userid,
+        user_login=current_user.login,
+        action="Движение по складу",
+        description=action_description,
+        ip_address=request.remote_addr,
+        page_url=request.url,
+        method=request.method
+    )
+
+    restored = response_data.pop('restored')
+    if restored:
+        response_data['warning'] = f'Автоматически восстановлены ранее скрытые материалы: {", ".join(restored)}'
+    return jsonify(response_data), 201
+
+
+# Размер страницы истории движений по умолчанию и верхняя граница для ?limit=
+MOVEMENTS_PAGE_SIZE = 200
+MOVEMENTS_MAX_PAGE_SIZE = 500
+# Типы движений, которые сами по себе отражают появление материала на складе
+CREATION_MOVEMENT_TYPES = ('add', 'creation', 'create')
+
+
+def _encode_movements_cursor(created_at, row_id):
+    """Курсор страницы истории: непрозрачная строка из пары (created_at, id)."""
+    raw = f"{created_at.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def _decode_movements_cursor(cursor):
+    """Разбирает курсор истории движений; при ошибке формата бросает ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        created_at, row_id = raw.split('|', 1)
+        return datetime.fromisoformat(created_at), uuid.UUID(row_id)
+    except Exception:
+        raise ValueError('Неверный курсор')
+
+
+def _keyset_before(created_col, id_col, cursor):
+    """Условие «строго раньше курсора» в порядке (created_at DESC, id DESC)."""
+    created_at, row_id = cursor
+    return db.or_(
+        created_col < created_at,
+        db.and_(created_col == created_at, id_col < row_id),
+    )
+
+
+def _parse_movements_filters(args):
+    """Читает фильтры истории движений из query string.
+
+    Поддерживаются material_id, user_id, movement_type, date_from и date_to
+    (ГГГГ-ММ-ДД, включительно). Ошибки формата — ValueError.
+    """
+    filters = {}
+    for key in ('material_id', 'user_id'):
+        value = (args.get(key) or '').strip()
+        if value:
+            try:
+                filters[key] = uuid.UUID(value)
+            except ValueError:
+                raise ValueError(f'Неверный {key}')
+    movement_type = (args.get('movement_type') or '').strip()
+    if movement_type:
+        filters['movement_type'] = movement_type
+    for key in ('date_from', 'date_to'):
+        value = (args.get(key) or '').strip()
+        if value:
+            try:
+                filters[key] = datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError(f'Неверный формат {key}, ожидается ГГГГ-ММ-ДД')
+    return filters
+
+
+def _user_display_name(secondname, firstname, login):
+    """Отображаемое имя пользователя: «Фамилия Имя» или логин."""
+    return f"{secondname or ''} {firstname or ''}".strip() or login
+
+
 @supply.route('/api/supply/movements', methods=['GET'])
 @login_required
 def api_list_movements():
+    """История движений по складу с keyset-пагинацией.
+
+    Параметры: limit (по умолчанию 200, не более 500), cursor (из заголовка
+    X-Next-Cursor предыдущего ответа) и фильтры material_id, user_id,
+    movement_type, date_from, date_to. Тело ответа — список записей, как и
+    раньше; если есть более старые записи, курсор следующей страницы
+    отдаётся в заголовке X-Next-Cursor.
+
+    История складывается из двух потоков, упорядоченных по (created_at, id):
+    реальные движения и синтетические записи «creation» для материалов без
+    движения поступления. Каждый поток читается по индексу с тем же курсором,
+    затем потоки сливаются. Данные собираются фиксированным числом запросов,
+    не зависящим от количества строк: движения вместе с материалом и
+    пользователями (1), материалы-создания вместе с создателями (2),
+    метаданные вложений без колонки data (3). Итого не более 3 запросов.
+    """
     if not is_supplier_or_admin():
         return jsonify({'error': 'Недостаточно прав'}), 403
-    
-    # Получаем движения с информацией о материалах
-    movements = db.session.query(
-        WarehouseMovement,
-        Material.name.label('material_name')
-    ).join(
-        Material, WarehouseMovement.material_id == Material.id
-    ).order_by(
-        WarehouseMovement.created_at.desc()
-    ).limit(200).all()
-    
-    result = []
-    for movement, material_name in movements:
-        movement_dict = movement.to_dict()
-        movement_dict['material_name'] = material_name
-        
-        # Определяем пользователя в зависимости от типа движения
-        user_name = "Не указан"
-        if movement.movement_type == 'return' and movement.from_user_id:
-            # Для возврата ищем пользователя по from_user_id
-            user = Users.query.get(movement.from_user_id)
-            if user:
-                user_name = f"{user.secondname or ''} {user.firstname or ''}".strip() or user.login
-        elif movement.movement_type in ['move', 'add'] and movement.to_user_id:
-            # Для выдачи и поступления ищем пользователя по to_user_id
-            user = Users.query.get(movement.to_user_id)
-            if user:
-                user_name = f"{user.secondname or ''} {user.firstname or ''}".strip() or user.login
-        
-        movement_dict['to_user_name'] = user_name
-        
-        # Получаем вложения для этого движения
-        attachments = WarehouseAttachment.query.filter_by(movement_id=movement.id).all()
-        movement_dict['attachments'] = [{
-            'id': str(att.id),
-            'filename': att.filename,
-            'original_filename': att.filename,  # В текущей модели нет отдельного поля
-            'file_size': att.size_bytes,
-            'mime_type': att.content_type
-        } for att in attachments]
-        
-        result.append(movement_dict)
-    
-    # Добавляем в историю создания материалов как отдельные записи (если не ведётся WarehouseMovement для создания)
+
     try:
-        recent_materials = Material.query.order_by(Material.created_at.desc()).limit(200).all()
-        for mat in recent_materials:
-            # Если по материалу уже есть движение с той же датой создания типа 'add'/'creation', дубликат не добавляем
-            # (простая проверка по material_id и близкой дате)
-            duplicate = any(
-                (m.get('material_id') == mat.id and m.get('movement_type') in ('add', 'creation', 'create'))
-                for m in result
-            )
-            if duplicate:
-                continue
-            # Получаем информацию о создателе материала
-            creator_name = 'Не указан'
-            if mat.created_by:
-                creator = Users.query.get(mat.created_by)
-                if creator:
-                    creator_name = f"{creator.secondname or ''} {creator.firstname or ''}".strip() or creator.login
-            else:
-                # Для старых материалов без created_by
-                creator_name = 'Система (старая запись)'
-            
-            result.append({
-                'id': str(mat.id),
-                'material_id': mat.id,
-                'material_name': mat.name,
-                'from_user_id': None,
-                'to_user_id': None,
-                'quantity': mat.current_quantity or 0,  # Показываем текущее количество
-                'movement_type': 'creation',
-                'note': f'Создание материала (начальное количество: {mat.current_quantity or 0} {mat.unit or "шт"})',
-                'created_by': mat.created_by,
-                'created_at': mat.created_at.isoformat() if mat.created_at else None,
-                'to_user_name': creator_name,
-                'attachments': []
+        limit = int(request.args.get('limit') or MOVEMENTS_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'limit должен быть числом'}), 400
+    limit = max(1, min(limit, MOVEMENTS_MAX_PAGE_SIZE))
+
+    try:
+        cursor = request.args.get('cursor')
+        cursor = _decode_movements_cursor(cursor) if cursor else None
+        filters = _parse_movements_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    movement_type = filters.get('movement_type')
+    date_to = filters['date_to'] + timedelta(days=1) if 'date_to' in filters else None
+
+    # Поток 1: реальные движения
+    movements = []
+    if movement_type != 'creation':
+        FromUser = db.aliased(Users)
+        ToUser = db.aliased(Users)
+        query = db.session.query(
+            WarehouseMovement,
+            Material.name.label('material_name'),
+            FromUser.secondname, FromUser.firstname, FromUser.login,
+            ToUser.secondname, ToUser.firstname, ToUser.login,
+        ).join(
+            Material, WarehouseMovement.material_id == Material.id
+        ).outerjoin(
+            FromUser, WarehouseMovement.from_user_id == FromUser.userid
+        ).outerjoin(
+            ToUser, WarehouseMovement.to_user_id == ToUser.userid
+        )
+        if 'material_id' in filters:
+            query = query.filter(WarehouseMovement.material_id == filters['material_id'])
+        if 'user_id' in filters:
+            query = query.filter(db.or_(
+                WarehouseMovement.from_user_id == filters['user_id'],
+                WarehouseMovement.to_user_id == filters['user_id'],
+                WarehouseMovement.created_by == filters['user_id'],
+            ))
+        if movement_type:
+            query = query.filter(WarehouseMovement.movement_type == movement_type)
+        if 'date_from' in filters:
+            query = query.filter(WarehouseMovement.created_at >= filters['date_from'])
+        if date_to:
+            query = query.filter(WarehouseMovement.created_at < date_to)
+        if cursor:
+            query = query.filter(_keyset_before(WarehouseMovement.created_at, WarehouseMovement.id, cursor))
+        movements = query.order_by(
+            WarehouseMovement.created_at.desc(), WarehouseMovement.id.desc()
+        ).limit(limit + 1).all()
+
+    # Поток 2: создания материалов, по которым не ведётся движение поступления
+    creations = []
+    if not movement_type or movement_type == 'creation':
+        has_creation_movement = db.session.query(WarehouseMovement.id).filter(
+            WarehouseMovement.material_id == Material.id,
+            WarehouseMovement.movement_type.in_(CREATION_MOVEMENT_TYPES),
+        ).exists()
+        query = db.session.query(
+            Material,
+            Users.secondname, Users.firstname, Users.login,
+        ).outerjoin(
+            Users, Material.created_by == Users.userid
+        ).filter(~has_creation_movement)
+        if 'material_id' in filters:
+            query = query.filter(Material.id == filters['material_id'])
+        if 'user_id' in filters:
+            query = query.filter(Material.created_by == filters['user_id'])
+        if 'date_from' in filters:
+            query = query.filter(Material.created_at >= filters['date_from'])
+        if date_to:
+            query = query.filter(Material.created_at < date_to)
+        if cursor:
+            query = query.filter(_keyset_before(Material.created_at, Material.id, cursor))
+        creations = query.order_by(
+            Material.created_at.desc(), Material.id.desc()
+        ).limit(limit + 1).all()
+
+    # Слияние двух упорядоченных потоков
+    page = list(heapq.merge(
+        (('movement', row[0].created_at, row[0].id, row) for row in movements),
+        (('creation', row[0].created_at, row[0].id, row) for row in creations),
+        key=lambda item: (item[1], item[2]),
+        reverse=True,
+    ))
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = _encode_movements_cursor(page[-1][1], page[-1][2])
+
+    # Метаданные вложений для всех движений страницы разом (без загрузки самих файлов)
+    attachments_by_movement = {}
+    movement_ids = [row_id for kind, _, row_id, _ in page if kind == 'movement']
+    if movement_ids:
+        attachment_rows = db.session.query(
+            WarehouseAttachment.id,
+            WarehouseAttachment.movement_id,
+            WarehouseAttachment.filename,
+            WarehouseAttachment.size_bytes,
+            WarehouseAttachment.content_type,
+        ).filter(
+            WarehouseAttachment.movement_id.in_(movement_ids)
+        ).all()
+        for att in attachment_rows:
+            attachments_by_movement.setdefault(att.movement_id, []).append({
+                'id': str(att.id),
+                'filename': att.filename,
+                'original_filename': att.filename,  # В текущей модели нет отдельного поля
+                'file_size': att.size_bytes,
+                'mime_type': att.content_type
             })
-        # Сортируем совмещённый список по дате убыв.
-        result.sort(key=lambda x: x.get('created_at') or '', reverse=True)
-        # Обрезаем до 200 записей
-        result = result[:200]
-    except Exception:
-        # В случае ошибки не блокируем историю движений
-        pass
 
-    return jsonify(result)
+    result = []
+    for kind, _, _, row in page:
+        if kind == 'movement':
+            (movement, material_name,
+             from_secondname, from_firstname, from_login,
+             to_secondname, to_firstname, to_login) = row
+            movement_dict = movement.to_dict()
+            movement_dict['material_name'] = material_name
+
+            # Определяем пользователя в зависимости от типа движения
+            user_name = "Не указан"
+            if movement.movement_type == 'return' and movement.from_user_id and from_login:
+                # Для возврата берём пользователя по from_user_id
+                user_name = _user_display_name(from_secondname, from_firstname, from_login)
+            elif movement.movement_type in ['move', 'add'] and movement.to_user_id and to_login:
+                # Для выдачи и поступления берём пользователя по to_user_id
+                user_name = _user_display_name(to_secondname, to_firstname, to_login)
+
+            movement_dict['to_user_name'] = user_name
+            movement_dict['attachments'] = attachments_by_movement.get(movement.id, [])
+            result.append(movement_dict)
+            continue
+
+        mat, creator_secondname, creator_firstname, creator_login = row
+        # Информация о создателе материала
+        creator_name = 'Не указан'
+        if mat.created_by:
+            if creator_login:
+                creator_name = _user_display_name(creator_secondname, creator_firstname, creator_login)
+        else:
+            # Для старых материалов без created_by
+            creator_name = 'Система (старая запись)'
+
+        result.append({
+            'id': str(mat.id),
+            'material_id': mat.id,
+            'material_name': mat.name,
+            'from_user_id': None,
+            'to_user_id': None,
+            'quantity': mat.current_quantity or 0,  # Показываем текущее количество
+            'movement_type': 'creation',
+            'note': f'Создание материала (начальное количество: {mat.current_quantity or 0} {mat.unit or "шт"})',
+            'created_by': mat.created_by,
+            'created_at': mat.created_at.isoformat() if mat.created_at else None,
+            'to_user_name': creator_name,
+            'attachments': []
+        })
+
+    response = jsonify(result)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 @supply.route('/api/supply/allocations', methods=['GET'])
 @login_required
@@ -1543,29 +1750,22 @@ def api_materials_for_return():
             result.append(material_dict)
             print(f"DEBUG: Материал {material.name}, у пользователей: {total_allocated}")
         
-        # Если нет материалов через UserMaterialAllocation, попробуем через WarehouseMovement
+        # Если нет материалов через UserMaterialAllocation, пересчитываем распределения
+        # по журналу движений (от последнего снимка, с учётом возвратов)
         if not result:
-            print("DEBUG: Нет материалов в UserMaterialAllocation, проверяем WarehouseMovement")
-            # Получаем материалы, которые были выданы (movement_type = 'move')
-            # Для возврата показываем ВСЕ материалы, независимо от is_active
-            materials_with_movements = db.session.query(
-                Material,
-                db.func.sum(WarehouseMovement.quantity).label('total_moved')
-            ).join(
-                WarehouseMovement, Material.id == WarehouseMovement.material_id
-            ).filter(
-                WarehouseMovement.movement_type == 'move'
-            ).group_by(
-                Material.id
-            ).all()
+            balances, _, _ = replay(latest_snapshot())
+            allocated = {}
+            for (material_id, user_id), quantity in balances.items():
+                if user_id is not None and quantity > 0:
+                    allocated[material_id] = allocated.get(material_id, 0.0) + quantity
             
-            print(f"DEBUG: Найдено материалов через WarehouseMovement: {len(materials_with_movements)}")
+            # Для возврата показываем ВСЕ материалы, независимо от is_active
+            materials_with_movements = Material.query.filter(Material.id.in_(allocated)).all() if allocated else []
             
-            for material, total_moved in materials_with_movements:
+            for material in materials_with_movements:
                 material_dict = material.to_dict()
-                material_dict['total_allocated'] = float(total_moved or 0)
+                material_dict['total_allocated'] = allocated[material.id]
                 result.append(material_dict)
-                print(f"DEBUG: Материал {material.name}, было выдано: {total_moved}")
         
         # Если все еще нет результатов, покажем все материалы (включая неактивные)
         if not result:
@@ -1586,6 +1786,114 @@ def api_materials_for_return():
         print(f"DEBUG: Traceback: {traceback.format_exc()}")
         return jsonify({'error': str(e)}), 500
 
+def is_stock_admin():
+    """Пересчёт и снимки складского учёта доступны только администраторам"""
+    return current_user.role in ['Инженер ПТО', 'Ген.Директор']
+
+@supply.route('/api/supply/ledger/drift', methods=['GET'])
+@login_required
+def api_ledger_drift():
+    """Расхождения остатков и распределений с журналом движений"""
+    if not is_supplier_or_admin():
+        return jsonify({'error': 'Недостаточно прав'}), 403
+    
+    return jsonify(check_drift())
+
+@supply.route('/api/supply/ledger/rebuild', methods=['POST'])
+@login_required
+def api_ledger_rebuild():
+    """Пересчёт остатков и распределений по журналу движений (только для админов)"""
+    if not is_supplier_or_admin() or not is_stock_admin():
+        return jsonify({'error': 'Пересчёт складского учёта доступен только администраторам'}), 403
+    
+    try:
+        drift = rebuild(created_by=current_user.userid)
+    except Exception as e:
+        current_app.logger.exception('Ошибка пересчёта складского учёта')
+        return jsonify({'error': f'Ошибка пересчёта: {str(e)}'}), 500
+    
+    if drift:
+        ActivityLog.log_action(
+            user_id=current_user.userid,
+            user_login=current_user.login,
+            action="Пересчёт складского учёта",
+            description=f"Исправлено расхождений с журналом движений: {len(drift)}",
+            ip_address=request.remote_addr,
+            page_url=request.url,
+            method=request.method
+        )
+    return jsonify({'success': True, 'fixed': drift})
+
+@supply.route('/api/supply/ledger/snapshots', methods=['POST'])
+@login_required
+def api_ledger_snapshot():
+    """Снимок остатков. {"source": "counters"} фиксирует текущие счётчики как исходную точку"""
+    if not is_supplier_or_admin() or not is_stock_admin():
+        return jsonify({'error': 'Снимки складского учёта доступны только администраторам'}), 403
+    
+    payload = request.get_json(force=True, silent=True) or {}
+    source = payload.get('source') or 'ledger'
+    if source not in ('ledger', 'counters'):
+        return jsonify({'error': 'source должен быть ledger или counters'}), 400
+    
+    try:
+        snapshot = take_snapshot(source=source, created_by=current_user.userid)
+    except Exception as e:
+        current_app.logger.exception('Ошибка создания снимка складского учёта')
+        return jsonify({'error': f'Ошибка создания снимка: {str(e)}'}), 500
+    
+    ActivityLog.log_action(
+        user_id=current_user.userid,
+        user_login=current_user.login,
+        action="Снимок складского учёта",
+        description=f"Создан снимок остатков ({source})",
+        ip_address=request.remote_addr,
+        page_url=request.url,
+        method=request.method
+    )
+    return jsonify(snapshot.to_dict()), 201
+
+@supply.route('/api/supply/stock/as-of', methods=['GET'])
+@login_required
+def api_stock_as_of():
+    """Остатки на складе и у пользователей на дату (?date=YYYY-MM-DD[THH:MM], ?material_id=)"""
+    if not has_warehouse_read_access():
+        return jsonify({'error': 'Недостаточно прав'}), 403
+    
+    date_str = request.args.get('date', '').strip()
+    try:
+        moment = datetime.fromisoformat(date_str) if 'T' in date_str else datetime.strptime(date_str, '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'Неверный формат даты. Используйте YYYY-MM-DD'}), 400
+    if isinstance(moment, datetime) and moment.tzinfo is not None:
+        moment = moment.replace(tzinfo=None)
+    
+    material_id = request.args.get('material_id')
+    if material_id:
+        try:
+            material_id = uuid.UUID(material_id)
+        except ValueError:
+            return jsonify({'error': 'Неверный material_id'}), 400
+    
+    balances = stock_as_of(moment, material_id=material_id or None)
+    materials = {}
+    for (mat_id, user_id), quantity in balances.items():
+        entry = materials.setdefault(mat_id, {'material_id': mat_id, 'warehouse': 0.0, 'allocations': []})
+        if user_id is None:
+            entry['warehouse'] = quantity
+        else:
+            entry['allocations'].append({'user_id': user_id, 'quantity': quantity})
+    
+    if materials:
+        for row in db.session.query(Material.id, Material.name, Material.unit).filter(Material.id.in_(materials)):
+            materials[row.id]['material_name'] = row.name
+            materials[row.id]['unit'] = row.unit
+    
+    return jsonify({
+        'date': moment.isoformat(),
+        'materials': sorted(materials.values(), key=lambda m: m.get('material_name') or ''),
+    })
+
 @supply.route('/api/supply/user/<uuid:user_id>/material/<uuid:material_id>/movements', methods=['GET'])
 @login_required
 def api_user_material_movements(user_id, material_id):
@@ -1633,6 +1941,10 @@ def api_user_material_movements(user_id, material_id):
     
     return jsonify(result)
 
+# Число подсказок и время жизни кэша ответов поиска пользователей (секунды)
+USERS_SEARCH_LIMIT = 10
+USERS_SEARCH_CACHE_TTL = 30
+
 @supply.route('/api/supply/users/search', methods=['GET'])
 @login_required
 def api_search_users():
@@ -1644,35 +1956,24 @@ def api_search_users():
     if len(query) < 2:
         return jsonify([])
     
-    # Поиск по имени, фамилии, логину (используем правильные названия полей)
-    users = Users.query.filter(
-        db.or_(
-            Users.firstname.ilike(f'%{query}%'),
-            Users.secondname.ilike(f'%{query}%'),
-            Users.thirdname.ilike(f'%{query}%'),
-            Users.login.ilike(f'%{query}%'),
-            db.func.concat(Users.secondname, ' ', Users.firstname, ' ', Users.thirdname).ilike(f'%{query}%')
-        )
-    ).limit(10).all()
-    
-    result = []
-    for user in users:
-        firstname = user.firstname or ''
-        secondname = user.secondname or ''
-        thirdname = user.thirdname or ''
-        login = user.login or ''
-        
-        # Формируем полное имя
-        full_name = f"{secondname} {firstname} {thirdname}".strip()
-        if not full_name:
-            full_name = login
-        
-        result.append({
-            'id': str(user.userid),
-            'name': full_name,
-            'login': login,
-            'display': f"{full_name} ({login})"
-        })
+    # Ответы на одинаковые запросы автодополнения кэшируются ненадолго;
+    # ключ включает версию тега индекса, чтобы сброс индекса сбрасывал и ответы.
+    # Версия читается до индекса: ответ устаревшего индекса не попадёт под новую версию
+    version = '-'.join(str(value) for value in tag_versions([USER_INDEX_TAG, ALL_TAG]))
+    cache_key = f'users_search:{version}:{normalize_search_query(query)}'
+    result = cache.get(cache_key)
+    if result is None:
+        index = get_user_index()
+        result = [
+            {
+                'id': entry['id'],
+                'name': entry['name'],
+                'login': entry['login'],
+                'display': f"{entry['name']} ({entry['login']})"
+            }
+            for entry in index.search(query, limit=USERS_SEARCH_LIMIT)
+        ]
+        cache.set(cache_key, result, timeout=USERS_SEARCH_CACHE_TTL)
     
     return jsonify(result)
 
@@ -1772,58 +2073,55 @@ def api_create_receipt():
         if not file or file.filename == '':
             return jsonify({'error': 'Прикрепите накладную'}), 400
         
-        # Проверяем, существует ли уже такой материал
-        existing_material = Material.query.filter_by(name=name, unit=unit).first()
-        
-        if existing_material:
-            # Обновляем количество существующего материала
-            existing_material.current_quantity += quantity
-            material = existing_material
-        else:
-            # Создаем новый материал
-            material = Material(
-                name=name,
-                unit=unit,
-                current_quantity=quantity,
-                min_quantity=0,
-                description='Поступление на склад',
-                created_by=current_user.userid
-            )
-            db.session.add(material)
-            db.session.flush()  # Получаем ID
-        
         # Получаем имя файла для записи в движение
         filename = secure_filename(file.filename) if file else 'Без файла'
+        # Читаем файл в память для сохранения в хранилище вложений
+        file.seek(0)  # Возвращаемся к началу файла
+        file_data = file.read()
         
-        # Создаем движение поступления
-        movement = WarehouseMovement(
-            material_id=material.id,
-            movement_type='add',
-            quantity=quantity,
-            to_user_id=current_user.userid,
-            note=f'Поступление на склад. Накладная: {filename}',
-            created_by=current_user.userid
-        )
-        db.session.add(movement)
-        db.session.flush()
-        
-        # Создаем вложение с накладной
-        if file:
-            # Читаем файл в память для хранения в БД
-            file.seek(0)  # Возвращаемся к началу файла
-            file_data = file.read()
+        def work():
+            # Проверяем, существует ли уже такой материал
+            existing_material = Material.query.filter_by(name=name, unit=unit).first()
+            
+            if existing_material:
+                # Обновляем количество существующего материала
+                existing_material.current_quantity += quantity
+                material = existing_material
+            else:
+                # Создаем новый материал
+                material = Material(
+                    name=name,
+                    unit=unit,
+                    current_quantity=quantity,
+                    min_quantity=0,
+                    description='Поступление на склад',
+                    created_by=current_user.userid
+                )
+                db.session.add(material)
+                db.session.flush()  # Получаем ID
+            
+            # Создаем движение поступления
+            movement = WarehouseMovement(
+                material_id=material.id,
+                movement_type='add',
+                quantity=quantity,
+                to_user_id=current_user.userid,
+                note=f'Поступление на склад. Накладная: {filename}',
+                created_by=current_user.userid
+            )
+            db.session.add(movement)
+            db.session.flush()
             
-            attachment = WarehouseAttachment(
+            # Создаем вложение с накладной
+            db.session.add(WarehouseAttachment(
                 movement_id=movement.id,
                 filename=filename,  # Оригинальное имя файла
                 content_type=file.content_type,
-                data=file_data,
-                size_bytes=len(file_data),
+                content=file_data,
                 uploaded_by=current_user.userid
-            )
-            db.session.add(attachment)
+            ))
         
-        db.session.commit()
+        commit_with_retry(work)
         
         # Логируем действие
         ActivityLog.log_action(
@@ -1838,6 +2136,8 @@ def api_create_receipt():
         
         return jsonify({'success': True, 'message': 'Поступление успешно проведено'})
         
+    except StockLedgerError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         db.session.rollback()
         print(f"Ошибка создания поступления: {e}")
@@ -1855,7 +2155,7 @@ def api_download_attachment(movement_id, attachment_id):
     if not att:
         flash('Вложение не найдено', 'error')
         return redirect(url_for('supply.warehouse_view'))
-    return send_file(BytesIO(att.data), mimetype=att.content_type or 'application/octet-stream', as_attachment=True, download_name=att.filename)
+    return send_attachment(att, as_attachment=True)
 
 @supply.route('/api/supply/movements/<uuid:movement_id>/attachments/<uuid:attachment_id>/view', methods=['GET'])
 @login_required
@@ -1868,29 +2168,8 @@ def api_view_attachment(movement_id, attachment_id):
     if not att:
         return jsonify({'error': 'Вложение не найдено'}), 404
     
-    # Определяем, можно ли отобразить файл в браузере
-    viewable_types = [
-        'image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp',
-        'application/pdf',
-        'text/plain', 'text/html', 'text/css', 'text/javascript',
-        'application/json', 'application/xml', 'text/xml'
-    ]
-    
-    if att.content_type in viewable_types:
-        # Отправляем файл для просмотра в браузере
-        return send_file(
-            BytesIO(att.data), 
-            mimetype=att.content_type or 'application/octet-stream', 
-            as_attachment=False
-        )
-    else:
-        # Для неподдерживаемых типов файлов предлагаем скачать
-        return send_file(
-            BytesIO(att.data), 
-            mimetype=att.content_type or 'application/octet-stream', 
-            as_attachment=True, 
-            download_name=att.filename
-        )
+    # Поддерживаемые браузером типы показываем, остальные предлагаем скачать
+    return send_attachment_for_view(att)
 
 @supply.route('/api/supply/equipment', methods=['GET'])
 @login_required
@@ -0,0 +1,263 @@
+"""
+Помесячное хранение журнала действий: секции, архив и срок хранения
+
+Каждая запись activity_logs относится к секции-месяцу (колонка
+partition_month = ГГГГММ, индекс (partition_month, created_at)):
+- запросы с фильтром по дате ограничиваются секциями, которые задевает
+  период (partition_filter), и не просматривают остальную таблицу;
+- ежедневная задача планировщика переносит месяцы старше
+  ACTIVITY_LOG_RETENTION_MONTHS в сжатые CSV-файлы каталога
+  ACTIVITY_LOG_ARCHIVE_PATH и удаляет их из таблицы;
+- записи, сделанные до появления секций, размечаются командой
+  `flask activity-log backfill` (и понемногу — той же задачей); до разметки
+  фильтр по периоду находит их по created_at.
+
+Архив месяца пишется целиком во временный файл и переименовывается, и
+только после этого строки удаляются: прерванный перенос повторяется заново.
+"""
+import csv
+import gzip
+import io
+import os
+import tempfile
+from datetime import timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, or_
+
+from app.extensions import db
+from app.models.activity_log import ActivityLog, month_key
+from app.models.settings import SystemSetting
+from app.utils.activity_writer import register_actions
+from app.utils.timezone_utils import get_moscow_now
+
+# Сколько месяцев журнал хранится в таблице (текущий месяц включительно)
+DEFAULT_RETENTION_MONTHS = 6
+# Размер пачки при чтении, удалении и разметке
+ARCHIVE_BATCH_SIZE = 5000
+# Сколько старых записей размечать за один запуск задачи
+BACKFILL_PER_RUN = 50000
+# Отметка о заполнении справочника действий по уже записанному журналу
+ACTIONS_FILLED_SETTING = 'activity_actions_filled_at'
+
+ARCHIVE_COLUMNS = (
+    'id', 'user_id', 'user_login', 'action', 'description', 'ip_address',
+    'user_agent', 'page_url', 'method', 'status_code', 'created_at',
+)
+
+
+def add_months(key, months):
+    index = (key // 100) * 12 + (key % 100 - 1) + months
+    return (index // 12) * 100 + index % 12 + 1
+
+
+def partition_filter(start=None, end=None):
+    """Условия на период [start, end): секции месяцев плюс точные границы.
+
+    Записи, ещё не размеченные по секциям (partition_month IS NULL), в период
+    попадают по created_at, пока их не разметит backfill.
+    """
+    criteria = []
+    months = []
+    if start is not None:
+        months.append(ActivityLog.partition_month >= month_key(start))
+        criteria.append(ActivityLog.created_at >= start)
+    if end is not None:
+        # end не входит в период: последняя секция — месяц момента перед end
+        months.append(ActivityLog.partition_month <= month_key(end - timedelta(microseconds=1)))
+        criteria.append(ActivityLog.created_at < end)
+    if months:
+        criteria.insert(0, or_(ActivityLog.partition_month.is_(None), and_(*months)))
+    return criteria
+
+
+def archive_root():
+    return current_app.config.get('ACTIVITY_LOG_ARCHIVE_PATH') or os.path.join(
+        current_app.instance_path, 'activity_archive'
+    )
+
+
+def backfill_partitions(batch_size=ARCHIVE_BATCH_SIZE, limit=None):
+    """Проставляет partition_month записям без секции. Возвращает их число."""
+    table = ActivityLog.__table__
+    done = 0
+    while limit is None or done < limit:
+        size = batch_size if limit is None else min(batch_size, limit - done)
+        rows = db.session.execute(
+            db.select(table.c.id, table.c.created_at)
+            .where(table.c.partition_month.is_(None))
+            .limit(size)
+        ).all()
+        if not rows:
+            break
+        db.session.execute(
+            table.update().where(table.c.id == db.bindparam('row_id')),
+            [{'row_id': row.id, 'partition_month': month_key(row.created_at)} for row in rows],
+        )
+        db.session.commit()
+        done += len(rows)
+    return done
+
+
+def expired_months(retention_months):
+    """Секции старше срока хранения, которые ещё есть в таблице."""
+    oldest_kept = add_months(month_key(get_moscow_now()), -(retention_months - 1))
+    return [
+        key for (key,) in db.session.query(ActivityLog.partition_month)
+        .filter(ActivityLog.partition_month < oldest_kept)
+        .distinct()
+        .order_by(ActivityLog.partition_month)
+    ]
+
+
+def archive_path(key):
+    return os.path.join(archive_root(), f'activity_logs_{key}.csv.gz')
+
+
+def _write_archive(key, path):
+    """Выгружает секцию в gzip CSV потоком; возвращает число строк."""
+    table = ActivityLog.__table__
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    written = 0
+    try:
+        with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as compressed, \
+                io.TextIOWrapper(compressed, encoding='utf-8', newline='') as text:
+            # Месяц, уже архивированный ранее (повторный перенос), дописывается в тот же файл
+            if os.path.exists(path):
+                with gzip.open(path, 'rt', encoding='utf-8', newline='') as previous:
+                    for line in previous:
+                        text.write(line)
+            else:
+                csv.writer(text).writerow(ARCHIVE_COLUMNS)
+            writer = csv.writer(text)
+            result = db.session.execute(
+                db.select(*(table.c[column] for column in ARCHIVE_COLUMNS))
+                .where(table.c.partition_month == key)
+                .order_by(table.c.created_at, table.c.id)
+                .execution_options(yield_per=ARCHIVE_BATCH_SIZE)
+            )
+            for row in result:
+                writer.writerow(row)
+                written += 1
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return written
+
+
+def _delete_partition(key):
+    table = ActivityLog.__table__
+    deleted = 0
+    while True:
+        ids = db.session.execute(
+            db.select(table.c.id).where(table.c.partition_month == key).limit(ARCHIVE_BATCH_SIZE)
+        ).scalars().all()
+        if not ids:
+            return deleted
+        db.session.execute(table.delete().where(table.c.id.in_(ids)))
+        db.session.commit()
+        deleted += len(ids)
+
+
+def archive_partition(key):
+    """Переносит секцию месяца key в архивный файл. Возвращает число строк."""
+    path = archive_path(key)
+    written = _write_archive(key, path)
+    db.session.rollback()
+    _delete_partition(key)
+    return written
+
+
+def _try_lock(lock_file):
+    """Неблокирующая эксклюзивная блокировка файла; False, если файл уже занят."""
+    # fcntl есть только в Unix, на Windows — msvcrt (запуск для разработки)
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def _unlock(lock_file):
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        return
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def fill_actions():
+    """Вносит в справочник activity_actions все действия журнала. Возвращает их число.
+
+    Справочник пополняется при записи журнала только новыми названиями, поэтому
+    после развёртывания он однократно заполняется по таблице (по первому
+    обращению к фильтру действий или командой `flask activity-log actions`).
+    """
+    names = set(db.session.execute(db.select(ActivityLog.action).distinct()).scalars())
+    with db.engine.begin() as connection:
+        if names:
+            register_actions(connection, names)
+    SystemSetting.set(ACTIONS_FILLED_SETTING, get_moscow_now().isoformat())
+    return len(names)
+
+
+def apply_retention(retention_months=None, backfill_limit=BACKFILL_PER_RUN):
+    """Архивирует секции старше срока хранения: {месяц: число строк}.
+
+    Одновременно работает только один процесс (файловая блокировка в
+    каталоге архива); остальные сразу возвращают пустой результат.
+    """
+    if retention_months is None:
+        retention_months = current_app.config.get('ACTIVITY_LOG_RETENTION_MONTHS', DEFAULT_RETENTION_MONTHS)
+    os.makedirs(archive_root(), exist_ok=True)
+    with open(os.path.join(archive_root(), '.lock'), 'w') as lock_file:
+        if not _try_lock(lock_file):
+            return {}
+        try:
+            backfill_partitions(limit=backfill_limit)
+            return {key: archive_partition(key) for key in expired_months(retention_months)}
+        finally:
+            _unlock(lock_file)
+
+
+activity_log_cli = AppGroup('activity-log', help='Хранение журнала действий')
+
+
+@activity_log_cli.command('backfill')
+@click.option('--batch-size', default=ARCHIVE_BATCH_SIZE, show_default=True, help='Записей в одной транзакции')
+def backfill_command(batch_size):
+    """Разметка старых записей по секциям-месяцам."""
+    click.echo(f'Размечено записей: {backfill_partitions(batch_size=batch_size)}')
+
+
+@activity_log_cli.command('actions')
+def actions_command():
+    """Заполнение справочника действий по уже записанному журналу."""
+    click.echo(f'Названий действий в журнале: {fill_actions()}')
+
+
+@activity_log_cli.command('archive')
+@click.option('--retention-months', type=int, default=None, help='Сколько месяцев оставить в таблице')
+def archive_command(retention_months):
+    """Перенос месяцев старше срока хранения в архив."""
+    archived = apply_retention(retention_months, backfill_limit=None)
+    for key, count in archived.items():
+        click.echo(f'{key}: перенесено {count} записей в {archive_path(key)}')
+    if not archived:
+        click.echo('Нет секций для архивации')
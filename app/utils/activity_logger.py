@@ -3,6 +3,18 @@ from flask import request, current_app
 from flask_login import current_user
 from app.models.activity_log import ActivityLog
 
+
+def _request_fields():
+    """Пользователь и параметры текущего запроса для ActivityLog.log_action"""
+    authenticated = current_user.is_authenticated
+    return {
+        'user_id': current_user.userid if authenticated else None,
+        'user_login': current_user.login if authenticated else None,
+        'ip_address': request.remote_addr,
+        'page_url': request.url,
+        'method': request.method,
+    }
+
 def log_activity(action="", description=""):
     """Декоратор для логирования действий пользователей"""
     def decorator(f):
@@ -14,10 +26,9 @@ def log_activity(action="", description=""):
             # Логируем действие
             try:
                 ActivityLog.log_action(
-                    user=current_user if current_user.is_authenticated else None,
                     action=action,
                     description=description,
-                    request=request
+                    **_request_fields()
                 )
             except Exception as e:
                 # Не прерываем выполнение функции из-за ошибки логирования
@@ -38,11 +49,11 @@ def log_page_view(page_name=""):
             # Логируем просмотр страницы
             try:
                 user_info = current_user.login if current_user.is_authenticated else "Неавторизованный пользователь"
+                # Повторные просмотры сворачиваются в почасовые счётчики (activity_policy)
                 ActivityLog.log_action(
-                    user=current_user if current_user.is_authenticated else None,
                     action="Просмотр страницы",
                     description=f"Пользователь {user_info} просмотрел страницу: {page_name}",
-                    request=request
+                    **_request_fields()
                 )
             except Exception as e:
                 current_app.logger.error(f"Ошибка логирования просмотра страницы: {e}")
@@ -68,10 +79,9 @@ def log_user_action(action="", description_template=""):
                 )
                 
                 ActivityLog.log_action(
-                    user=current_user if current_user.is_authenticated else None,
                     action=action,
                     description=description,
-                    request=request
+                    **_request_fields()
                 )
             except Exception as e:
                 current_app.logger.error(f"Ошибка логирования действия пользователя: {e}")
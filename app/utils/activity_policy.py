@@ -0,0 +1,68 @@
+"""
+Правила записи в журнал действий
+
+Изменения данных (движения, удаления, входы) пишутся в activity_logs полностью,
+а повторяющиеся просмотры страниц не несут ценности по отдельности: они
+сворачиваются в счётчики ActivityLogRollup «пользователь — действие —
+страница — час».
+
+Правила проверяются по порядку, применяется первое подошедшее:
+- action — точное название действия;
+- action_prefix — начало названия действия;
+- methods — HTTP-методы (None — любые);
+- mode — 'full' (отдельная запись), 'rollup' (счётчик) или 'drop' (не писать);
+- sample_rate — для 'rollup': доля просмотров, которые дополнительно
+  пишутся отдельной записью (0 — только счётчик).
+Если ни одно правило не подошло, действие пишется полностью.
+
+Правила задаются настройкой ACTIVITY_LOG_RULES; None — DEFAULT_RULES.
+"""
+import random
+
+from flask import current_app, has_app_context
+
+MODE_FULL = 'full'
+MODE_ROLLUP = 'rollup'
+MODE_DROP = 'drop'
+
+DEFAULT_RULES = [
+    # Обращения к самому журналу важны для аудита
+    {'action': 'Просмотр журнала действий', 'mode': MODE_FULL},
+    {'action_prefix': 'Просмотр', 'methods': ('GET', 'HEAD'), 'mode': MODE_ROLLUP, 'sample_rate': 0.0},
+]
+
+
+def current_rules():
+    if has_app_context():
+        rules = current_app.config.get('ACTIVITY_LOG_RULES')
+        if rules is not None:
+            return rules
+    return DEFAULT_RULES
+
+
+def match_rule(action, method, rules=None):
+    """Первое правило, подходящее под действие и метод, или None."""
+    action = action or ''
+    method = (method or '').upper()
+    for rule in current_rules() if rules is None else rules:
+        if 'action' in rule and action != rule['action']:
+            continue
+        if 'action_prefix' in rule and not action.startswith(rule['action_prefix']):
+            continue
+        methods = rule.get('methods')
+        if methods is not None and method not in methods:
+            continue
+        return rule
+    return None
+
+
+def apply_policy(action, method, rules=None):
+    """(mode, keep_detail): как учесть действие и писать ли отдельную запись."""
+    rule = match_rule(action, method, rules)
+    mode = rule['mode'] if rule else MODE_FULL
+    if mode == MODE_FULL:
+        return mode, True
+    if mode == MODE_ROLLUP:
+        sample_rate = rule.get('sample_rate', 0.0)
+        return mode, sample_rate > 0 and random.random() < sample_rate
+    return mode, False
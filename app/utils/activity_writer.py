@@ -0,0 +1,285 @@
+"""
+Фоновая запись журнала действий (activity_logs)
+
+ActivityLog.log_action вызывается почти на каждом просмотре страницы. Чтобы
+запрос не ждал отдельной транзакции, запись только кладётся в ограниченную
+очередь процесса, а фоновый поток пишет накопленное одним INSERT с пакетом
+параметров (executemany):
+- пакет сбрасывается, когда набралось ACTIVITY_LOG_BATCH_SIZE записей или
+  прошло ACTIVITY_LOG_FLUSH_INTERVAL_MS с первой записи пакета;
+- при переполнении очереди запрос ждёт не дольше
+  ACTIVITY_LOG_ENQUEUE_TIMEOUT_MS, после чего запись отбрасывается; число
+  отброшенных записей попадает в журнал отдельной строкой при следующей записи;
+- если пакет не записался, записи пишутся по одной и отбрасываются только
+  те, что не записываются сами по себе;
+- при завершении процесса (atexit) очередь дописывается.
+
+Просмотры, которые правила app/utils/activity_policy.py сворачивают в счётчики,
+идут через ту же очередь: пакет суммируется по ключу «час — пользователь —
+действие — страница» и прибавляется к activity_log_rollups одним upsert.
+
+ACTIVITY_LOG_ASYNC = False (и работа без init_app, например в скриптах)
+включает синхронную запись.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.extensions import db
+from app.models.activity_log import ActivityAction, ActivityLog, ActivityLogRollup
+from app.utils.timezone_utils import get_moscow_now
+
+logger = logging.getLogger(__name__)
+
+# Значения по умолчанию (переопределяются конфигурацией приложения)
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_FLUSH_INTERVAL_MS = 500
+DEFAULT_ENQUEUE_TIMEOUT_MS = 50
+# Сколько ждать дозаписи очереди при завершении процесса
+SHUTDOWN_TIMEOUT = 10
+
+DROPPED_ACTION = 'Потеря записей журнала'
+
+
+class ActivityLogWriter:
+    """Очередь записей журнала и поток, пишущий их пакетами."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('ACTIVITY_LOG_ASYNC', True)
+        self.batch_size = app.config.get('ACTIVITY_LOG_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+        self.flush_interval = app.config.get('ACTIVITY_LOG_FLUSH_INTERVAL_MS', DEFAULT_FLUSH_INTERVAL_MS) / 1000
+        self.enqueue_timeout = app.config.get('ACTIVITY_LOG_ENQUEUE_TIMEOUT_MS', DEFAULT_ENQUEUE_TIMEOUT_MS) / 1000
+        self._queue = queue.Queue(maxsize=app.config.get('ACTIVITY_LOG_QUEUE_SIZE', DEFAULT_QUEUE_SIZE))
+        atexit.register(self.stop)
+
+    def enqueue(self, row, rollup=False):
+        """Ставит запись (словарь колонок activity_logs) в очередь.
+
+        rollup=True — запись учитывается только в почасовом счётчике.
+        Возвращает False, если запись отброшена из-за переполнения очереди.
+        """
+        if not self.enabled:
+            write_batch([(rollup, row)])
+            return True
+        self._ensure_started()
+        try:
+            self._queue.put((rollup, row), timeout=self.enqueue_timeout)
+            return True
+        except queue.Full:
+            with self._dropped_lock:
+                self._dropped += 1
+            return False
+
+    def _ensure_started(self):
+        # Поток не переживает fork: в каждом процессе gunicorn он запускается заново
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='activity-log-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _take_dropped(self):
+        with self._dropped_lock:
+            dropped, self._dropped = self._dropped, 0
+        return dropped
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+            except queue.Empty:
+                pass
+            deadline = time.monotonic() + self.flush_interval
+            while batch and len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stop.is_set():
+                    # При остановке дочитываем очередь без ожидания
+                    try:
+                        batch.append(self._queue.get_nowait())
+                        continue
+                    except queue.Empty:
+                        break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            dropped = self._take_dropped()
+            if dropped:
+                batch.append((False, dropped_row(dropped)))
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        with self.app.app_context():
+            try:
+                write_batch(batch)
+                return
+            except Exception:
+                if len(batch) == 1:
+                    logger.exception('Ошибка записи в журнал действий')
+                    return
+                logger.exception('Ошибка записи пакета из %s записей журнала действий, запись по одной', len(batch))
+            # Одна ошибочная запись (например, слишком длинное значение) не
+            # должна терять весь пакет: пишем по одной и отбрасываем только ошибочные
+            failed = 0
+            for entry in batch:
+                try:
+                    write_batch([entry])
+                except Exception:
+                    failed += 1
+                    logger.warning('Запись журнала действий отброшена: %r', entry[1], exc_info=True)
+            if failed:
+                logger.error('Отброшено записей журнала действий: %s из %s', failed, len(batch))
+
+    def stop(self, timeout=SHUTDOWN_TIMEOUT):
+        """Дописывает очередь и останавливает поток текущего процесса."""
+        thread = self._thread
+        if thread is None or self._pid != os.getpid() or not thread.is_alive():
+            return
+        self._stop.set()
+        thread.join(timeout)
+
+
+def write_batch(batch):
+    """Пишет пакет (rollup, row) в отдельной транзакции.
+
+    Отдельные записи вставляются одним INSERT с пакетом параметров, счётчики
+    суммируются в памяти и прибавляются одним upsert.
+    """
+    rows = [row for rollup, row in batch if not rollup]
+    rollups = rollup_rows(row for rollup, row in batch if rollup)
+    new_actions = {row['action'] for row in rows} - _known_actions
+    with db.engine.begin() as connection:
+        if rows:
+            connection.execute(ActivityLog.__table__.insert(), rows)
+        if new_actions:
+            register_actions(connection, new_actions)
+        if rollups:
+            upsert_rollups(connection, rollups)
+    _known_actions.update(new_actions)
+
+
+# Названия действий, уже внесённые в справочник activity_actions этим процессом
+_known_actions = set()
+
+
+def register_actions(connection, names):
+    """Добавляет в справочник activity_actions отсутствующие названия."""
+    table = ActivityAction.__table__
+    now = get_moscow_now()
+    values = [{'name': name[:100], 'first_seen': now} for name in sorted(names)]
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(connection.dialect.name)
+    if dialect is not None:
+        connection.execute(dialect.insert(table).on_conflict_do_nothing(index_elements=['name']), values)
+        return
+    existing = set(connection.execute(
+        db.select(table.c.name).where(table.c.name.in_([value['name'] for value in values]))
+    ).scalars())
+    missing = [value for value in values if value['name'] not in existing]
+    if missing:
+        connection.execute(table.insert(), missing)
+
+
+def rollup_rows(rows):
+    """Суммирует записи по ключу (час, логин, действие, страница)."""
+    counters = OrderedDict()
+    for row in rows:
+        created_at = row['created_at']
+        key = (
+            created_at.replace(minute=0, second=0, microsecond=0),
+            row['user_login'],
+            row['action'],
+            (urlsplit(row['page_url']).path if row['page_url'] else '')[:500],
+        )
+        counter = counters.get(key)
+        if counter is None:
+            counters[key] = {
+                'hour': key[0],
+                'user_id': row['user_id'],
+                'user_login': key[1],
+                'action': key[2],
+                'page': key[3],
+                'count': 1,
+                'first_seen': created_at,
+                'last_seen': created_at,
+            }
+        else:
+            counter['count'] += 1
+            counter['first_seen'] = min(counter['first_seen'], created_at)
+            counter['last_seen'] = max(counter['last_seen'], created_at)
+    return list(counters.values())
+
+
+ROLLUP_KEY = ('hour', 'user_login', 'action', 'page')
+
+
+def upsert_rollups(connection, rollups):
+    """Прибавляет счётчики пакета к activity_log_rollups."""
+    table = ActivityLogRollup.__table__
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(connection.dialect.name)
+    if dialect is not None:
+        statement = dialect.insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(ROLLUP_KEY),
+            set_={
+                'count': table.c.count + statement.excluded.count,
+                'last_seen': statement.excluded.last_seen,
+            },
+        )
+        connection.execute(statement, rollups)
+        return
+    # Прочие СУБД: обновление, а для новых ключей — вставка
+    for rollup in rollups:
+        updated = connection.execute(
+            table.update()
+            .where(*(table.c[column] == rollup[column] for column in ROLLUP_KEY))
+            .values(count=table.c.count + rollup['count'], last_seen=rollup['last_seen'])
+        )
+        if not updated.rowcount:
+            connection.execute(table.insert(), [rollup])
+
+
+def dropped_row(count):
+    return {
+        'user_id': None,
+        'user_login': 'system',
+        'action': DROPPED_ACTION,
+        'description': f'Очередь журнала действий переполнена, пропущено записей: {count}',
+        'ip_address': None,
+        'user_agent': None,
+        'page_url': None,
+        'method': None,
+        'status_code': None,
+        'created_at': get_moscow_now(),
+    }
+
+
+activity_log_writer = ActivityLogWriter()
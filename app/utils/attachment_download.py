@@ -0,0 +1,68 @@
+"""
+Отдача файлов-вложений клиенту
+
+Общий помощник для всех маршрутов просмотра и скачивания вложений:
+- файл из хранилища отдаётся потоком по частям (без чтения целиком в память);
+- поддерживаются Range-запросы (докачка, перемотка PDF/видео);
+- ETag строится по id вложения: содержимое вложения не меняется, поэтому
+  повторный запрос с If-None-Match получает 304 без тела;
+- ответы по id вложения кэшируются браузером надолго (private, immutable).
+"""
+from flask import send_file
+
+from app.utils.blob_store import get_blob_store
+
+# Срок кэширования неизменяемых вложений в браузере (год)
+ATTACHMENT_MAX_AGE = 365 * 24 * 3600
+
+# Типы, которые браузер может показать сам; остальные отдаются на скачивание
+VIEWABLE_TYPES = {
+    'image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp',
+    'application/pdf',
+    'text/plain', 'text/html', 'text/css', 'text/javascript',
+    'application/json', 'application/xml', 'text/xml',
+}
+
+
+def send_attachment(attachment, as_attachment=False, download_name=None, immutable=True):
+    """Ответ с содержимым вложения (WarehouseAttachment, MaterialAttachment, ElementAttachment).
+
+    immutable=False — для адресов вроде «последний файл элемента», содержимое
+    которых может смениться: браузер кэширует ответ, но каждый раз
+    перепроверяет его по ETag.
+    """
+    store = get_blob_store()
+    if attachment.sha256 and hasattr(store, 'path'):
+        # Путь к файлу даёт send_file размер и потоковую отдачу с Range
+        source = store.path(attachment.sha256)
+    else:
+        source = attachment.open_content()
+
+    response = send_file(
+        source,
+        mimetype=attachment.content_type or 'application/octet-stream',
+        as_attachment=as_attachment,
+        download_name=download_name or attachment.filename,
+        conditional=True,
+        etag=f'att-{attachment.id}',
+        last_modified=attachment.uploaded_at,
+        max_age=ATTACHMENT_MAX_AGE if immutable else 0,
+    )
+    # Вложения доступны только после входа: общие прокси их не кэшируют
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if immutable:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def send_attachment_for_view(attachment, download_name=None, immutable=True):
+    """Показ в браузере для поддерживаемых типов, иначе скачивание."""
+    return send_attachment(
+        attachment,
+        as_attachment=attachment.content_type not in VIEWABLE_TYPES,
+        download_name=download_name,
+        immutable=immutable,
+    )
@@ -0,0 +1,195 @@
+"""
+Хранилище содержимого вложений вне базы данных
+
+Файлы вложений (WarehouseAttachment, MaterialAttachment, ElementAttachment)
+хранятся в хранилище, адресуемом по SHA-256 содержимого: одинаковые файлы
+сохраняются один раз, в БД остаются метаданные и хэш (колонка sha256).
+Колонка data оставлена для записей, ещё не перенесённых командой
+`flask blobs migrate`, и загружается только по обращению (deferred).
+
+Хранилище выбирается настройкой BLOB_STORE_BACKEND (по умолчанию 'local' —
+файловая система в каталоге BLOB_STORE_PATH). Новые реализации регистрируются
+в BLOB_STORE_BACKENDS.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from io import BytesIO
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from app.extensions import db
+
+# Сколько записей переносить за одну транзакцию
+MIGRATE_BATCH_SIZE = 50
+# Файлы моложе этого возраста не удаляются при очистке: их запись в БД может
+# быть ещё не зафиксирована
+GC_GRACE_SECONDS = 3600
+
+
+class LocalBlobStore:
+    """Файловое хранилище: <root>/<ab>/<cd>/<sha256>."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def put(self, data):
+        """Сохраняет содержимое и возвращает его SHA-256; повторная запись не выполняется."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Пишем во временный файл и переименовываем: читатели не увидят
+        # недописанный файл, а параллельная запись того же содержимого безопасна
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest
+
+    def open(self, digest):
+        return open(self.path(digest), 'rb')
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def delete(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+    def iter_digests(self):
+        """(digest, mtime) всех сохранённых файлов."""
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith('.tmp-'):
+                    continue
+                yield filename, os.path.getmtime(os.path.join(dirpath, filename))
+
+
+BLOB_STORE_BACKENDS = {
+    'local': lambda app: LocalBlobStore(
+        app.config.get('BLOB_STORE_PATH') or os.path.join(app.instance_path, 'blobs')
+    ),
+}
+
+
+def get_blob_store():
+    """Хранилище текущего приложения (создаётся один раз на приложение)."""
+    app = current_app._get_current_object()
+    store = app.extensions.get('blob_store')
+    if store is None:
+        backend = app.config.get('BLOB_STORE_BACKEND', 'local')
+        store = app.extensions['blob_store'] = BLOB_STORE_BACKENDS[backend](app)
+    return store
+
+
+class BlobContentMixin:
+    """Содержимое вложения в хранилище blob_store.
+
+    Модель должна иметь колонки data (deferred, для неперенесённых записей),
+    sha256 и size_bytes. Содержимое можно передать в конструктор: Model(content=...).
+    """
+
+    def __init__(self, content=None, **kwargs):
+        super().__init__(**kwargs)
+        if content is not None:
+            self.store_content(content)
+
+    def store_content(self, data):
+        """Сохраняет содержимое в хранилище и заполняет sha256/size_bytes."""
+        self.sha256 = get_blob_store().put(data)
+        self.size_bytes = len(data)
+        self.data = None
+
+    def open_content(self):
+        """Файловый объект для чтения содержимого."""
+        if self.sha256:
+            return get_blob_store().open(self.sha256)
+        return BytesIO(self.data or b'')
+
+    def read_content(self):
+        with self.open_content() as stream:
+            return stream.read()
+
+
+def attachment_models():
+    from app.models.objects import ElementAttachment
+    from app.models.supply import MaterialAttachment, WarehouseAttachment
+    return [WarehouseAttachment, MaterialAttachment, ElementAttachment]
+
+
+def migrate_blobs(model, batch_size=MIGRATE_BATCH_SIZE, limit=None):
+    """Переносит содержимое записей model из колонки data в хранилище.
+
+    Каждая пачка фиксируется отдельной транзакцией, поэтому перенос можно
+    прервать и продолжить. Возвращает число перенесённых записей.
+    """
+    store = get_blob_store()
+    moved = 0
+    while limit is None or moved < limit:
+        size = batch_size if limit is None else min(batch_size, limit - moved)
+        rows = model.query.options(db.undefer(model.data)).filter(
+            model.sha256.is_(None)
+        ).order_by(model.id).limit(size).all()
+        if not rows:
+            break
+        for row in rows:
+            row.sha256 = store.put(row.data or b'')
+            row.size_bytes = len(row.data or b'')
+            row.data = None
+        db.session.commit()
+        # Освобождаем содержимое перенесённой пачки
+        db.session.expunge_all()
+        moved += len(rows)
+    return moved
+
+
+def collect_garbage(grace_seconds=GC_GRACE_SECONDS):
+    """Удаляет файлы, на которые не ссылается ни одно вложение. Возвращает их число."""
+    store = get_blob_store()
+    referenced = set()
+    for model in attachment_models():
+        referenced.update(
+            digest for (digest,) in db.session.query(model.sha256).filter(model.sha256.isnot(None)).distinct()
+        )
+    removed = 0
+    threshold = time.time() - grace_seconds
+    for digest, mtime in list(store.iter_digests()):
+        if digest not in referenced and mtime < threshold:
+            store.delete(digest)
+            removed += 1
+    return removed
+
+
+blobs_cli = AppGroup('blobs', help='Хранилище содержимого вложений')
+
+
+@blobs_cli.command('migrate')
+@click.option('--batch-size', default=MIGRATE_BATCH_SIZE, show_default=True, help='Записей в одной транзакции')
+@click.option('--limit', type=int, default=None, help='Перенести не больше указанного числа записей каждой модели')
+def migrate_command(batch_size, limit):
+    """Перенос содержимого вложений из БД в хранилище."""
+    for model in attachment_models():
+        moved = migrate_blobs(model, batch_size=batch_size, limit=limit)
+        click.echo(f'{model.__tablename__}: перенесено {moved}')
+
+
+@blobs_cli.command('gc')
+@click.option('--grace-seconds', default=GC_GRACE_SECONDS, show_default=True, help='Не удалять файлы моложе')
+def gc_command(grace_seconds):
+    """Удаление файлов, на которые не ссылается ни одно вложение."""
+    click.echo(f'Удалено файлов: {collect_garbage(grace_seconds)}')
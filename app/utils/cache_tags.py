@@ -0,0 +1,201 @@
+"""
+Сброс кэша по тегам при изменении данных
+
+Закэшированные страницы и фрагменты (cached_value) помечаются тегами тех
+данных, из которых построены:
+- object:<id> — объект и всё, что к нему относится (опоры, траншеи и их
+  выемки, отчёты, запланированные работы, элементы и их вложения...);
+- material:<id> — материал, его движения, вложения, распределения, строки
+  заявок и снимков остатков;
+- user:<id> — пользователь и строки, выданные ему (user_id, from_user_id,
+  to_user_id);
+- model:<таблица> — любая строка таблицы (для сводных страниц).
+
+У каждого тега в общем кэше хранится версия. Запись кэша хранит версии своих
+тегов на момент построения и считается устаревшей, если хоть одна из них
+сменилась. После flush сессии изменённые строки моделей app/models/objects.py,
+app/models/supply.py и пользователи переводятся в теги, а после commit версии
+этих тегов меняются — сразу во всех процессах. Массовые query.update()/delete()
+сбрасывают все записи (тег ALL_TAG): какие строки они задели, неизвестно.
+
+Поэтому сроки хранения можно делать большими (PAGE_CACHE_TIMEOUT): устаревшая
+запись не будет показана, срок только ограничивает размер кэша.
+"""
+import time
+from itertools import chain
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from app.extensions import cache
+from app.models.objects import Bracket, Checklist, Luminaire, Object, PlannedWork, Trench, ZDF
+from app.models.supply import Material, WarehouseMovement
+from app.models.users import Users
+
+TAG_NAMESPACE = 'tag'
+ALL_TAG = 'all'
+
+# Модули моделей, изменения которых сбрасывают кэш
+TAGGED_MODULES = {'app.models.objects', 'app.models.supply', 'app.models.users'}
+# Служебные колонки: их изменение не меняет показываемых данных
+IGNORED_COLUMNS = {'last_login', 'last_activity', 'is_online'}
+
+
+def object_tag(object_id):
+    return f'object:{object_id}'
+
+
+def material_tag(material_id):
+    return f'material:{material_id}'
+
+
+def user_tag(user_id):
+    return f'user:{user_id}'
+
+
+def model_tag(table_name):
+    return f'model:{table_name}'
+
+
+# Сама строка-владелец: модель -> тег по первичному ключу
+IDENTITY_TAGS = {Object: object_tag, Material: material_tag, Users: user_tag}
+# Колонки, прямо указывающие на владельца
+DIRECT_COLUMNS = {
+    'object_id': object_tag,
+    'material_id': material_tag,
+    'user_id': user_tag,
+    'from_user_id': user_tag,
+    'to_user_id': user_tag,
+}
+# Колонки, через которые владелец находится запросом:
+# колонка -> (модель родителя, колонка владельца у родителя, тег)
+PARENT_COLUMNS = {
+    'trench_id': (Trench, Trench.object_id, object_tag),
+    'checklist_id': (Checklist, Checklist.object_id, object_tag),
+    'planned_work_id': (PlannedWork, PlannedWork.object_id, object_tag),
+    'movement_id': (WarehouseMovement, WarehouseMovement.material_id, material_tag),
+}
+# Вложения элементов: element_type -> модель элемента
+ELEMENT_MODELS = {'zdf': ZDF, 'bracket': Bracket, 'luminaire': Luminaire}
+
+
+def _version_key(tag):
+    return f'{TAG_NAMESPACE}:{tag}'
+
+
+def invalidate_tags(tags):
+    """Делает устаревшими все записи кэша с любым из тегов."""
+    # Версия — момент сброса, а не счётчик: вытесненный из кэша счётчик
+    # начался бы заново и мог совпасть с версией в старой записи
+    version = time.time_ns()
+    for tag in set(tags):
+        cache.set(_version_key(tag), version, timeout=0)
+
+
+def tag_versions(tags):
+    """Текущие версии тегов в порядке tags (0 — тег ещё не сбрасывался)."""
+    return [version or 0 for version in cache.get_many(*(_version_key(tag) for tag in tags))]
+
+
+def mark_tags(session, tags):
+    """Сбросить теги после commit сессии (отменяется откатом)."""
+    session.info.setdefault('cache_tags', set()).update(tags)
+
+
+def cached_value(key, tags, compute, timeout=None):
+    """Значение из кэша, если его теги не сбрасывались, иначе compute().
+
+    Результат None не кэшируется.
+    """
+    tags = sorted({ALL_TAG, *tags})
+    entry, *versions = cache.get_many(key, *(_version_key(tag) for tag in tags))
+    versions = [version or 0 for version in versions]
+    if entry is not None and entry[0] == versions:
+        return entry[1]
+    # Версии прочитаны до построения: сброс во время построения сделает
+    # запись устаревшей
+    value = compute()
+    if value is not None:
+        cache.set(key, (versions, value), timeout=timeout)
+    return value
+
+
+def _column_values(state, column):
+    """Текущее и прежнее (если менялось) значения колонки."""
+    history = state.attrs[column].history
+    return {value for value in chain(history.added, history.unchanged, history.deleted) if value is not None}
+
+
+def _changed(state):
+    if state.deleted or state.was_deleted or state.key is None:
+        return True
+    changed = {attr.key for attr in state.attrs if attr.history.has_changes()}
+    return bool(changed - IGNORED_COLUMNS)
+
+
+def row_tags(connection, target):
+    """Теги, которые нужно сбросить после изменения строки target."""
+    model = type(target)
+    state = inspect(target)
+    tags = {model_tag(model.__tablename__)}
+    columns = set(state.mapper.columns.keys())
+
+    identity = IDENTITY_TAGS.get(model)
+    if identity is not None:
+        for value in state.mapper.primary_key_from_instance(target):
+            tags.add(identity(value))
+    for column, tag in DIRECT_COLUMNS.items():
+        if column in columns:
+            tags.update(tag(value) for value in _column_values(state, column))
+    for column, (parent, owner_column, tag) in PARENT_COLUMNS.items():
+        if column not in columns or owner_column.key in columns:
+            continue
+        parent_ids = _column_values(state, column)
+        if parent_ids:
+            owners = connection.execute(
+                select(owner_column).where(parent.id.in_(parent_ids))
+            ).scalars()
+            tags.update(tag(owner) for owner in owners)
+    if 'element_type' in columns and 'element_id' in columns:
+        element_model = ELEMENT_MODELS.get(target.element_type)
+        if element_model is not None and target.element_id is not None:
+            owner = connection.execute(
+                select(element_model.object_id).where(element_model.id == target.element_id)
+            ).scalar()
+            if owner is not None:
+                tags.add(object_tag(owner))
+    return tags
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_tags(session, flush_context):
+    tags = set()
+    connection = session.connection()
+    for target in chain(session.new, session.dirty, session.deleted):
+        if type(target).__module__ not in TAGGED_MODULES:
+            continue
+        state = inspect(target)
+        if target in session.dirty and not _changed(state):
+            continue
+        tags.update(row_tags(connection, target))
+    mark_tags(session, tags)
+
+
+def _bulk_changed(context):
+    mark_tags(context.session, [ALL_TAG])
+
+
+event.listen(Session, 'after_bulk_update', _bulk_changed)
+event.listen(Session, 'after_bulk_delete', _bulk_changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        invalidate_tags(tags)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_after_rollback(session, previous_transaction):
+    session.info.pop('cache_tags', None)
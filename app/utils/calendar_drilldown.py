@@ -0,0 +1,110 @@
+"""
+Активность по объектам за один день (страница /calendar/date/<дата>)
+
+Каждый вид записей — отчёты, ежедневные отчёты, запланированные работы,
+опоры, траншеи, выполненные пункты чек-листа — выбирается одним запросом за
+весь день по всем объектам и раскладывается по object_id в памяти. Объекты и
+пользователи (авторы, исполнители) подгружаются одним запросом каждые и
+только для объектов, в которых что-то было. Число запросов не зависит от
+числа объектов.
+
+Колонки-даты сравниваются на равенство, колонки с датой и временем —
+полуинтервалом [день, следующий день), а не func.date(колонка) == день:
+так используются индексы по created_at и completed_at.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.models.objects import Checklist, ChecklistItem, DailyReport, Object, PlannedWork, Report, Support, Trench
+from app.models.users import Users
+
+
+def day_range(column, day):
+    """Условие «значение column приходится на день day» без функций над колонкой."""
+    start = datetime.combine(day, time.min)
+    return (column >= start) & (column < start + timedelta(days=1))
+
+
+class DailyReportEntry:
+    """Ежедневный отчёт в блоке «Отчёты» (поля как у Report)."""
+
+    title = 'Ежедневный отчёт'
+    report_number = ''
+
+    def __init__(self, daily_report):
+        self.daily_report = daily_report
+        self.status = daily_report.approval_status or daily_report.status or ''
+        self.created_by = daily_report.created_by
+        self.creator = None
+
+
+def _group(rows, key=lambda row: row.object_id):
+    grouped = defaultdict(list)
+    for row in rows:
+        grouped[key(row)].append(row)
+    return grouped
+
+
+def date_activity(day):
+    """Данные для страницы дня: список словарей по объектам с активностью."""
+    reports = _group(Report.query.filter(Report.report_date == day).order_by(Report.created_at))
+    for object_id, entries in _group(
+        DailyReport.query.filter(DailyReport.report_date == day).order_by(DailyReport.created_at)
+    ).items():
+        reports[object_id].extend(DailyReportEntry(entry) for entry in entries)
+    planned_works = _group(PlannedWork.query.filter(PlannedWork.planned_date == day).order_by(PlannedWork.created_at))
+    supports = _group(Support.query.filter(day_range(Support.created_at, day)).order_by(Support.created_at))
+    trenches = _group(Trench.query.filter(day_range(Trench.created_at, day)).order_by(Trench.created_at))
+    checklist_rows = (
+        ChecklistItem.query.join(Checklist, ChecklistItem.checklist_id == Checklist.id)
+        .add_columns(Checklist.object_id)
+        .filter(ChecklistItem.is_completed.is_(True), day_range(ChecklistItem.completed_at, day))
+        .order_by(ChecklistItem.completed_at)
+        .all()
+    )
+    checklist_items = _group(checklist_rows, key=lambda row: row.object_id)
+    checklist_items = {
+        object_id: [row.ChecklistItem for row in rows] for object_id, rows in checklist_items.items()
+    }
+
+    object_ids = set(reports) | set(planned_works) | set(supports) | set(trenches) | set(checklist_items)
+    if not object_ids:
+        return []
+    objects = Object.query.filter(Object.id.in_(object_ids)).order_by(Object.name).all()
+
+    authored = [
+        *(entry for entries in reports.values() for entry in entries),
+        *(work for works in planned_works.values() for work in works),
+    ]
+    completed = [item for items in checklist_items.values() for item in items]
+    user_ids = {entry.created_by for entry in authored} | {item.completed_by for item in completed}
+    user_ids.discard(None)
+    users = {user.userid: user for user in Users.query.filter(Users.userid.in_(user_ids))} if user_ids else {}
+    for entry in authored:
+        entry.creator = users.get(entry.created_by)
+    for item in completed:
+        # Как загруженное значение: обычное присваивание пометило бы строку
+        # изменённой, и она записалась бы при следующем flush
+        set_committed_value(item, 'completed_by_user', users.get(item.completed_by))
+
+    objects_data = []
+    for obj in objects:
+        data = {
+            'object': obj,
+            'reports': reports.get(obj.id, []),
+            'planned_works': planned_works.get(obj.id, []),
+            'supports_created': supports.get(obj.id, []),
+            'trenches_created': trenches.get(obj.id, []),
+            'checklist_items_completed': checklist_items.get(obj.id, []),
+        }
+        data.update({
+            'total_reports': len(data['reports']),
+            'total_planned_works': len(data['planned_works']),
+            'total_supports_created': len(data['supports_created']),
+            'total_trenches_created': len(data['trenches_created']),
+            'total_checklist_completed': len(data['checklist_items_completed']),
+        })
+        objects_data.append(data)
+    return objects_data
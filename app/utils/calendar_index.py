@@ -0,0 +1,228 @@
+"""
+Сводка активности для календаря (таблица activity_dates)
+
+Календарь подсвечивает дни, в которые по объектам что-то происходило:
+отчёты, ежедневные отчёты, запланированные работы, новые опоры и траншеи,
+выполненные пункты чек-листа. Вместо DISTINCT по датам всех этих таблиц за
+всю историю календарь читает сводку ActivityDate «день — объект — число
+записей каждого вида» только за показываемый месяц.
+
+Сводка поддерживается событиями маппера в той же транзакции, что и запись
+строки: вставка прибавляет 1 к счётчику (день, объект), удаление вычитает,
+изменение даты, объекта или отметки выполнения переносит единицу из старой
+ячейки в новую. Массовые query.update()/delete() событий не вызывают —
+после них сводка пересобирается командой `flask calendar rebuild`. После
+первого развёртывания сводка собирается сама при первом открытии календаря
+(отметка в SystemSetting).
+"""
+from collections import Counter
+from datetime import date, datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import case, event, func, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.extensions import db
+from app.models.objects import (
+    ActivityDate, Checklist, ChecklistItem, DailyReport, Object, PlannedWork, Report, Support, Trench,
+)
+from app.models.settings import SystemSetting
+from app.utils.timezone_utils import get_moscow_now
+
+# Модель -> (счётчик в ActivityDate, атрибут с датой активности)
+ACTIVITY_KINDS = {
+    Report: ('reports_count', 'report_date'),
+    DailyReport: ('daily_reports_count', 'report_date'),
+    PlannedWork: ('planned_works_count', 'planned_date'),
+    Support: ('supports_count', 'created_at'),
+    Trench: ('trenches_count', 'created_at'),
+    ChecklistItem: ('checklist_items_count', 'completed_at'),
+}
+COUNT_COLUMNS = tuple(column for column, _ in ACTIVITY_KINDS.values())
+
+REBUILD_BATCH_SIZE = 5000
+# Отметка о сборке сводки по исходным таблицам
+REBUILT_SETTING = 'activity_dates_rebuilt_at'
+
+
+def _day(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value if isinstance(value, date) else None
+
+
+def _value(state, attribute, previous):
+    """Значение атрибута до flush (previous=True) или после."""
+    history = state.attrs[attribute].history
+    if previous and history.deleted:
+        return history.deleted[0]
+    if not previous and history.added:
+        return history.added[0]
+    values = history.unchanged or history.added
+    return values[0] if values else None
+
+
+def _cell(connection, target, previous=False):
+    """(день, объект), к которому относится строка, или None."""
+    state = inspect(target)
+    _, date_attribute = ACTIVITY_KINDS[type(target)]
+    day = _day(_value(state, date_attribute, previous))
+    if day is None:
+        return None
+    if isinstance(target, ChecklistItem):
+        if not _value(state, 'is_completed', previous):
+            return None
+        checklist_id = _value(state, 'checklist_id', previous)
+        object_id = connection.execute(
+            db.select(Checklist.object_id).where(Checklist.id == checklist_id)
+        ).scalar()
+    else:
+        object_id = _value(state, 'object_id', previous)
+    return (day, object_id) if object_id is not None else None
+
+
+def _bump(connection, cell, column, delta):
+    table = ActivityDate.__table__
+    day, object_id = cell
+    updated_count = case((table.c[column] + delta < 0, 0), else_=table.c[column] + delta)
+    new_row = {'day': day, 'object_id': object_id, **{name: 0 for name in COUNT_COLUMNS}}
+    new_row[column] = max(delta, 0)
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(connection.dialect.name)
+    if dialect is not None:
+        statement = dialect.insert(table).values(new_row)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=['day', 'object_id'], set_={column: updated_count},
+        ))
+        return
+    updated = connection.execute(
+        table.update()
+        .where(table.c.day == day, table.c.object_id == object_id)
+        .values({column: updated_count})
+    )
+    if not updated.rowcount and delta > 0:
+        connection.execute(table.insert().values(new_row))
+
+
+def _after_insert(mapper, connection, target):
+    cell = _cell(connection, target)
+    if cell is not None:
+        _bump(connection, cell, ACTIVITY_KINDS[type(target)][0], 1)
+
+
+def _after_update(mapper, connection, target):
+    old, new = _cell(connection, target, previous=True), _cell(connection, target)
+    if old == new:
+        return
+    column = ACTIVITY_KINDS[type(target)][0]
+    if old is not None:
+        _bump(connection, old, column, -1)
+    if new is not None:
+        _bump(connection, new, column, 1)
+
+
+def _after_delete(mapper, connection, target):
+    cell = _cell(connection, target, previous=True)
+    if cell is not None:
+        _bump(connection, cell, ACTIVITY_KINDS[type(target)][0], -1)
+
+
+def _remember_previous(target, value, oldvalue, initiator):
+    pass
+
+
+for _model, (_column, _date_attribute) in ACTIVITY_KINDS.items():
+    event.listen(_model, 'after_insert', _after_insert)
+    event.listen(_model, 'after_update', _after_update)
+    event.listen(_model, 'after_delete', _after_delete)
+    # Прежнее значение нужно, даже если атрибут меняют, не прочитав его
+    for _attribute in (_date_attribute, 'object_id', 'checklist_id', 'is_completed'):
+        if hasattr(_model, _attribute):
+            event.listen(getattr(_model, _attribute), 'set', _remember_previous, active_history=True)
+
+
+@event.listens_for(Object, 'after_delete')
+def _object_deleted(mapper, connection, target):
+    table = ActivityDate.__table__
+    connection.execute(table.delete().where(table.c.object_id == target.id))
+
+
+def active_days(start, end):
+    """Дни с активностью в [start, end) — список строк ГГГГ-ММ-ДД."""
+    ensure_activity_dates()
+    total = sum(getattr(ActivityDate, column) for column in COUNT_COLUMNS)
+    days = db.session.execute(
+        db.select(ActivityDate.day)
+        .where(ActivityDate.day >= start, ActivityDate.day < end)
+        .group_by(ActivityDate.day)
+        .having(func.sum(total) > 0)
+        .order_by(ActivityDate.day)
+    ).scalars()
+    return [day.isoformat() for day in days]
+
+
+def month_bounds(year, month):
+    start = date(year, month, 1)
+    end = date(year + month // 12, month % 12 + 1, 1)
+    return start, end
+
+
+# Процесс уже видел отметку о сборке и больше не читает SystemSetting
+_rebuilt = False
+
+
+def ensure_activity_dates():
+    """Собирает сводку, если она ещё ни разу не собиралась по исходным таблицам.
+
+    Сразу после развёртывания таблица пуста или содержит только записи,
+    сделанные с тех пор, поэтому сборка выполняется по отметке, а не по
+    пустоте таблицы.
+    """
+    global _rebuilt
+    if _rebuilt:
+        return
+    if SystemSetting.get(REBUILT_SETTING) is None:
+        rebuild_activity_dates()
+    _rebuilt = True
+
+
+def rebuild_activity_dates():
+    """Пересобирает сводку по исходным таблицам. Возвращает число ячеек."""
+    cells = Counter()
+    checklist_objects = dict(db.session.execute(db.select(Checklist.id, Checklist.object_id)).all())
+    for model, (column, date_attribute) in ACTIVITY_KINDS.items():
+        if model is ChecklistItem:
+            query = db.select(ChecklistItem.checklist_id, ChecklistItem.completed_at).where(
+                ChecklistItem.is_completed.is_(True)
+            )
+        else:
+            query = db.select(model.object_id, getattr(model, date_attribute))
+        result = db.session.execute(query.execution_options(yield_per=REBUILD_BATCH_SIZE))
+        for owner, value in result:
+            object_id = checklist_objects.get(owner) if model is ChecklistItem else owner
+            day = _day(value)
+            if object_id is not None and day is not None:
+                cells[(day, object_id, column)] += 1
+
+    rows = {}
+    for (day, object_id, column), count in cells.items():
+        row = rows.setdefault((day, object_id), {
+            'day': day, 'object_id': object_id, **{name: 0 for name in COUNT_COLUMNS}
+        })
+        row[column] = count
+    db.session.execute(ActivityDate.__table__.delete())
+    values = list(rows.values())
+    for offset in range(0, len(values), REBUILD_BATCH_SIZE):
+        db.session.execute(ActivityDate.__table__.insert(), values[offset:offset + REBUILD_BATCH_SIZE])
+    db.session.commit()
+    SystemSetting.set(REBUILT_SETTING, get_moscow_now().isoformat())
+    return len(values)
+
+
+calendar_cli = AppGroup('calendar', help='Сводка активности для календаря')
+
+
+@calendar_cli.command('rebuild')
+def rebuild_command():
+    """Пересборка activity_dates по отчётам, работам, опорам, траншеям и чек-листам."""
+    click.echo(f'Дней-объектов с активностью: {rebuild_activity_dates()}')
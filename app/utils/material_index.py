@@ -0,0 +1,171 @@
+"""
+Индекс названий материалов для проверки дублей (/api/supply/materials/check)
+
+Индекс хранится в памяти процесса и содержит только названия и id активных
+материалов:
+- точные названия и названия в нижнем регистре — словари;
+- похожие названия — инвертированный индекс триграмм: кандидат должен иметь
+  достаточно общих триграмм с запросом (лемма о q-граммах), после чего
+  расстояние Левенштейна считается с отсечкой по допустимому порогу.
+
+Индекс сбрасывается во всех процессах после commit, в котором материал
+создан, удалён, или у него изменились название или активность
+(app/utils/shared_index.py).
+"""
+from collections import Counter, defaultdict
+
+from app.extensions import db
+from app.models.supply import Material
+from app.utils.shared_index import SharedIndex
+
+MATERIAL_INDEX_TAG = 'index:materials'
+# Страховочный срок жизни индекса, если общий кэш недоступен
+MATERIAL_INDEX_TTL = 3600
+# Допустимое расстояние — 30% от длины более короткого названия
+SIMILARITY_RATIO = 0.3
+TRIGRAM = 3
+PAD = ' ' * (TRIGRAM - 1)
+
+
+def trigrams(text):
+    """Мультимножество триграмм строки, дополненной пробелами по краям."""
+    padded = f'{PAD}{text}{PAD}'
+    return Counter(padded[i:i + TRIGRAM] for i in range(len(padded) - TRIGRAM + 1))
+
+
+def char_masks(pattern):
+    """Битовые маски позиций каждого символа шаблона для bounded_levenshtein."""
+    masks = {}
+    for i, char in enumerate(pattern):
+        masks[char] = masks.get(char, 0) | (1 << i)
+    return masks
+
+
+def bounded_levenshtein(pattern, text, limit, masks=None):
+    """Расстояние Левенштейна или limit + 1, если оно заведомо больше limit.
+
+    Битово-параллельный алгоритм Майерса (в варианте Хюрё): столбец матрицы
+    расстояний хранится в двух целых числах, поэтому на символ text приходится
+    десяток целочисленных операций вместо цикла по символам pattern. masks —
+    результат char_masks(pattern), если шаблон проверяется многократно.
+    """
+    over = limit + 1
+    if abs(len(pattern) - len(text)) > limit:
+        return over
+    if not pattern:
+        return len(text)
+    if masks is None:
+        masks = char_masks(pattern)
+    full = (1 << len(pattern)) - 1
+    last = 1 << (len(pattern) - 1)
+    plus, minus = full, 0
+    score = len(pattern)
+    remaining = len(text)
+    for char in text:
+        eq = masks.get(char, 0)
+        xv = eq | minus
+        xh = (((eq & plus) + plus) ^ plus) | eq
+        h_plus = minus | ~(xh | plus)
+        h_minus = plus & xh
+        if h_plus & last:
+            score += 1
+        elif h_minus & last:
+            score -= 1
+        remaining -= 1
+        # Каждый оставшийся символ уменьшает расстояние не больше чем на 1
+        if score - remaining > limit:
+            return over
+        h_plus = (h_plus << 1) | 1
+        h_minus <<= 1
+        plus = (h_minus | ~(xv | h_plus)) & full
+        minus = h_plus & xv & full
+    return score if score <= limit else over
+
+
+class MaterialNameIndex:
+    """Снимок названий активных материалов с быстрым поиском похожих."""
+
+    def __init__(self, rows):
+        self.exact = {}
+        self.lower = {}
+        # Уникальные названия в нижнем регистре и id материалов с таким названием
+        self.names = []
+        self.ids_by_name = []
+        self.postings = defaultdict(list)
+
+        positions = {}
+        for material_id, name in rows:
+            self.exact.setdefault(name, material_id)
+            lowered = name.lower()
+            self.lower.setdefault(lowered, material_id)
+            if lowered not in positions:
+                positions[lowered] = len(self.names)
+                self.names.append(lowered)
+                self.ids_by_name.append([])
+            self.ids_by_name[positions[lowered]].append(material_id)
+
+        # (триграмма, k) -> названия, где триграмма встречается не меньше k раз:
+        # число общих триграмм с запросом считается сложением списков в Counter
+        for position, lowered in enumerate(self.names):
+            for gram, count in trigrams(lowered).items():
+                for k in range(1, count + 1):
+                    self.postings[gram, k].append(position)
+
+    def similar(self, name, limit=3):
+        """До limit пар (material_id, distance) с похожими названиями, ближайшие первыми."""
+        query = name.lower()
+        query_len = len(query)
+        masks = char_masks(query)
+        shared = Counter()
+        for gram, query_count in trigrams(query).items():
+            for k in range(1, query_count + 1):
+                shared.update(self.postings.get((gram, k), ()))
+
+        matches = []
+        # Кандидаты с большим числом общих триграмм проверяются первыми: когда
+        # найдено limit совпадений, порог расстояния для остальных сужается
+        worst = None
+        query_cap = int(query_len * SIMILARITY_RATIO)
+        for position, common in shared.most_common():
+            cap = query_cap if worst is None else min(query_cap, worst)
+            if common < query_len + TRIGRAM - 1 - cap * TRIGRAM:
+                # Дальше кандидаты с ещё меньшим числом общих триграмм
+                break
+            candidate = self.names[position]
+            max_distance = int(min(query_len, len(candidate)) * SIMILARITY_RATIO)
+            if worst is not None:
+                max_distance = min(max_distance, worst)
+            if max_distance == 0:
+                continue
+            # Каждая правка разрушает не больше TRIGRAM триграмм
+            if common < max(query_len, len(candidate)) + TRIGRAM - 1 - max_distance * TRIGRAM:
+                continue
+            distance = bounded_levenshtein(query, candidate, max_distance, masks)
+            if 0 < distance <= max_distance:
+                matches.extend((distance, candidate, material_id) for material_id in self.ids_by_name[position])
+                if len(matches) >= limit:
+                    matches.sort(key=lambda m: (m[0], m[1]))
+                    worst = matches[limit - 1][0]
+
+        matches.sort(key=lambda m: (m[0], m[1]))
+        return [(material_id, distance) for distance, _, material_id in matches[:limit]]
+
+
+def _build_material_index():
+    rows = db.session.query(Material.id, Material.name).filter(Material.is_active.is_(True)).all()
+    return MaterialNameIndex(rows)
+
+
+_index = SharedIndex(MATERIAL_INDEX_TAG, _build_material_index, max_age=MATERIAL_INDEX_TTL)
+# Индекс зависит только от названий и активности материалов
+_index.watch(Material, ('name', 'is_active'))
+
+
+def get_material_index():
+    """Текущий индекс; строится одним запросом при первом обращении и после сброса."""
+    return _index.get()
+
+
+def invalidate_material_index():
+    """Сбрасывает индекс в текущем процессе."""
+    _index.invalidate()
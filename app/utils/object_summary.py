@@ -0,0 +1,104 @@
+"""
+Сводка по объекту для карточки объекта (ObjectSummary)
+
+Карточка объекта показывает число опор, траншей, отчётов, работ и элементов.
+Раньше шаблон получал их через ленивые связи obj.supports, obj.trenches... —
+по запросу с полными строками на каждую. Сводка считается тремя запросами:
+число строк каждого вида по статусам (GROUP BY по UNION ALL), выкопанные
+метры траншей (Trench.total_excavated) и выполнение чек-листа.
+
+Готовая сводка хранится в общем кэше с тегом object:<id>. Любая запись
+строки объекта или его дочерних строк сбрасывает этот тег после commit
+(app/utils/cache_tags.py), и сводка пересчитывается при следующем просмотре
+только для этого объекта.
+"""
+from sqlalchemy import case, func, literal, union_all
+
+from app.extensions import db
+from app.models.objects import (
+    Bracket, Checklist, ChecklistItem, Luminaire, PlannedWork, Report, Support, Trench, ZDF,
+)
+from app.utils.cache_tags import cached_value, object_tag
+
+SUMMARY_NAMESPACE = 'object_summary'
+SUMMARY_TIMEOUT = 24 * 3600
+
+# Вид дочерних строк -> модель (у всех есть object_id и status)
+SUMMARY_KINDS = {
+    'supports': Support,
+    'trenches': Trench,
+    'reports': Report,
+    'planned_works': PlannedWork,
+    'zdf': ZDF,
+    'brackets': Bracket,
+    'luminaires': Luminaire,
+}
+
+
+class ObjectSummary:
+    """Счётчики по статусам дочерних строк объекта, метры траншей и чек-лист."""
+
+    def __init__(self, counts=None, trench_metres=0.0, checklist_total=0, checklist_completed=0):
+        self.counts = counts or {}
+        self.trench_metres = trench_metres
+        self.checklist_total = checklist_total
+        self.checklist_completed = checklist_completed
+
+    def total(self, kind):
+        """Число строк вида kind ('supports', 'trenches', ...)."""
+        return sum(self.counts.get(kind, {}).values())
+
+    def count(self, kind, status):
+        """Число строк вида kind в статусе status."""
+        return self.counts.get(kind, {}).get(status, 0)
+
+    @property
+    def checklist_percent(self):
+        if not self.checklist_total:
+            return 0
+        return round(self.checklist_completed / self.checklist_total * 100)
+
+    def to_dict(self):
+        return {
+            'counts': self.counts,
+            'trench_metres': self.trench_metres,
+            'checklist_total': self.checklist_total,
+            'checklist_completed': self.checklist_completed,
+        }
+
+
+def compute_object_summary(object_id):
+    """Считает сводку объекта по таблицам (три запроса)."""
+    rows = union_all(*(
+        db.select(literal(kind).label('kind'), model.status.label('status'), func.count().label('count'))
+        .where(model.object_id == object_id)
+        .group_by(model.status)
+        for kind, model in SUMMARY_KINDS.items()
+    )).subquery()
+    counts = {}
+    for kind, status, count in db.session.execute(db.select(rows.c.kind, rows.c.status, rows.c.count)):
+        counts.setdefault(kind, {})[status] = count
+
+    trench_metres = db.session.execute(
+        db.select(func.coalesce(func.sum(Trench.total_excavated), 0.0)).where(Trench.object_id == object_id)
+    ).scalar()
+    checklist_total, checklist_completed = db.session.execute(
+        db.select(
+            func.count(ChecklistItem.id),
+            func.coalesce(func.sum(case((ChecklistItem.is_completed.is_(True), 1), else_=0)), 0),
+        )
+        .join(Checklist, ChecklistItem.checklist_id == Checklist.id)
+        .where(Checklist.object_id == object_id)
+    ).one()
+    return ObjectSummary(counts, float(trench_metres), checklist_total, int(checklist_completed))
+
+
+def object_summary(object_id):
+    """Сводка объекта из кэша; после изменений по объекту — пересчитанная."""
+    data = cached_value(
+        f'{SUMMARY_NAMESPACE}:{object_id}',
+        [object_tag(object_id)],
+        lambda: compute_object_summary(object_id).to_dict(),
+        timeout=SUMMARY_TIMEOUT,
+    )
+    return ObjectSummary(**data)
@@ -0,0 +1,44 @@
+"""
+Статистика запланированных работ по объектам
+
+Сводные страницы (обзор запланированных работ, таблица всех работ) показывают
+для каждого объекта число работ по статусам. Счётчики берутся одним запросом
+GROUP BY object_id, status, а не подгрузкой obj.planned_works у каждого
+объекта: число запросов не зависит от числа объектов и работ.
+"""
+from sqlalchemy import func
+
+from app.extensions import db
+from app.models.objects import PlannedWork
+
+# Статус работы -> атрибут объекта, который читают шаблоны
+STATUS_ATTRIBUTES = {
+    'planned': 'pending_works_count',
+    'in_progress': 'in_progress_works_count',
+    'completed': 'completed_works_count',
+    'overdue': 'overdue_works_count',
+}
+
+
+def planned_work_counts(object_ids=None):
+    """{object_id: {статус: число работ}} по всем объектам или по object_ids."""
+    query = db.session.query(
+        PlannedWork.object_id, PlannedWork.status, func.count(PlannedWork.id)
+    ).group_by(PlannedWork.object_id, PlannedWork.status)
+    if object_ids is not None:
+        query = query.filter(PlannedWork.object_id.in_(object_ids))
+    counts = {}
+    for object_id, status, count in query:
+        counts.setdefault(object_id, {})[status] = count
+    return counts
+
+
+def attach_work_counts(objects):
+    """Проставляет объектам planned_works_count и счётчики по статусам."""
+    counts = planned_work_counts()
+    for obj in objects:
+        by_status = counts.get(obj.id, {})
+        obj.planned_works_count = sum(by_status.values())
+        for status, attribute in STATUS_ATTRIBUTES.items():
+            setattr(obj, attribute, by_status.get(status, 0))
+    return objects
@@ -0,0 +1,49 @@
+"""
+Календарь отчётов за месяц (страница /reports/calendar)
+
+Число ручных и ежедневных отчётов по дням и объектам считается одним
+запросом GROUP BY по объединению reports и daily_reports, объекты
+подгружаются одним запросом по найденным id. Строки отчётов и их авторы для
+сетки месяца не нужны и не загружаются.
+"""
+from sqlalchemy import func, literal, union_all
+
+from app.extensions import db
+from app.models.objects import DailyReport, Object, Report
+from app.utils.calendar_index import month_bounds
+
+
+def month_report_counts(start, end):
+    """[(день, object_id, ручных отчётов, ежедневных отчётов)] за [start, end)."""
+    reports = union_all(
+        db.select(
+            Report.report_date.label('day'), Report.object_id.label('object_id'),
+            literal(1).label('manual'), literal(0).label('daily'),
+        ).where(Report.report_date >= start, Report.report_date < end),
+        db.select(
+            DailyReport.report_date, DailyReport.object_id, literal(0), literal(1),
+        ).where(DailyReport.report_date >= start, DailyReport.report_date < end),
+    ).subquery()
+    return db.session.execute(
+        db.select(reports.c.day, reports.c.object_id, func.sum(reports.c.manual), func.sum(reports.c.daily))
+        .group_by(reports.c.day, reports.c.object_id)
+        .order_by(reports.c.day)
+    ).all()
+
+
+def month_reports_by_date(year, month):
+    """{'ГГГГ-ММ-ДД': {'objects', 'reports_count', 'daily_reports_count'}} за месяц."""
+    counts = month_report_counts(*month_bounds(year, month))
+    object_ids = {object_id for _, object_id, _, _ in counts}
+    objects = {obj.id: obj for obj in Object.query.filter(Object.id.in_(object_ids))} if object_ids else {}
+
+    objects_by_date = {}
+    for day, object_id, manual_count, daily_count in counts:
+        entry = objects_by_date.setdefault(
+            day.strftime('%Y-%m-%d'), {'objects': [], 'reports_count': 0, 'daily_reports_count': 0}
+        )
+        if object_id in objects:
+            entry['objects'].append(objects[object_id])
+        entry['reports_count'] += manual_count
+        entry['daily_reports_count'] += daily_count
+    return objects_by_date
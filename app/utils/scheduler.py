@@ -11,7 +11,7 @@ from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from flask import current_app
 
 from app.extensions import db
-from app.models.objects import PlannedWork, DailyReport, Object, WorkExecution
+from app.models.objects import PlannedWork, DailyReport, Object, Trench, WorkExecution
 from app.models.settings import SystemSetting
 from app.utils.timezone_utils import get_moscow_now
 
@@ -19,6 +19,51 @@ from app.utils.timezone_utils import get_moscow_now
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Отметка последнего пересчёта статусов работ и траншей (ГГГГ-ММ-ДДTЧЧ по Москве)
+STATUS_SWEEP_SETTING = 'status_sweep_last_run'
+
+
+def sweep_statuses(force=False):
+    """Переводит работы в 'в работе'/'просрочено' и траншеи в 'просрочено' по дате.
+
+    Статусы пересчитывает планировщик (без него — sweep_statuses_on_request),
+    страницы их лишь читают. Планировщик запущен в каждом процессе gunicorn,
+    поэтому пересчёт выполняется не чаще раза в час: остальные процессы видят
+    отметку в SystemSetting и возвращают None.
+    """
+    watermark = get_moscow_now().strftime('%Y-%m-%dT%H')
+    if not force and SystemSetting.get(STATUS_SWEEP_SETTING) == watermark:
+        return None
+    counts = {
+        'in_progress': PlannedWork.update_works_status_to_in_progress(),
+        'overdue_works': PlannedWork.update_overdue_works(),
+        'overdue_trenches': Trench.update_overdue_trenches(),
+    }
+    SystemSetting.set(STATUS_SWEEP_SETTING, watermark)
+    return counts
+
+
+def sweep_statuses_on_request(app):
+    """Пересчёт статусов перед запросами, когда планировщик не запущен (режим отладки).
+
+    Процесс проверяет отметку в SystemSetting один раз в час; ошибка
+    пересчёта не мешает самому запросу.
+    """
+    checked = {'hour': None}
+
+    @app.before_request
+    def sweep_statuses_before_request():
+        hour = get_moscow_now().strftime('%Y-%m-%dT%H')
+        if checked['hour'] == hour:
+            return
+        checked['hour'] = hour
+        try:
+            sweep_statuses()
+        except Exception:
+            db.session.rollback()
+            logger.exception("Ошибка пересчёта статусов работ и траншей")
+
+
 class TaskScheduler:
     """Класс для управления автоматическими задачами"""
     
@@ -70,7 +115,7 @@ class TaskScheduler:
     def _register_jobs(self):
         """Регистрация автоматических задач"""
         
-        # Обновление статуса просроченных работ - каждый день в 00:05
+        # Пересчёт статусов работ и траншей по дате - каждый день в 00:05
         self.scheduler.add_job(
             func=update_overdue_works_job,
             trigger=CronTrigger(hour=0, minute=5),
@@ -88,7 +133,8 @@ class TaskScheduler:
             replace_existing=True
         )
         
-        # Дополнительная проверка просроченных работ - каждый час
+        # Дополнительный пересчёт статусов - каждый час (работы, запланированные
+        # на сегодня после полуночи)
         self.scheduler.add_job(
             func=update_overdue_works_job,
             trigger=CronTrigger(minute=0),
@@ -106,6 +152,24 @@ class TaskScheduler:
             replace_existing=True
         )
         
+        # Снимок складских остатков - каждый день в 00:20
+        self.scheduler.add_job(
+            func=take_stock_snapshot_job,
+            trigger=CronTrigger(hour=0, minute=20),
+            id='take_stock_snapshot',
+            name='Снимок складских остатков',
+            replace_existing=True
+        )
+        
+        # Архивация старых месяцев журнала действий - каждый день в 03:30
+        self.scheduler.add_job(
+            func=archive_activity_log_job,
+            trigger=CronTrigger(hour=3, minute=30),
+            id='archive_activity_log',
+            name='Архивация журнала действий',
+            replace_existing=True
+        )
+        
         logger.info("Автоматические задачи зарегистрированы")
     
     def _run_initial_tasks(self):
@@ -113,9 +177,9 @@ class TaskScheduler:
         try:
             logger.info("Выполняем начальные задачи...")
             
-            # Обновляем просроченные работы (это быстро)
-            updated_count = self.update_overdue_works()
-            logger.info(f"Обновлено просроченных работ при запуске: {updated_count}")
+            # Пересчитываем статусы, если другой процесс ещё не сделал этого в этот час
+            updated = self.update_overdue_works()
+            logger.info(f"Пересчёт статусов при запуске: {updated}")
             
             # Легкая проверка пропущенных отчетов: только за последние 1-2 дня
             generated_count = self.generate_missing_reports(light_mode=True)
@@ -124,21 +188,21 @@ class TaskScheduler:
         except Exception as e:
             logger.error(f"Ошибка при выполнении начальных задач: {e}")
     
-    def update_overdue_works(self):
-        """Обновление статуса просроченных работ"""
+    def update_overdue_works(self, force=False):
+        """Пересчёт статусов работ и траншей по дате"""
         with self.app.app_context():
             try:
-                logger.info("Начинаем обновление статуса просроченных работ")
+                logger.info("Начинаем пересчёт статусов работ и траншей")
                 
-                # Используем существующий метод из модели
-                updated_count = PlannedWork.update_overdue_works()
+                updated = sweep_statuses(force=force)
                 
-                logger.info(f"Обновлено просроченных работ: {updated_count}")
-                return updated_count
+                logger.info(f"Пересчёт статусов: {updated if updated is not None else 'уже выполнен в этот час'}")
+                return updated
                 
             except Exception as e:
-                logger.error(f"Ошибка при обновлении просроченных работ: {e}")
-                return 0
+                db.session.rollback()
+                logger.error(f"Ошибка при пересчёте статусов: {e}")
+                return None
     
     def generate_daily_reports(self):
         """Генерация ежедневных отчетов за вчерашний день"""
@@ -343,6 +407,37 @@ class TaskScheduler:
                 logger.error(f"Ошибка при генерации пропущенных отчетов: {e}")
                 return 0
     
+    def take_stock_snapshot(self):
+        """Контрольная точка складского учёта для пересчёта и запросов остатков на дату"""
+        with self.app.app_context():
+            try:
+                from app.utils.stock_replay import take_snapshot
+                # Первый снимок take_snapshot сам снимает с текущих счётчиков.
+                # Задача запускается в каждом процессе, снимок за день — один
+                snapshot = take_snapshot(source='ledger', once_a_day=True)
+                if snapshot is None:
+                    logger.info("Снимок складских остатков за сегодня уже создан")
+                    return None
+                logger.info(f"Создан снимок складских остатков на {snapshot.taken_at}")
+                return snapshot.id
+            except Exception as e:
+                logger.error(f"Ошибка при создании снимка складских остатков: {e}")
+                return None
+    
+    def archive_activity_log(self):
+        """Перенос месяцев журнала действий старше срока хранения в архив"""
+        with self.app.app_context():
+            try:
+                from app.utils.activity_archive import apply_retention
+                archived = apply_retention()
+                for month, count in archived.items():
+                    logger.info(f"Журнал действий за {month}: в архив перенесено {count} записей")
+                return archived
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Ошибка при архивации журнала действий: {e}")
+                return {}
+    
     def shutdown(self):
         """Остановка планировщика"""
         if self.scheduler:
@@ -351,16 +446,10 @@ class TaskScheduler:
 
 # Глобальные функции-задачи для планировщика
 def update_overdue_works_job():
-    """Задача для обновления просроченных работ"""
-    from flask import current_app
-    with current_app.app_context():
-        try:
-            updated_count = PlannedWork.update_overdue_works()
-            logger.info(f"Автоматически обновлено просроченных работ: {updated_count}")
-            return updated_count
-        except Exception as e:
-            logger.error(f"Ошибка при автоматическом обновлении просроченных работ: {e}")
-            return 0
+    """Задача для пересчёта статусов работ и траншей"""
+    # Поток планировщика работает без контекста приложения: его открывает метод
+    from app.utils.scheduler import scheduler
+    return scheduler.update_overdue_works()
 
 def generate_daily_reports_job():
     """Задача для генерации ежедневных отчетов"""
@@ -415,6 +504,16 @@ def generate_missing_reports_job():
             logger.error(f"Ошибка при автоматической генерации пропущенных отчетов: {e}")
             return 0
 
+def take_stock_snapshot_job():
+    """Задача для ежедневного снимка складских остатков"""
+    from app.utils.scheduler import scheduler
+    return scheduler.take_stock_snapshot()
+
+def archive_activity_log_job():
+    """Задача для ежедневной архивации журнала действий"""
+    from app.utils.scheduler import scheduler
+    return scheduler.archive_activity_log()
+
 def _generate_report_for_object_job(object_id, report_date):
     """Генерация отчета для конкретного объекта за конкретную дату (для задач)"""
     try:
@@ -0,0 +1,351 @@
+"""
+Общий для всех процессов gunicorn кэш приложения
+
+Приложение работает в нескольких процессах (gunicorn -w 4). Кэш в памяти
+процесса (SimpleCache) у каждого свой: попадания делятся на число процессов,
+а сброс ключа после изменения данных виден только одному из них. SQLiteCache —
+бэкенд Flask-Caching поверх файла SQLite в CACHE_DIR, который открывают все
+процессы одного сервера:
+- запись и удаление ключа сразу видны остальным процессам (общий файл,
+  журнал WAL);
+- ключи вида «<пространство>:<ключ>» можно сбросить целиком —
+  delete_prefix() или CacheNamespace.clear();
+- попадания и промахи считаются по пространствам имён (часть ключа до «:»,
+  для кэша страниц — 'view'); процесс копит счётчики в памяти и раз в
+  STATS_FLUSH_INTERVAL секунд прибавляет их к общей таблице.
+
+Бэкенд выбирается настройкой CACHE_TYPE; для нескольких серверов можно указать
+RedisCache — CacheNamespace тогда сбрасывает пространство сменой поколения
+ключей. Ошибки SQLite не прерывают запрос: кэш считается пустым.
+"""
+import atexit
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+import click
+from flask.cli import AppGroup
+from flask_caching.backends.base import BaseCache
+
+from app.extensions import cache
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILENAME = 'cache.sqlite3'
+# Сколько ждать блокировки файла другим процессом, с
+BUSY_TIMEOUT = 5
+# Как часто процесс сбрасывает счётчики попаданий в общую таблицу, с
+STATS_FLUSH_INTERVAL = 5
+# Удаление просроченных ключей — раз в столько записей
+PRUNE_EVERY = 200
+
+VIEW_NAMESPACE = 'view'
+OTHER_NAMESPACE = 'other'
+
+
+def key_namespace(key):
+    """Пространство имён ключа: часть до «:», для кэша страниц — 'view'."""
+    if key.startswith('/') or key.startswith('view/'):
+        # Ключи @cache.cached: путь страницы (+ хэш строки запроса)
+        return VIEW_NAMESPACE
+    name, separator, _ = key.partition(':')
+    return name if separator else OTHER_NAMESPACE
+
+
+def _prefix_bound(prefix):
+    """Верхняя граница диапазона ключей, начинающихся с prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SQLiteCache(BaseCache):
+    """Кэш в файле SQLite, общий для процессов одного сервера."""
+
+    def __init__(self, path, default_timeout=300, threshold=5000):
+        super().__init__(default_timeout=default_timeout)
+        self.path = path
+        self.threshold = threshold
+        self._local = threading.local()
+        self._writes = 0
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._stats_flushed_at = time.monotonic()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                ' key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_cache_expires ON cache (expires)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache_stats ('
+                ' namespace TEXT PRIMARY KEY, hits INTEGER NOT NULL, misses INTEGER NOT NULL)'
+            )
+        atexit.register(self.flush_stats)
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        cache_dir = config['CACHE_DIR'] or os.path.join(app.instance_path, 'cache')
+        kwargs.setdefault('threshold', config['CACHE_THRESHOLD'])
+        return cls(os.path.join(cache_dir, CACHE_FILENAME), *args, **kwargs)
+
+    def _connect(self):
+        # Соединение на поток; после fork процесс gunicorn открывает своё
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _execute(self, sql, parameters=()):
+        try:
+            return self._connect().execute(sql, parameters)
+        except sqlite3.Error:
+            logger.exception('Ошибка кэша SQLite: %s', sql.split(' ', 1)[0])
+            return None
+
+    def _expires(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout > 0 else 0
+
+    # --- Чтение ---------------------------------------------------------
+
+    def _load(self, key):
+        cursor = self._execute(
+            'SELECT value FROM cache WHERE key = ? AND (expires = 0 OR expires > ?)',
+            (key, time.time()),
+        )
+        row = cursor.fetchone() if cursor is not None else None
+        if row is None:
+            return None
+        try:
+            return pickle.loads(row[0])
+        except Exception:
+            return None
+
+    def get(self, key):
+        value = self._load(key)
+        self._count(key, value is not None)
+        return value
+
+    def get_many(self, *keys):
+        """Значения ключей одним запросом (None для отсутствующих)."""
+        cursor = self._execute(
+            f'SELECT key, value FROM cache WHERE key IN ({", ".join("?" * len(keys))})'
+            ' AND (expires = 0 OR expires > ?)',
+            (*keys, time.time()),
+        ) if keys else None
+        found = {}
+        for key, value in cursor.fetchall() if cursor is not None else ():
+            try:
+                found[key] = pickle.loads(value)
+            except Exception:
+                pass
+        values = [found.get(key) for key in keys]
+        for key, value in zip(keys, values):
+            self._count(key, value is not None)
+        return values
+
+    def has(self, key):
+        cursor = self._execute(
+            'SELECT 1 FROM cache WHERE key = ? AND (expires = 0 OR expires > ?)',
+            (key, time.time()),
+        )
+        return cursor is not None and cursor.fetchone() is not None
+
+    # --- Запись ---------------------------------------------------------
+
+    def set(self, key, value, timeout=None):
+        if self._normalize_timeout(timeout) < 0:
+            return self.delete(key)
+        cursor = self._execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._expires(timeout)),
+        )
+        self._after_write()
+        return cursor is not None
+
+    def add(self, key, value, timeout=None):
+        now = time.time()
+        # Просроченный ключ считается отсутствующим
+        self._execute('DELETE FROM cache WHERE key = ? AND expires != 0 AND expires <= ?', (key, now))
+        cursor = self._execute(
+            'INSERT OR IGNORE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._expires(timeout)),
+        )
+        self._after_write()
+        return cursor is not None and cursor.rowcount == 1
+
+    def inc(self, key, delta=1):
+        # Чтение и запись в одной транзакции: счётчик не теряет прибавления
+        # соседних процессов
+        try:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                value = (self._load(key) or 0) + delta
+                connection.execute(
+                    'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                    (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._expires(None)),
+                )
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            logger.exception('Ошибка кэша SQLite: inc')
+            return None
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def delete(self, key):
+        cursor = self._execute('DELETE FROM cache WHERE key = ?', (key,))
+        return cursor is not None and cursor.rowcount > 0
+
+    def delete_many(self, *keys):
+        return [key for key in keys if self.delete(key)]
+
+    def delete_prefix(self, prefix):
+        """Удаляет все ключи, начинающиеся с prefix. Возвращает их число."""
+        if not prefix:
+            return 0
+        cursor = self._execute(
+            'DELETE FROM cache WHERE key >= ? AND key < ?', (prefix, _prefix_bound(prefix))
+        )
+        return cursor.rowcount if cursor is not None else 0
+
+    def clear(self):
+        return self._execute('DELETE FROM cache') is not None
+
+    def _after_write(self):
+        self._writes += 1
+        if self._writes % PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        """Удаляет просроченные ключи, а сверх threshold — самые старые по сроку."""
+        self._execute('DELETE FROM cache WHERE expires != 0 AND expires <= ?', (time.time(),))
+        if self.threshold:
+            self._execute(
+                'DELETE FROM cache WHERE key IN ('
+                ' SELECT key FROM cache WHERE expires != 0 ORDER BY expires'
+                ' LIMIT max((SELECT count(*) FROM cache) - ?, 0))',
+                (self.threshold,),
+            )
+
+    # --- Счётчики попаданий ---------------------------------------------
+
+    def _count(self, key, hit):
+        namespace = key_namespace(key)
+        with self._stats_lock:
+            counter = self._stats.setdefault(namespace, [0, 0])
+            counter[0 if hit else 1] += 1
+            due = time.monotonic() - self._stats_flushed_at >= STATS_FLUSH_INTERVAL
+        if due:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Прибавляет накопленные процессом счётчики к общей таблице."""
+        with self._stats_lock:
+            pending, self._stats = self._stats, {}
+            self._stats_flushed_at = time.monotonic()
+        for namespace, (hits, misses) in pending.items():
+            self._execute(
+                'INSERT INTO cache_stats (namespace, hits, misses) VALUES (?, ?, ?)'
+                ' ON CONFLICT (namespace) DO UPDATE SET'
+                ' hits = hits + excluded.hits, misses = misses + excluded.misses',
+                (namespace, hits, misses),
+            )
+
+    def stats(self):
+        """{пространство: {'hits', 'misses'}} по всем процессам."""
+        self.flush_stats()
+        cursor = self._execute('SELECT namespace, hits, misses FROM cache_stats ORDER BY namespace')
+        rows = cursor.fetchall() if cursor is not None else []
+        return {namespace: {'hits': hits, 'misses': misses} for namespace, hits, misses in rows}
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats = {}
+        self._execute('DELETE FROM cache_stats')
+
+
+class CacheNamespace:
+    """Ключи с общим префиксом «<name>:», сбрасываемые одним вызовом во всех процессах.
+
+    Для бэкендов без delete_prefix (Redis, SimpleCache) в ключ входит номер
+    поколения пространства, и clear() его увеличивает.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def _prefix(self):
+        backend = cache.cache
+        if hasattr(backend, 'delete_prefix'):
+            return f'{self.name}:'
+        generation = backend.get(f'{self.name}:generation') or 0
+        return f'{self.name}:{generation}:'
+
+    def key(self, key):
+        return f'{self._prefix()}{key}'
+
+    def get(self, key):
+        return cache.get(self.key(key))
+
+    def set(self, key, value, timeout=None):
+        return cache.set(self.key(key), value, timeout=timeout)
+
+    def delete(self, key):
+        return cache.delete(self.key(key))
+
+    def clear(self):
+        backend = cache.cache
+        if hasattr(backend, 'delete_prefix'):
+            backend.delete_prefix(f'{self.name}:')
+        else:
+            backend.inc(f'{self.name}:generation')
+
+
+def cache_stats():
+    """Счётчики попаданий по пространствам имён или {}, если бэкенд их не ведёт."""
+    backend = cache.cache
+    return backend.stats() if hasattr(backend, 'stats') else {}
+
+
+cache_cli = AppGroup('cache', help='Общий кэш приложения')
+
+
+@cache_cli.command('stats')
+def stats_command():
+    """Попадания и промахи кэша по пространствам имён."""
+    stats = cache_stats()
+    if not stats:
+        click.echo('Бэкенд кэша не ведёт счётчики' if not hasattr(cache.cache, 'stats') else 'Обращений к кэшу не было')
+        return
+    for namespace, counters in stats.items():
+        total = counters['hits'] + counters['misses']
+        ratio = counters['hits'] / total * 100 if total else 0
+        click.echo(f"{namespace}: попаданий {counters['hits']}, промахов {counters['misses']} ({ratio:.0f}%)")
+
+
+@cache_cli.command('clear')
+@click.argument('namespace', required=False)
+@click.option('--reset-stats', is_flag=True, help='Обнулить и счётчики попаданий')
+def clear_command(namespace, reset_stats):
+    """Сброс всего кэша или одного пространства имён."""
+    if namespace:
+        CacheNamespace(namespace).clear()
+        click.echo(f'Пространство {namespace} сброшено')
+    else:
+        cache.clear()
+        click.echo('Кэш сброшен')
+    if reset_stats and hasattr(cache.cache, 'reset_stats'):
+        cache.cache.reset_stats()
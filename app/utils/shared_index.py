@@ -0,0 +1,74 @@
+"""
+Индексы в памяти процесса, сбрасываемые во всех процессах сразу
+
+Индексы для поиска (названия материалов, пользователи) строятся одним
+запросом и живут в памяти процесса. Их актуальность отслеживается версией
+тега в общем кэше (app/utils/cache_tags.py): watch() отмечает тег индекса в
+сессии, когда у модели меняются отслеживаемые поля, после commit версия тега
+меняется, и каждый процесс gunicorn перестраивает свой индекс при следующем
+обращении. Откат транзакции отметку снимает — тем же механизмом, что и для
+закэшированных страниц.
+"""
+import threading
+import time
+
+from sqlalchemy import event, inspect
+
+from app.utils.cache_tags import ALL_TAG, mark_tags, tag_versions
+
+
+class SharedIndex:
+    """Объект в памяти процесса, перестраиваемый после сброса своего тега.
+
+    build() вызывается без аргументов и возвращает новый индекс. max_age —
+    страховочный срок жизни в секундах на случай недоступного общего кэша.
+    """
+
+    def __init__(self, tag, build, max_age=None):
+        self.tag = tag
+        self.build = build
+        self.max_age = max_age
+        self._value = None
+        self._version = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+
+    def _fresh(self, version):
+        if self._value is None or self._version != version:
+            return False
+        return self.max_age is None or time.monotonic() - self._built_at < self.max_age
+
+    def get(self):
+        """Текущий индекс; перестраивается, если тег сброшен в любом процессе."""
+        # Массовые query.update()/delete() сбрасывают ALL_TAG
+        version = tag_versions([self.tag, ALL_TAG])
+        if self._fresh(version):
+            return self._value
+        with self._lock:
+            if not self._fresh(version):
+                # Версия прочитана до построения: сброс во время построения
+                # приведёт к ещё одной перестройке, а не к устаревшему индексу
+                self._value = self.build()
+                self._version = version
+                self._built_at = time.monotonic()
+        return self._value
+
+    def invalidate(self):
+        """Сбрасывает индекс в текущем процессе."""
+        self._value = None
+
+    def watch(self, model, fields):
+        """Отмечать тег индекса при вставке и удалении строк model и изменении fields."""
+        def mark(mapper, connection, target):
+            session = inspect(target).session
+            if session is not None:
+                mark_tags(session, [self.tag])
+
+        def mark_if_changed(mapper, connection, target):
+            state = inspect(target)
+            if any(state.attrs[field].history.has_changes() for field in fields):
+                mark(mapper, connection, target)
+
+        event.listen(model, 'after_insert', mark)
+        event.listen(model, 'after_delete', mark)
+        event.listen(model, 'after_update', mark_if_changed)
@@ -0,0 +1,341 @@
+"""
+Складской учёт: атомарное проведение движений по складу
+
+Все изменения остатков (Material.current_quantity) и распределений
+(UserMaterialAllocation.quantity) проходят через этот модуль в рамках одной
+транзакции:
+
+1. строки блокируются через SELECT ... FOR UPDATE в детерминированном порядке —
+   сначала материалы по возрастанию id, затем распределения по
+   (material_id, user_id), — поэтому параллельные движения не взаимоблокируются;
+2. проверки остатков выполняются по заблокированным строкам;
+3. изменения (включая автоскрытие материала с нулевым остатком) фиксируются
+   одним commit.
+
+На СУБД без FOR UPDATE (SQLite в разработке) защиту даёт колонка версии
+version_id у Material и UserMaterialAllocation: конкурентное изменение
+приводит к StaleDataError, и транзакция повторяется в commit_with_retry.
+"""
+import uuid
+
+from sqlalchemy import tuple_
+from sqlalchemy.orm.exc import StaleDataError
+
+from app.extensions import db
+from app.models.supply import Material, UserMaterialAllocation, WarehouseMovement
+from app.utils.timezone_utils import get_moscow_now
+
+# Сколько раз повторять транзакцию при конфликте версий
+MAX_ATTEMPTS = 3
+
+
+class StockLedgerError(Exception):
+    """Движение не может быть проведено (неверные данные, недостаточно остатка)."""
+
+    status_code = 400
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.message = message
+        if status_code is not None:
+            self.status_code = status_code
+
+
+class StockConflictError(StockLedgerError):
+    """Остатки изменились параллельно и повторные попытки исчерпаны."""
+
+    status_code = 409
+
+
+class StockBatchError(StockLedgerError):
+    """Одна или несколько строк пакетного движения не прошли проверку.
+
+    errors — список {'line': номер строки (с 0), 'error': текст ошибки}.
+    """
+
+    def __init__(self, errors):
+        super().__init__('Пакет движений не проведён: есть ошибки в строках')
+        self.errors = errors
+
+
+def as_uuid(value, field):
+    """Приводит идентификатор из запроса к UUID; пустое значение — None."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, uuid.UUID):
+        return value
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        raise StockLedgerError(f'Неверный {field}')
+
+
+def lock_materials(material_ids):
+    """Блокирует материалы по возрастанию id и возвращает словарь id -> Material."""
+    ids = sorted(set(material_ids))
+    if not ids:
+        return {}
+    materials = Material.query.filter(
+        Material.id.in_(ids)
+    ).order_by(Material.id).with_for_update().populate_existing().all()
+    return {m.id: m for m in materials}
+
+
+def lock_allocations(pairs):
+    """Блокирует распределения для пар (user_id, material_id).
+
+    Порядок блокировки — (material_id, user_id). Возвращает словарь
+    (user_id, material_id) -> UserMaterialAllocation для существующих строк.
+    """
+    pairs = sorted(set(pairs), key=lambda pair: (pair[1], pair[0]))
+    if not pairs:
+        return {}
+    # Только запрошенные пары, а не все сочетания пользователей и материалов:
+    # лишние строки были бы заблокированы до конца транзакции
+    allocations = UserMaterialAllocation.query.filter(
+        tuple_(UserMaterialAllocation.user_id, UserMaterialAllocation.material_id).in_(pairs)
+    ).order_by(
+        UserMaterialAllocation.material_id, UserMaterialAllocation.user_id
+    ).with_for_update().populate_existing().all()
+    return {(a.user_id, a.material_id): a for a in allocations}
+
+
+def allocation_key(movement_type, from_user_id, to_user_id, material_id):
+    """Пара (user_id, material_id), чьё распределение затрагивает движение."""
+    if movement_type == 'move' and to_user_id:
+        return to_user_id, material_id
+    if movement_type == 'return' and from_user_id:
+        return from_user_id, material_id
+    return None
+
+
+def apply_movement(material, allocations, movement_type, quantity, created_by,
+                   from_user_id=None, to_user_id=None, note=None):
+    """Проверяет и применяет одно движение к заблокированным строкам.
+
+    allocations — словарь из lock_allocations; созданные распределения
+    добавляются в него, чтобы следующие строки той же транзакции их видели.
+    Ничего не коммитит. Возвращает (movement, material_restored).
+    """
+    if quantity <= 0:
+        raise StockLedgerError('quantity должен быть больше нуля')
+
+    available = material.current_quantity or 0.0
+
+    # Проверяем достаточность количества
+    if movement_type in ('move', 'writeoff'):
+        # Для выдачи и списания проверяем наличие на складе
+        if available < quantity:
+            raise StockLedgerError(
+                f'Недостаточно материала на складе. Доступно: {available} {material.unit}, требуется: {quantity} {material.unit}'
+            )
+    elif movement_type == 'return' and from_user_id:
+        # Для возврата проверяем наличие у пользователя
+        user_alloc = allocations.get((from_user_id, material.id))
+        user_quantity = user_alloc.quantity if user_alloc else 0.0
+        if user_quantity < quantity:
+            raise StockLedgerError(
+                f'У пользователя недостаточно материала. Доступно: {user_quantity} {material.unit}, требуется: {quantity} {material.unit}'
+            )
+
+    movement = WarehouseMovement(
+        material_id=material.id,
+        from_user_id=from_user_id,
+        to_user_id=to_user_id,
+        quantity=quantity,
+        movement_type=movement_type,
+        note=note,
+        created_by=created_by,
+    )
+    db.session.add(movement)
+
+    material_restored = False
+    now = get_moscow_now()
+
+    # Обновление остатков материала
+    if movement_type in ('add', 'replenishment', 'return'):
+        # Поступление, пополнение или возврат на склад - увеличиваем количество
+        material.current_quantity = available + quantity
+        # Если материал был неактивен, восстанавливаем его
+        if not material.is_active:
+            material.is_active = True
+            material.updated_at = now
+            material_restored = True
+    elif movement_type in ('move', 'writeoff'):
+        # Выдача или списание - уменьшаем склад
+        material.current_quantity = available - quantity
+
+    # Обновляем распределение по пользователям
+    key = allocation_key(movement_type, from_user_id, to_user_id, material.id)
+    if key and movement_type == 'move':
+        # Выдача: увеличиваем количество у получателя
+        alloc = allocations.get(key)
+        if not alloc:
+            alloc = UserMaterialAllocation(user_id=key[0], material_id=material.id, quantity=0.0)
+            db.session.add(alloc)
+            allocations[key] = alloc
+        alloc.quantity = (alloc.quantity or 0.0) + quantity
+        alloc.updated_at = now
+    elif key:
+        # Возврат: уменьшаем количество у возвращающего
+        alloc_from = allocations.get(key)
+        if alloc_from:
+            new_quantity = max(0.0, (alloc_from.quantity or 0.0) - quantity)
+            alloc_from.quantity = new_quantity
+            alloc_from.updated_at = now
+            # Запись с нулевым количеством удаляет drop_empty_allocations в конце транзакции
+
+    return movement, material_restored
+
+
+def set_quantity(material, quantity, created_by, note=None):
+    """Устанавливает остаток материала на складе с записью движения на разницу.
+
+    Для прямого ввода количества (создание, восстановление, правка
+    материала): рост записывается движением 'add', уменьшение — 'writeoff',
+    чтобы пересчёт по журналу (stock_replay) давал тот же остаток. Материал
+    должен быть уже сохранён (flush), ничего не коммитит. Возвращает
+    движение или None, если остаток не изменился.
+    """
+    previous = material.current_quantity or 0.0
+    material.current_quantity = quantity
+    delta = quantity - previous
+    if abs(delta) <= 1e-9:
+        return None
+    movement = WarehouseMovement(
+        material_id=material.id,
+        quantity=abs(delta),
+        movement_type='add' if delta > 0 else 'writeoff',
+        note=note,
+        created_by=created_by,
+    )
+    db.session.add(movement)
+    return movement
+
+
+def drop_empty_allocations(allocations):
+    """Удаляет распределения, количество по которым стало нулевым."""
+    for key, alloc in list(allocations.items()):
+        if (alloc.quantity or 0.0) <= 0:
+            if alloc in db.session.new:
+                db.session.expunge(alloc)
+            else:
+                db.session.delete(alloc)
+            del allocations[key]
+
+
+def hide_empty_material(material):
+    """Скрывает материал, если его остаток стал нулевым или отрицательным."""
+    if (material.current_quantity or 0.0) <= 0 and material.is_active:
+        material.is_active = False
+        material.updated_at = get_moscow_now()
+        return True
+    return False
+
+
+def post_movement(material_id, movement_type, quantity, created_by,
+                  from_user_id=None, to_user_id=None, note=None):
+    """Проводит одно движение: блокировки, проверки, изменения остатков.
+
+    Ничего не коммитит — вызывающий код фиксирует транзакцию через
+    commit_with_retry. Возвращает (movement, material, material_restored).
+    """
+    material_id = as_uuid(material_id, 'material_id')
+    from_user_id = as_uuid(from_user_id, 'from_user_id')
+    to_user_id = as_uuid(to_user_id, 'to_user_id')
+
+    material = lock_materials([material_id]).get(material_id)
+    if not material:
+        raise StockLedgerError('Материал не найден', 404)
+
+    key = allocation_key(movement_type, from_user_id, to_user_id, material_id)
+    allocations = lock_allocations([key] if key else [])
+
+    movement, material_restored = apply_movement(
+        material, allocations, movement_type, quantity, created_by,
+        from_user_id=from_user_id, to_user_id=to_user_id, note=note,
+    )
+    drop_empty_allocations(allocations)
+    hide_empty_material(material)
+    return movement, material, material_restored
+
+
+def post_movements(lines, created_by):
+    """Проводит пакет движений в одной транзакции.
+
+    lines — список словарей с ключами material_id, movement_type, quantity и
+    необязательными from_user_id, to_user_id, note. Все затронутые материалы
+    и распределения блокируются двумя запросами до применения строк, строки
+    применяются по порядку к одному снимку остатков (каждая следующая видит
+    результат предыдущих). Если хотя бы одна строка не проходит проверку,
+    бросается StockBatchError со списком ошибок, и ничего не применяется —
+    откат выполняет commit_with_retry. Ничего не коммитит.
+
+    Возвращает список (movement, material, material_restored) в порядке строк.
+    """
+    errors = []
+    parsed = []
+    for index, line in enumerate(lines):
+        try:
+            parsed.append((
+                as_uuid(line.get('material_id'), 'material_id'),
+                line.get('movement_type'),
+                line.get('quantity'),
+                as_uuid(line.get('from_user_id'), 'from_user_id'),
+                as_uuid(line.get('to_user_id'), 'to_user_id'),
+                line.get('note'),
+            ))
+        except StockLedgerError as e:
+            errors.append({'line': index, 'error': e.message})
+            parsed.append(None)
+    if errors:
+        raise StockBatchError(errors)
+
+    materials = lock_materials(p[0] for p in parsed)
+    allocations = lock_allocations(
+        key for key in (allocation_key(p[1], p[3], p[4], p[0]) for p in parsed) if key
+    )
+
+    results = []
+    for index, (material_id, movement_type, quantity, from_user_id, to_user_id, note) in enumerate(parsed):
+        material = materials.get(material_id)
+        if not material:
+            errors.append({'line': index, 'error': 'Материал не найден'})
+            continue
+        try:
+            movement, material_restored = apply_movement(
+                material, allocations, movement_type, quantity, created_by,
+                from_user_id=from_user_id, to_user_id=to_user_id, note=note,
+            )
+        except StockLedgerError as e:
+            errors.append({'line': index, 'error': e.message})
+            continue
+        results.append((movement, material, material_restored))
+    if errors:
+        raise StockBatchError(errors)
+
+    drop_empty_allocations(allocations)
+    for material in materials.values():
+        hide_empty_material(material)
+    return results
+
+
+def commit_with_retry(work, attempts=MAX_ATTEMPTS):
+    """Выполняет work() и коммитит результат одной транзакцией.
+
+    При конфликте версий (StaleDataError) транзакция откатывается и work()
+    выполняется заново с актуальными данными. Любая другая ошибка откатывает
+    транзакцию и пробрасывается дальше.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            result = work()
+            db.session.commit()
+            return result
+        except StaleDataError:
+            db.session.rollback()
+            if attempt == attempts:
+                raise StockConflictError('Остатки изменились во время операции, повторите попытку')
+        except Exception:
+            db.session.rollback()
+            raise
@@ -0,0 +1,301 @@
+"""
+Пересчёт складского учёта по журналу движений
+
+Material.current_quantity и UserMaterialAllocation.quantity — денормализованные
+счётчики. Источник истины для них — журнал WarehouseMovement, начиная с
+контрольной точки (StockSnapshot):
+
+- replay() восстанавливает остатки из последнего снимка и движений после него
+  (по индексу (created_at, id), без полного просмотра таблицы);
+- find_drift() сравнивает результат с текущими счётчиками;
+- rebuild() записывает пересчитанные значения в счётчики;
+- take_snapshot() сохраняет новую контрольную точку (ежедневно — планировщиком);
+- stock_as_of() отвечает «сколько было на дату» по ближайшему снимку.
+
+Ключ баланса — (material_id, user_id), где user_id = None означает склад.
+Материалы, заведённые до появления журнала, могли получить количество без
+движения, поэтому без снимка пересчёт «с нуля» недостоверен: первый снимок
+всегда снимается с текущих счётчиков (source='counters'), а rebuild() без
+снимка только сохраняет такую точку и ничего не исправляет.
+"""
+from datetime import datetime, timedelta
+
+from app.extensions import db
+from app.models.supply import (
+    Material,
+    StockSnapshot,
+    StockSnapshotLine,
+    UserMaterialAllocation,
+    WarehouseMovement,
+)
+from app.utils.stock_ledger import lock_materials
+from app.utils.timezone_utils import get_moscow_now
+
+# Расхождения меньше этого порога считаются погрешностью float
+DRIFT_TOLERANCE = 1e-6
+# Размер пачки при потоковом чтении движений
+REPLAY_BATCH_SIZE = 1000
+
+
+def apply_to_balances(balances, material_id, movement_type, quantity, from_user_id, to_user_id):
+    """Применяет одно движение к словарю балансов так же, как stock_ledger."""
+    warehouse_key = (material_id, None)
+    if movement_type in ('add', 'replenishment', 'return'):
+        balances[warehouse_key] = balances.get(warehouse_key, 0.0) + quantity
+    elif movement_type in ('move', 'writeoff'):
+        balances[warehouse_key] = balances.get(warehouse_key, 0.0) - quantity
+
+    if movement_type == 'move' and to_user_id:
+        key = (material_id, to_user_id)
+        balances[key] = balances.get(key, 0.0) + quantity
+    elif movement_type == 'return' and from_user_id:
+        key = (material_id, from_user_id)
+        # Как и при проведении движения, количество у пользователя не уходит в минус
+        balances[key] = max(0.0, balances.get(key, 0.0) - quantity)
+
+
+def latest_snapshot(before=None):
+    """Последний снимок (не позже before, если задано) или None."""
+    query = StockSnapshot.query
+    if before is not None:
+        query = query.filter(StockSnapshot.taken_at <= before)
+    return query.order_by(StockSnapshot.taken_at.desc(), StockSnapshot.id.desc()).first()
+
+
+def snapshot_balances(snapshot, material_id=None):
+    """Балансы из строк снимка."""
+    if snapshot is None:
+        return {}
+    query = db.session.query(
+        StockSnapshotLine.material_id, StockSnapshotLine.user_id, StockSnapshotLine.quantity
+    ).filter(StockSnapshotLine.snapshot_id == snapshot.id)
+    if material_id is not None:
+        query = query.filter(StockSnapshotLine.material_id == material_id)
+    return {(row.material_id, row.user_id): row.quantity for row in query}
+
+
+def replay(snapshot=None, until=None, material_id=None):
+    """Пересчитывает балансы от снимка по движениям после его контрольной точки.
+
+    snapshot — контрольная точка (None — пересчёт с нуля по всему журналу),
+    until — учитывать движения не позже этого момента, material_id —
+    пересчитать один материал.
+    Возвращает (balances, checkpoint, movements_count), где checkpoint —
+    (created_at, id) последнего учтённого движения или None.
+    """
+    balances = snapshot_balances(snapshot, material_id)
+    checkpoint = None
+    if snapshot is not None and snapshot.last_movement_id is not None:
+        checkpoint = (snapshot.last_movement_created_at, snapshot.last_movement_id)
+
+    query = db.session.query(
+        WarehouseMovement.id,
+        WarehouseMovement.material_id,
+        WarehouseMovement.movement_type,
+        WarehouseMovement.quantity,
+        WarehouseMovement.from_user_id,
+        WarehouseMovement.to_user_id,
+        WarehouseMovement.created_at,
+    )
+    if checkpoint is not None:
+        created_at, movement_id = checkpoint
+        query = query.filter(db.or_(
+            WarehouseMovement.created_at > created_at,
+            db.and_(WarehouseMovement.created_at == created_at, WarehouseMovement.id > movement_id),
+        ))
+    if until is not None:
+        query = query.filter(WarehouseMovement.created_at <= until)
+    if material_id is not None:
+        query = query.filter(WarehouseMovement.material_id == material_id)
+
+    count = 0
+    for row in query.order_by(
+        WarehouseMovement.created_at, WarehouseMovement.id
+    ).yield_per(REPLAY_BATCH_SIZE):
+        apply_to_balances(
+            balances, row.material_id, row.movement_type, row.quantity or 0.0,
+            row.from_user_id, row.to_user_id,
+        )
+        checkpoint = (row.created_at, row.id)
+        count += 1
+    return balances, checkpoint, count
+
+
+def counter_balances():
+    """Текущие значения денормализованных счётчиков в виде балансов."""
+    balances = {
+        (row.id, None): row.current_quantity or 0.0
+        for row in db.session.query(Material.id, Material.current_quantity)
+    }
+    for row in db.session.query(
+        UserMaterialAllocation.material_id, UserMaterialAllocation.user_id, UserMaterialAllocation.quantity
+    ):
+        balances[(row.material_id, row.user_id)] = row.quantity or 0.0
+    return balances
+
+
+def find_drift(expected, actual):
+    """Расхождения между пересчитанными и текущими балансами."""
+    drift = []
+    for key in sorted(set(expected) | set(actual), key=lambda k: (str(k[0]), str(k[1] or ''))):
+        expected_qty = expected.get(key, 0.0)
+        actual_qty = actual.get(key, 0.0)
+        if abs(expected_qty - actual_qty) > DRIFT_TOLERANCE:
+            material_id, user_id = key
+            drift.append({
+                'material_id': material_id,
+                'user_id': user_id,
+                'expected': expected_qty,
+                'actual': actual_qty,
+                'delta': actual_qty - expected_qty,
+            })
+    return drift
+
+
+def check_drift():
+    """Отчёт о расхождениях счётчиков с журналом движений (ничего не меняет)."""
+    snapshot = latest_snapshot()
+    expected, _, count = replay(snapshot)
+    return {
+        'snapshot': snapshot.to_dict() if snapshot else None,
+        'replayed_movements': count,
+        'drift': find_drift(expected, counter_balances()),
+    }
+
+
+def _save_snapshot(balances, checkpoint, source, created_by=None):
+    snapshot = StockSnapshot(
+        taken_at=get_moscow_now(),
+        source=source,
+        last_movement_created_at=checkpoint[0] if checkpoint else None,
+        last_movement_id=checkpoint[1] if checkpoint else None,
+        created_by=created_by,
+    )
+    db.session.add(snapshot)
+    db.session.flush()
+    db.session.bulk_insert_mappings(StockSnapshotLine, [
+        {
+            'snapshot_id': snapshot.id,
+            'material_id': material_id,
+            'user_id': user_id,
+            'quantity': quantity,
+        }
+        for (material_id, user_id), quantity in balances.items()
+        if user_id is None or abs(quantity) > DRIFT_TOLERANCE
+    ])
+    return snapshot
+
+
+def _lock_all_materials():
+    """Блокирует все материалы (в порядке stock_ledger), останавливая проведение движений."""
+    return lock_materials(row.id for row in db.session.query(Material.id))
+
+
+def take_snapshot(source='ledger', created_by=None, once_a_day=False):
+    """Сохраняет контрольную точку и коммитит её.
+
+    source='ledger' — остатки пересчитываются от предыдущего снимка по
+    движениям (расхождения счётчиков в снимок не попадают);
+    source='counters' — текущие счётчики принимаются за истину (начальная
+    точка или фиксация ручной корректировки). Первый снимок всегда
+    снимается с счётчиков.
+    once_a_day=True — для задачи планировщика, запущенной в каждом процессе
+    gunicorn: если сегодня уже есть снимок по журналу или автоматический
+    снимок, новый не сохраняется и возвращается None.
+    """
+    try:
+        _lock_all_materials()
+        previous = latest_snapshot()
+        # Проверка после блокировки материалов: процессы, ждавшие её, видят
+        # снимок, сохранённый первым
+        if once_a_day and previous is not None and _taken_today(previous):
+            db.session.rollback()
+            return None
+        if previous is None:
+            source = 'counters'
+        balances, checkpoint, _ = replay(previous)
+        if source == 'counters':
+            balances = counter_balances()
+        snapshot = _save_snapshot(balances, checkpoint, source, created_by)
+        db.session.commit()
+        return snapshot
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _taken_today(snapshot):
+    if snapshot.taken_at.date() != get_moscow_now().date():
+        return False
+    return snapshot.source == 'ledger' or snapshot.created_by is None
+
+
+def rebuild(created_by=None):
+    """Перезаписывает счётчики значениями из журнала движений и коммитит.
+
+    Материалы блокируются на время пересчёта, поэтому новые движения ждут
+    его окончания. После записи сохраняется снимок — следующий пересчёт
+    начнётся с этой точки. Возвращает список исправленных расхождений.
+    Если снимков ещё нет, текущие счётчики сохраняются начальным снимком и
+    ничего не исправляется: пересчёт с нуля не знает начальных остатков.
+    """
+    try:
+        snapshot = latest_snapshot()
+        if snapshot is None:
+            take_snapshot(source='counters', created_by=created_by)
+            return []
+        materials = _lock_all_materials()
+        expected, checkpoint, _ = replay(snapshot)
+        drift = find_drift(expected, counter_balances())
+        if not drift:
+            db.session.rollback()
+            return drift
+
+        allocations = {
+            (a.material_id, a.user_id): a
+            for a in UserMaterialAllocation.query.with_for_update().populate_existing()
+        }
+        now = get_moscow_now()
+        for item in drift:
+            key = (item['material_id'], item['user_id'])
+            if item['user_id'] is None:
+                material = materials.get(item['material_id'])
+                if material:
+                    material.current_quantity = item['expected']
+                    material.updated_at = now
+                continue
+            alloc = allocations.get(key)
+            if item['expected'] <= DRIFT_TOLERANCE:
+                if alloc:
+                    db.session.delete(alloc)
+            elif alloc:
+                alloc.quantity = item['expected']
+                alloc.updated_at = now
+            else:
+                db.session.add(UserMaterialAllocation(
+                    user_id=item['user_id'], material_id=item['material_id'], quantity=item['expected'],
+                ))
+
+        _save_snapshot(expected, checkpoint, 'ledger', created_by)
+        db.session.commit()
+        return drift
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def stock_as_of(moment, material_id=None):
+    """Остатки на момент времени: ближайший снимок до moment плюс движения после него.
+
+    moment — datetime или date (тогда берётся конец дня). Возвращает словарь
+    (material_id, user_id) -> количество без нулевых распределений.
+    """
+    if not isinstance(moment, datetime):
+        moment = datetime.combine(moment, datetime.min.time()) + timedelta(days=1) - timedelta(microseconds=1)
+    snapshot = latest_snapshot(before=moment)
+    balances, _, _ = replay(snapshot, until=moment, material_id=material_id)
+    return {
+        key: quantity
+        for key, quantity in balances.items()
+        if key[1] is None or abs(quantity) > DRIFT_TOLERANCE
+    }
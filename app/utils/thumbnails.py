@@ -0,0 +1,156 @@
+"""
+Уменьшенные копии фотографий для списков и окон предпросмотра
+
+Страницы элементов, материалов и траншей показывают фото вложений; вместо
+оригинала с камеры (несколько мегабайт) им отдаётся JPEG фиксированного
+размера:
+- 'sm' — миниатюра для карточек и списков;
+- 'md' — изображение для окна предпросмотра.
+
+Копия строится при первом запросе и сохраняется на диск в каталоге
+THUMBNAIL_PATH по ключу (вид вложения, id вложения, размер); повторные
+запросы отдают готовый файл. Содержимое вложения по id не меняется, поэтому
+копии не устаревают — при удалении вложения они удаляются delete_thumbnails().
+
+Для файлов, которые не являются изображением (или если Pillow не установлен),
+build_thumbnail() возвращает None, и маршрут отдаёт оригинал.
+"""
+import os
+import tempfile
+from io import BytesIO
+
+from flask import current_app, send_file
+
+from app.utils.attachment_download import ATTACHMENT_MAX_AGE
+from app.utils.blob_store import get_blob_store
+
+# Наибольшая сторона уменьшенной копии, px
+THUMB_SIZES = {'sm': 320, 'md': 1280}
+DEFAULT_THUMB_SIZE = 'sm'
+THUMB_QUALITY = 80
+THUMB_MIMETYPE = 'image/jpeg'
+
+
+def thumbnail_root():
+    app = current_app
+    return app.config.get('THUMBNAIL_PATH') or os.path.join(app.instance_path, 'thumbs')
+
+
+def thumbnail_path(kind, key, size):
+    """<THUMBNAIL_PATH>/<kind>/<ab>/<key>-<size>.jpg"""
+    key = str(key)
+    return os.path.join(thumbnail_root(), kind, key[:2], f'{key}-{size}.jpg')
+
+
+def render_thumbnail(source, max_side):
+    """JPEG-байты уменьшенной копии или None, если source — не изображение.
+
+    source — путь к файлу или файловый объект.
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    try:
+        with Image.open(source) as image:
+            # Для JPEG декодер сразу читает уменьшенное в 2-8 раз изображение
+            image.draft('RGB', (max_side, max_side))
+            image = ImageOps.exif_transpose(image)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.thumbnail((max_side, max_side))
+            output = BytesIO()
+            image.save(output, 'JPEG', quality=THUMB_QUALITY, optimize=True, progressive=True)
+            return output.getvalue()
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError):
+        # Не изображение, повреждённый файл или подозрительно большой размер
+        return None
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Несколько процессов могут строить одну копию одновременно: каждый пишет
+    # во временный файл, переименование атомарно
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def build_thumbnail(kind, key, size, open_source):
+    """Путь к уменьшенной копии, при необходимости строит её.
+
+    open_source() возвращает путь или файловый объект оригинала и вызывается,
+    только если копии ещё нет. None — копию построить нельзя.
+    """
+    path = thumbnail_path(kind, key, size)
+    if os.path.exists(path):
+        return path
+    source = open_source()
+    if source is None:
+        return None
+    try:
+        data = render_thumbnail(source, THUMB_SIZES[size])
+    finally:
+        if hasattr(source, 'close'):
+            source.close()
+    if data is None:
+        return None
+    _write_atomic(path, data)
+    return path
+
+
+def send_thumbnail(kind, key, size, open_source, immutable=True):
+    """Ответ с уменьшенной копией или None, если её нет и построить нельзя.
+
+    immutable=False — для адресов вида «последний файл», которые могут начать
+    указывать на другое вложение.
+    """
+    path = build_thumbnail(kind, key, size, open_source)
+    if path is None:
+        return None
+    response = send_file(
+        path,
+        mimetype=THUMB_MIMETYPE,
+        conditional=True,
+        etag=f'thumb-{key}-{size}',
+        max_age=ATTACHMENT_MAX_AGE if immutable else 0,
+    )
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if immutable:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def requested_size(value):
+    """Размер из параметра запроса ?size=, неизвестные значения — размер по умолчанию."""
+    return value if value in THUMB_SIZES else DEFAULT_THUMB_SIZE
+
+
+def attachment_source(attachment):
+    """open_source для вложений из blob_store."""
+    def open_source():
+        if not (attachment.content_type or '').startswith('image/'):
+            return None
+        store = get_blob_store()
+        if attachment.sha256 and hasattr(store, 'path'):
+            return store.path(attachment.sha256)
+        return attachment.open_content()
+    return open_source
+
+
+def delete_thumbnails(kind, key):
+    """Удаляет все копии вложения (после удаления самого вложения)."""
+    for size in THUMB_SIZES:
+        try:
+            os.remove(thumbnail_path(kind, key, size))
+        except FileNotFoundError:
+            pass
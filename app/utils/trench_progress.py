@@ -0,0 +1,68 @@
+"""
+Пересчёт сводки по копке траншей
+
+Trench.total_excavated, files_count и required_files хранятся в строке
+траншеи и обновляются при добавлении записи о копке (Trench.refresh_progress),
+поэтому списки и карточки траншей не обходят записи о копке и файлы. После
+первого развёртывания сводка пересчитывается сама при первом запросе к
+страницам объектов (отметка в SystemSetting), после правок записей о копке в
+обход приложения — командой `flask trenches refresh-progress`.
+"""
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func
+
+from app.extensions import db
+from app.models.objects import Trench, TrenchExcavation, TrenchFile
+from app.models.settings import SystemSetting
+from app.utils.timezone_utils import get_moscow_now
+
+# Отметка о пересчёте сводки по записям о копке
+REFRESHED_SETTING = 'trench_progress_refreshed_at'
+# Процесс уже видел отметку о пересчёте и больше не читает SystemSetting
+_refreshed = False
+
+
+def refresh_trench_progress():
+    """Пересчитывает сводку всех траншей двумя групповыми запросами. Возвращает число изменённых."""
+    lengths = dict(
+        db.session.query(TrenchExcavation.trench_id, func.sum(TrenchExcavation.length))
+        .group_by(TrenchExcavation.trench_id)
+    )
+    files = dict(
+        db.session.query(TrenchFile.trench_id, func.count(TrenchFile.id))
+        .group_by(TrenchFile.trench_id)
+    )
+    changed = 0
+    for trench in Trench.query:
+        total_excavated = lengths.get(trench.id) or 0.0
+        progress = (total_excavated, files.get(trench.id, 0), Trench.required_files_for(total_excavated))
+        if (trench.total_excavated, trench.files_count, trench.required_files) != progress:
+            trench.total_excavated, trench.files_count, trench.required_files = progress
+            changed += 1
+    db.session.commit()
+    SystemSetting.set(REFRESHED_SETTING, get_moscow_now().isoformat())
+    return changed
+
+
+def ensure_trench_progress():
+    """Пересчитывает сводку, если она ещё ни разу не пересчитывалась.
+
+    Колонки сводки добавлены со значениями по умолчанию, поэтому у траншей,
+    созданных до развёртывания, они не заполнены.
+    """
+    global _refreshed
+    if _refreshed:
+        return
+    if SystemSetting.get(REFRESHED_SETTING) is None:
+        refresh_trench_progress()
+    _refreshed = True
+
+
+trenches_cli = AppGroup('trenches', help='Обслуживание траншей')
+
+
+@trenches_cli.command('refresh-progress')
+def refresh_progress_command():
+    """Пересчёт выкопанной длины и числа файлов по записям о копке."""
+    click.echo(f'Обновлено траншей: {refresh_trench_progress()}')
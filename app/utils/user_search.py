@@ -0,0 +1,122 @@
+"""
+Поиск пользователей для автодополнения (/api/supply/users/search)
+
+ILIKE '%q%' по нескольким полям не обслуживается индексом, поэтому поиск идёт
+по индексу в памяти процесса: для каждого пользователя хранится
+нормализованная строка «фамилия имя отчество логин» и её триграммы.
+Совпадения по подстроке находятся пересечением списков триграмм запроса,
+при их нехватке добавляются похожие написания (опечатки). Результаты
+ранжируются: точное совпадение, начало слова, подстрока, похожее написание.
+
+Индекс сбрасывается во всех процессах после commit, в котором пользователь
+создан, удалён или изменились его ФИО или логин (app/utils/shared_index.py).
+"""
+import heapq
+from collections import Counter, defaultdict
+
+from app.extensions import db
+from app.models.users import Users
+from app.utils.material_index import trigrams
+from app.utils.shared_index import SharedIndex
+
+USER_INDEX_TAG = 'index:users'
+# Страховочный срок жизни индекса, если общий кэш недоступен
+USER_INDEX_TTL = 3600
+# Доля общих триграмм с запросом, начиная с которой написание считается похожим
+FUZZY_MIN_SIMILARITY = 0.6
+SEARCHED_FIELDS = ('firstname', 'secondname', 'thirdname', 'login')
+
+RANK_EXACT, RANK_PREFIX, RANK_SUBSTRING, RANK_FUZZY = range(4)
+
+
+def normalize(text):
+    """Нижний регистр, ё -> е, одиночные пробелы."""
+    return ' '.join((text or '').lower().replace('ё', 'е').split())
+
+
+class UserSearchIndex:
+    """Снимок ФИО и логинов пользователей с поиском по подстроке и триграммам."""
+
+    def __init__(self, rows):
+        self.entries = []
+        self.postings = defaultdict(set)
+        for userid, firstname, secondname, thirdname, login in rows:
+            full_name = f"{secondname or ''} {firstname or ''} {thirdname or ''}".strip() or (login or '')
+            name_key = normalize(f'{secondname or ""} {firstname or ""} {thirdname or ""}')
+            login_key = normalize(login)
+            haystack = f'{name_key} {login_key}'.strip()
+            position = len(self.entries)
+            self.entries.append({
+                'id': str(userid),
+                'name': full_name,
+                'login': login or '',
+                'name_key': name_key,
+                'login_key': login_key,
+                'haystack': haystack,
+                'words': haystack.split(),
+            })
+            for gram in trigrams(haystack):
+                self.postings[gram].add(position)
+
+    def _rank(self, entry, query):
+        if query in (entry['login_key'], entry['name_key']):
+            return RANK_EXACT
+        if entry['haystack'].startswith(query) or any(word.startswith(query) for word in entry['words']):
+            return RANK_PREFIX
+        return RANK_SUBSTRING
+
+    def search(self, query, limit=10):
+        """До limit пользователей, лучшие совпадения первыми."""
+        query = normalize(query)
+        if not query:
+            return []
+
+        # Триграммы без краевых (с пробелами-заполнителями) есть у любой строки,
+        # содержащей запрос как подстроку
+        inner = [gram for gram in trigrams(query) if ' ' not in gram[0] + gram[-1]]
+        if inner:
+            posting_sets = sorted((self.postings.get(gram, set()) for gram in inner), key=len)
+            candidates = set.intersection(*posting_sets)
+        else:
+            candidates = range(len(self.entries))
+
+        ranked = []
+        found = set()
+        for position in candidates:
+            entry = self.entries[position]
+            if query in entry['haystack']:
+                ranked.append((self._rank(entry, query), 0.0, entry['name'], position))
+                found.add(position)
+
+        if len(ranked) < limit and inner:
+            # Похожие написания: доля триграмм запроса, найденных у пользователя
+            shared = Counter()
+            for gram in inner:
+                shared.update(self.postings.get(gram, ()))
+            for position, common in shared.items():
+                similarity = common / len(inner)
+                if position not in found and similarity >= FUZZY_MIN_SIMILARITY:
+                    ranked.append((RANK_FUZZY, -similarity, self.entries[position]['name'], position))
+
+        return [self.entries[position] for _, _, _, position in heapq.nsmallest(limit, ranked)]
+
+
+def _build_user_index():
+    rows = db.session.query(
+        Users.userid, Users.firstname, Users.secondname, Users.thirdname, Users.login
+    ).all()
+    return UserSearchIndex(rows)
+
+
+_index = SharedIndex(USER_INDEX_TAG, _build_user_index, max_age=USER_INDEX_TTL)
+_index.watch(Users, SEARCHED_FIELDS)
+
+
+def get_user_index():
+    """Текущий индекс; строится одним запросом при первом обращении и после сброса."""
+    return _index.get()
+
+
+def invalidate_user_index():
+    """Сбрасывает индекс в текущем процессе."""
+    _index.invalidate()
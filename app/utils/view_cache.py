@@ -0,0 +1,68 @@
+"""
+Кэш готового HTML страниц объектов
+
+Страницы списков (объекты, отчёты, запланированные работы) строятся из
+нескольких запросов и рендера большого шаблона. Готовый HTML хранится в
+общем кэше (app/utils/shared_cache.py) под ключом
+
+    page:<endpoint>:<пользователь>:<язык>:<устройство>:<дата>:<хэш строки запроса>
+
+- пользователь — id вошедшего (шапка страницы и кнопки зависят от него);
+- язык — выбранный в сессии язык интерфейса;
+- устройство — 'mobile' или 'desktop' по is_mobile_device(): у страниц
+  разные шаблоны;
+- дата — страницы со статусами и «последними 30 днями» меняются в полночь.
+
+Кэшируется только рендер: запись в журнал действий и прочие действия на
+каждый запрос маршрут выполняет сам до вызова cached_page(). Если в сессии
+ждут показа flash-сообщения, страница строится заново и не сохраняется.
+
+Страница помечается тегами данных (app/utils/cache_tags.py) и перестаёт
+отдаваться из кэша после commit, изменившего эти данные, и тегом самого
+пользователя.
+"""
+import hashlib
+
+from flask import current_app, request, session
+from flask_login import current_user
+
+from app.utils.cache_tags import cached_value, user_tag
+from app.utils.mobile_detection import is_mobile_device
+from app.utils.timezone_utils import get_moscow_now
+
+PAGE_NAMESPACE = 'page'
+DEFAULT_PAGE_TIMEOUT = 6 * 3600
+
+
+def page_key():
+    who = f'user={current_user.get_id()}'
+    language = session.get('language', 'ru')
+    device = 'mobile' if is_mobile_device() else 'desktop'
+    args = str(sorted(request.args.items(multi=True))).encode()
+    query_hash = hashlib.md5(args).hexdigest()
+    today = get_moscow_now().date().isoformat()
+    return f'{PAGE_NAMESPACE}:{request.endpoint}:{who}:{language}:{device}:{today}:{query_hash}'
+
+
+def cached_page(render, tags, timeout=None):
+    """HTML страницы из кэша или результат render() с сохранением в кэш.
+
+    render() вызывается без аргументов; кэшируется только строка HTML
+    (перенаправления и прочие ответы возвращаются как есть).
+    """
+    if session.get('_flashes'):
+        return render()
+    tags = [*tags, user_tag(current_user.get_id())]
+    if timeout is None:
+        timeout = current_app.config.get('PAGE_CACHE_TIMEOUT', DEFAULT_PAGE_TIMEOUT)
+    result = {}
+
+    def render_html():
+        html = render()
+        if isinstance(html, str):
+            return html
+        result['response'] = html
+        return None
+
+    html = cached_value(page_key(), tags, render_html, timeout=timeout)
+    return result.get('response', html)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест складского учёта: параллельные выдачи одного материала
+
+Запускает несколько потоков, каждый из которых выдаёт материал со склада
+через app.utils.stock_ledger, и проверяет, что остаток никогда не уходит в
+минус, а сумма «остаток на складе + выдано пользователю» сохраняется.
+
+По умолчанию используется временная SQLite-база; для проверки блокировок
+FOR UPDATE на PostgreSQL укажите TEST_DATABASE_URL.
+"""
+
+import os
+import tempfile
+import threading
+
+from app import create_app
+from app.config import Config
+from app.extensions import db
+
+INITIAL_QUANTITY = 25.0
+THREADS = 8
+MOVES_PER_THREAD = 5  # 40 попыток выдачи при 25 единицах на складе
+
+
+def make_app(database_url, **overrides):
+    class StressConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_url
+        TESTING = True
+        DEBUG = True  # планировщик задач не запускается
+
+    for key, value in overrides.items():
+        setattr(StressConfig, key, value)
+    return create_app(StressConfig)
+
+
+def test_parallel_moves_never_oversell():
+    """Параллельные выдачи не уводят остаток в минус"""
+    from app.models.supply import Material, UserMaterialAllocation, WarehouseMovement
+    from app.models.users import Users
+    from app.utils.stock_ledger import StockLedgerError, commit_with_retry, post_movement
+
+    tmp_dir = tempfile.mkdtemp()
+    database_url = os.environ.get('TEST_DATABASE_URL') or f"sqlite:///{os.path.join(tmp_dir, 'stress.db')}"
+    app = make_app(database_url)
+
+    with app.app_context():
+        db.create_all()
+        storekeeper = Users(login='stress_storekeeper', password='-', role='Снабженец')
+        worker = Users(login='stress_worker', password='-', role='Прораб')
+        material = Material(name='Кабель (нагрузочный тест)', unit='м', current_quantity=INITIAL_QUANTITY)
+        db.session.add_all([storekeeper, worker, material])
+        db.session.commit()
+        storekeeper_id, worker_id, material_id = storekeeper.userid, worker.userid, material.id
+
+    results = {'ok': 0, 'rejected': 0}
+    observed_negative = []
+    lock = threading.Lock()
+    start = threading.Barrier(THREADS)
+
+    def issue():
+        with app.app_context():
+            start.wait()
+            for _ in range(MOVES_PER_THREAD):
+                try:
+                    _, material, _ = commit_with_retry(lambda: post_movement(
+                        material_id, 'move', 1.0, storekeeper_id, to_user_id=worker_id,
+                    ), attempts=50)
+                    outcome = 'ok'
+                    if material.current_quantity < 0:
+                        observed_negative.append(material.current_quantity)
+                except StockLedgerError:
+                    outcome = 'rejected'
+                with lock:
+                    results[outcome] += 1
+            db.session.remove()
+
+    threads = [threading.Thread(target=issue) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        material = db.session.get(Material, material_id)
+        allocation = UserMaterialAllocation.query.filter_by(user_id=worker_id, material_id=material_id).first()
+        issued = allocation.quantity if allocation else 0.0
+        movements = WarehouseMovement.query.filter_by(material_id=material_id).count()
+
+        print(f"Успешных выдач: {results['ok']}, отклонено: {results['rejected']}")
+        print(f"Остаток на складе: {material.current_quantity}, выдано: {issued}, движений: {movements}")
+
+        assert not observed_negative
+        assert material.current_quantity >= 0
+        assert results['ok'] + results['rejected'] == THREADS * MOVES_PER_THREAD
+        assert results['ok'] == movements == issued
+        assert material.current_quantity + issued == INITIAL_QUANTITY
+        db.drop_all()
+
+
+def test_movements_batch_endpoint():
+    """Пакетное движение проводится целиком или не проводится вовсе"""
+    from app.models.supply import Material, UserMaterialAllocation, WarehouseMovement
+    from app.models.users import Users
+    from app.utils.stock_ledger import lock_allocations
+
+    tmp_dir = tempfile.mkdtemp()
+    app = make_app(
+        f"sqlite:///{os.path.join(tmp_dir, 'batch.db')}",
+        CACHE_DIR=os.path.join(tmp_dir, 'cache'),
+        ACTIVITY_LOG_ASYNC=False,
+    )
+
+    with app.app_context():
+        db.create_all()
+        storekeeper = Users(login='batch_storekeeper', password='-', role='Снабженец')
+        worker = Users(login='batch_worker', password='-', role='Прораб')
+        other = Users(login='batch_other', password='-', role='Прораб')
+        cable = Material(name='Кабель (пакет)', unit='м', current_quantity=10.0)
+        bolts = Material(name='Болты (пакет)', unit='шт', current_quantity=3.0)
+        db.session.add_all([storekeeper, worker, other, cable, bolts])
+        db.session.commit()
+        worker_id, other_id = worker.userid, other.userid
+        cable_id, bolts_id = cable.id, bolts.id
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(storekeeper.userid)
+            session['_fresh'] = True
+
+        response = client.post('/supply/api/supply/movements/batch', json={
+            'movement_type': 'move',
+            'to_user_id': str(worker_id),
+            'lines': [
+                {'material_id': str(cable_id), 'quantity': 4},
+                {'material_id': str(bolts_id), 'quantity': 2},
+                {'material_id': str(cable_id), 'quantity': 1, 'to_user_id': str(other_id)},
+            ],
+        })
+        assert response.status_code == 201, response.get_json()
+        assert len(response.get_json()['movements']) == 3
+
+        db.session.expire_all()
+        assert db.session.get(Material, cable_id).current_quantity == 5.0
+        assert db.session.get(Material, bolts_id).current_quantity == 1.0
+        issued = {
+            (a.user_id, a.material_id): a.quantity for a in UserMaterialAllocation.query
+        }
+        assert issued == {(worker_id, cable_id): 4.0, (worker_id, bolts_id): 2.0, (other_id, cable_id): 1.0}
+
+        # Блокируются только запрошенные пары, а не все сочетания пользователей и материалов
+        locked = lock_allocations([(worker_id, bolts_id), (other_id, cable_id)])
+        assert set(locked) == {(worker_id, bolts_id), (other_id, cable_id)}
+        db.session.rollback()
+
+        # Вторая строка превышает остаток — не проводится ни одна строка
+        response = client.post('/supply/api/supply/movements/batch', json={
+            'movement_type': 'move',
+            'to_user_id': str(worker_id),
+            'lines': [
+                {'material_id': str(cable_id), 'quantity': 1},
+                {'material_id': str(bolts_id), 'quantity': 5},
+            ],
+        })
+        assert response.status_code == 400
+        assert [error['line'] for error in response.get_json()['errors']] == [1]
+
+        # Ошибки разбора строк возвращаются до проведения
+        response = client.post('/supply/api/supply/movements/batch', json={
+            'lines': [{'material_id': str(cable_id), 'quantity': 'много', 'movement_type': 'move'}],
+        })
+        assert response.status_code == 400
+
+        db.session.expire_all()
+        assert db.session.get(Material, cable_id).current_quantity == 5.0
+        assert db.session.get(Material, bolts_id).current_quantity == 1.0
+        assert WarehouseMovement.query.count() == 3
+        db.drop_all()
+
+
+if __name__ == "__main__":
+    test_parallel_moves_never_oversell()
+    test_movements_batch_endpoint()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Тест поиска пользователей для автодополнения (/api/supply/users/search)
+
+Проверяет, что эндпоинт отвечает по индексу в памяти и что кэш ответов
+сбрасывается вместе с индексом после изменения ФИО пользователя.
+"""
+
+import os
+import tempfile
+
+from app import create_app
+from app.config import Config
+from app.extensions import db
+
+
+def make_app(database_url, **overrides):
+    class SearchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_url
+        TESTING = True
+        DEBUG = True  # планировщик задач не запускается
+
+    for key, value in overrides.items():
+        setattr(SearchConfig, key, value)
+    return create_app(SearchConfig)
+
+
+def test_users_search_endpoint():
+    """Поиск находит пользователя и видит переименование сразу после commit"""
+    from app.models.users import Users
+
+    tmp_dir = tempfile.mkdtemp()
+    app = make_app(
+        f"sqlite:///{os.path.join(tmp_dir, 'search.db')}",
+        CACHE_DIR=os.path.join(tmp_dir, 'cache'),
+        ACTIVITY_LOG_ASYNC=False,
+    )
+
+    with app.app_context():
+        db.create_all()
+        storekeeper = Users(login='search_storekeeper', password='-', role='Снабженец')
+        worker = Users(login='ivanov_i', password='-', role='Прораб', firstname='Иван', secondname='Иванов')
+        db.session.add_all([storekeeper, worker])
+        db.session.commit()
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(storekeeper.userid)
+            session['_fresh'] = True
+
+        response = client.get('/supply/api/supply/users/search?q=иванов')
+        assert response.status_code == 200, response.get_data(as_text=True)
+        assert [user['login'] for user in response.get_json()] == ['ivanov_i']
+
+        # Повторный запрос отдаётся из кэша ответов
+        response = client.get('/supply/api/supply/users/search?q=иванов')
+        assert [user['login'] for user in response.get_json()] == ['ivanov_i']
+
+        # Переименование сбрасывает тег индекса, а с ним и кэш ответов
+        worker.secondname = 'Петров'
+        db.session.commit()
+        response = client.get('/supply/api/supply/users/search?q=иванов')
+        assert response.get_json() == []
+        response = client.get('/supply/api/supply/users/search?q=петров')
+        assert [user['login'] for user in response.get_json()] == ['ivanov_i']
+
+        # Слишком короткий запрос не ищется
+        response = client.get('/supply/api/supply/users/search?q=и')
+        assert response.get_json() == []
+        db.drop_all()
+
+
+if __name__ == "__main__":
+    test_users_search_endpoint()